@@ -2,20 +2,195 @@
 # -*- coding: utf-8 -*-
 """
 Claude 对话历史自动备份守护进程
-在后台运行，定期自动保存对话历史
+在后台运行，定期自动保存对话历史；监听模式下会话文件一有变化即增量导出
 """
 
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
+import importlib.util
+import io
+import multiprocessing
+import os
+import re
+import select
+import struct
 import time
-import subprocess
+import traceback
 from pathlib import Path
 from datetime import datetime
 import sys
 
+from history_archive import HistoryArchive
+from history_metrics import Metrics
+
+# inotify 事件掩码（见 <sys/inotify.h>）
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# 每次导出的默认时间预算（秒），到时后剩余的会话留到下一次
+DEFAULT_BUDGET_SECONDS = 120
+
+# 导出输出中需要写入日志的行（MessageStream 的解析错误、索引不可用等）
+EXPORT_PROBLEM_PATTERN = re.compile(r'error|warning|disabled', re.IGNORECASE)
+
+# 导出超出预算或出错后的首次退避时间，之后每次翻倍，最长 --max-backoff 秒
+BACKOFF_BASE_SECONDS = 5
+
+# 上次导出留有未完成的工作时，下一次导出前的等待时间
+RESUME_DELAY_SECONDS = 2
+
+# 原始历史归档的默认位置
+DEFAULT_ARCHIVE_DIR = Path.home() / "Documents" / "Claude History" / "archive"
+
+class InotifyWatcher:
+    """基于 Linux inotify 的会话文件监听，空闲时阻塞在 select 上不占 CPU"""
+
+    name = "inotify"
+    DIR_MASK = IN_CREATE | IN_MOVED_TO
+    FILE_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO
+
+    def __init__(self, projects_dir):
+        libc_name = ctypes.util.find_library('c')
+        if not sys.platform.startswith('linux') or not libc_name:
+            raise OSError("inotify is not available on this platform")
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+        self.projects_dir = projects_dir
+        self.watches = {}
+        self.add_watch(projects_dir, self.DIR_MASK)
+        for project_dir in projects_dir.iterdir():
+            if project_dir.is_dir():
+                self.add_watch(project_dir, self.FILE_MASK)
+
+    def add_watch(self, path, mask):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(str(path)), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        self.watches[wd] = path
+
+    def wait(self, timeout):
+        """等待变化，返回变化的会话文件集合；超时返回空集合，事件溢出返回 None"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        changed = set()
+        buf = os.read(self.fd, 64 * 1024)
+        pos = 0
+        while pos < len(buf):
+            wd, mask, _cookie, length = INOTIFY_EVENT.unpack_from(buf, pos)
+            name = buf[pos + INOTIFY_EVENT.size:pos + INOTIFY_EVENT.size + length].rstrip(b'\0')
+            pos += INOTIFY_EVENT.size + length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            parent = self.watches.get(wd)
+            if parent is None or not name:
+                continue
+            path = parent / os.fsdecode(name)
+
+            if parent == self.projects_dir:
+                if mask & IN_ISDIR:
+                    # 新项目目录：开始监听，并把其中已存在的会话算作变化
+                    self.add_watch(path, self.FILE_MASK)
+                    changed.update(path.glob("*.jsonl"))
+            elif path.suffix == '.jsonl':
+                changed.add(path)
+        return changed
+
+class PollingWatcher:
+    """通用的轮询监听：定期比较会话文件的大小和修改时间"""
+
+    name = "polling"
+
+    def __init__(self, projects_dir, poll_interval=5):
+        self.projects_dir = projects_dir
+        self.poll_interval = poll_interval
+        self.state = self.snapshot()
+
+    def snapshot(self):
+        state = {}
+        if not self.projects_dir.exists():
+            return state
+        for project_dir in os.scandir(self.projects_dir):
+            if not project_dir.is_dir():
+                continue
+            for entry in os.scandir(project_dir.path):
+                if entry.name.endswith('.jsonl'):
+                    st = entry.stat()
+                    state[entry.path] = (st.st_size, st.st_mtime)
+        return state
+
+    def wait(self, timeout):
+        """等待变化，返回变化的会话文件集合；超时返回空集合"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            state = self.snapshot()
+            changed = {Path(path) for path, stat in state.items() if self.state.get(path) != stat}
+            self.state = state
+            if changed:
+                return changed
+
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return set()
+            time.sleep(self.poll_interval if remaining is None else min(self.poll_interval, remaining))
+
+def load_manager_module(script_path):
+    """加载 claude-history-manager.py（文件名含连字符，不能直接 import）
+
+    注册到 sys.modules，并行导出时进程池才能按模块名序列化管理器。
+    """
+    spec = importlib.util.spec_from_file_location('claude_history_manager', script_path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def create_watcher(projects_dir):
+    """优先使用 inotify，不可用时退回轮询"""
+    try:
+        return InotifyWatcher(projects_dir)
+    except OSError:
+        return PollingWatcher(projects_dir)
+
 class AutoBackup:
-    def __init__(self, interval_minutes=30):
+    """在进程内驱动 ClaudeHistoryManager 的导出调度
+
+    管理器在第一次导出时创建并一直保留，清单、摘要、用量汇总表和全文索引连接都留在内存中，
+    之后每次导出只需检查文件状态。导出依次执行，下一次总在上一次结束后才开始；
+    每次导出有时间预算，到时后未完成的会话留到下一次继续；超出预算或出错后按指数退避推迟下一次导出。
+    """
+
+    def __init__(self, interval_minutes=30, debounce_seconds=2, max_delay_seconds=10,
+                 archive_dir=None, archive_interval_minutes=60, profile=False,
+                 budget_seconds=DEFAULT_BUDGET_SECONDS, max_backoff_seconds=300):
         self.interval = interval_minutes * 60  # 转换为秒
+        self.debounce = debounce_seconds
+        self.max_delay = max_delay_seconds
+        self.budget = budget_seconds
+        self.max_backoff = max_backoff_seconds
         self.script_path = Path(__file__).parent / "claude-history-manager.py"
+        self.projects_dir = Path.home() / ".claude" / "projects"
         self.log_file = Path.home() / ".claude" / "auto-backup.log"
+        self.archive = HistoryArchive(archive_dir) if archive_dir else None
+        self.archive_interval = archive_interval_minutes * 60
+        self.last_archive = None
+        # 开启后每次导出都记录各阶段耗时
+        self.metrics_file = Path.home() / ".claude" / "auto-backup-metrics.json" if profile else None
+        self.manager = None
+        # 连续超出预算或出错的次数，决定退避时间
+        self.slow_cycles = 0
 
     def log(self, message):
         """记录日志"""
@@ -30,54 +205,251 @@ class AutoBackup:
         except:
             pass
 
-    def backup(self):
-        """执行备份"""
+    def get_manager(self):
+        """返回常驻的管理器，第一次调用时加载模块并创建"""
+        if self.manager is None:
+            module = load_manager_module(self.script_path)
+            # 进程池只能在 fork 方式下使用动态加载的模块，其他方式（如 Windows）顺序导出
+            jobs = (os.cpu_count() or 1) if multiprocessing.get_start_method() == 'fork' else 1
+            self.manager = module.ClaudeHistoryManager(jobs=jobs)
+        elif self.manager.reload_if_changed():
+            self.log("Manifest changed on disk, reloaded")
+        return self.manager
+
+    def backup(self, changed=None):
+        """执行一次导出；changed 为会话文件集合时只解析这些会话（以及上次未完成的会话）"""
+        started = time.monotonic()
+        output = io.StringIO()
         try:
-            self.log("Starting backup...")
-            result = subprocess.run(
-                [sys.executable, str(self.script_path)],
-                capture_output=True,
-                text=True,
-                timeout=120
-            )
-
-            if result.returncode == 0:
-                self.log("Backup completed successfully!")
+            if changed:
+                self.log(f"Starting backup of {len(changed)} changed sessions...")
+            elif changed is not None:
+                self.log("Resuming unfinished backup...")
             else:
-                self.log(f"Backup failed: {result.stderr}")
+                self.log("Starting backup...")
+            manager = self.get_manager()
+            manager.metrics = Metrics(enabled=self.metrics_file is not None)
+            # 导出过程的逐项输出不显示在守护进程的控制台上：其中的错误和警告写入日志，
+            # 导出暂停或出错时写入全部输出
+            with contextlib.redirect_stdout(output):
+                manager.export_all(only=changed, deadline=started + self.budget)
 
+            elapsed = time.monotonic() - started
+            self.log_export_output(output.getvalue(), full=manager.has_pending_work())
+            if manager.has_pending_work():
+                self.log(f"Backup paused after {elapsed:.1f}s (time budget {self.budget:g}s): "
+                         f"{len(manager.carry_over)} sessions and {len(manager.deferred_outputs)} "
+                         f"outputs left for the next run")
+            else:
+                self.log(f"Backup completed successfully in {elapsed:.1f}s")
+            self.log_metrics(manager)
+            self.slow_cycles = self.slow_cycles + 1 if elapsed > self.budget else 0
+        except Exception as e:
+            self.log_export_output(output.getvalue(), full=True)
+            self.log(f"Error during backup: {e}\n{traceback.format_exc()}")
+            # 出错后内存中的状态不再可信，下一次重新从清单加载
+            self.manager = None
+            self.slow_cycles += 1
+
+        if self.slow_cycles:
+            self.log(f"Backing off {self.backoff_delay():g}s before the next backup")
+        self.maybe_archive()
+
+    def log_export_output(self, text, full=False):
+        """将导出过程的输出写入日志：full 时全部写入，否则只写含错误或警告的行"""
+        lines = [line for line in text.splitlines() if line.strip()]
+        if not full:
+            lines = [line for line in lines if EXPORT_PROBLEM_PATTERN.search(line)]
+        if lines:
+            self.log("Export output:\n" + "\n".join(f"  {line}" for line in lines))
+
+    def backoff_delay(self):
+        """连续超出预算或出错后，下一次导出前至少等待的秒数"""
+        if not self.slow_cycles:
+            return 0
+        return min(self.max_backoff, BACKOFF_BASE_SECONDS * 2 ** (self.slow_cycles - 1))
+
+    def has_pending_work(self):
+        return self.manager is not None and self.manager.has_pending_work()
+
+    def log_metrics(self, manager):
+        """将本次导出的各阶段耗时和吞吐写入日志"""
+        if not self.metrics_file:
+            return
+        report = manager.metrics.write(self.metrics_file, jobs=manager.jobs)
+        stages = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in report['stages'].items())
+        counters = report['counters']
+        self.log(f"  Stages: {stages}")
+        self.log(f"  Parsed {counters.get('sessions_parsed', 0)} sessions, "
+                 f"{counters.get('bytes_read', 0) / 1024 / 1024:.1f} MB read, "
+                 f"{counters.get('files_written', 0)} files written")
+
+    def maybe_archive(self):
+        """开启归档时，距上次快照超过归档间隔则创建新快照"""
+        if not self.archive:
+            return
+        now = time.monotonic()
+        if self.last_archive is not None and now - self.last_archive < self.archive_interval:
+            return
+        self.last_archive = now
+        self.archive_history()
+
+    def archive_history(self):
+        """归档原始会话文件，只存储新增的数据块"""
+        try:
+            started = time.monotonic()
+            name, stats = self.archive.snapshot(self.projects_dir)
+            elapsed = time.monotonic() - started
+            if name:
+                self.log(f"Archived snapshot {name}: {stats['changed']}/{stats['files']} files changed, "
+                         f"{stats['chunks']} new chunks ({stats['bytes'] / 1024:.1f} KB) in {elapsed:.1f}s")
+            else:
+                self.log(f"Archive unchanged ({stats['files']} files)")
         except Exception as e:
-            self.log(f"Error during backup: {e}")
+            self.log(f"Error during archive: {e}")
 
     def run(self):
         """运行守护进程"""
         self.log(f"Auto-backup daemon started (interval: {self.interval // 60} minutes)")
 
-        # 立即执行一次备份
-        self.backup()
-
         try:
             while True:
-                time.sleep(self.interval)
                 self.backup()
+                # 从上一次导出结束时开始计时，两次导出不会重叠
+                delay = RESUME_DELAY_SECONDS if self.has_pending_work() else self.interval
+                time.sleep(max(delay, self.backoff_delay()))
         except KeyboardInterrupt:
             self.log("Auto-backup daemon stopped")
 
-def main():
-    if len(sys.argv) > 1:
+    def wait_for_changes(self, watcher):
+        """阻塞直到有会话变化，并合并随后连续写入的变化（去抖）
+
+        返回变化的会话文件集合；无法确定具体文件时返回 None。
+        """
+        changed = set()
+        while not changed:
+            changed = watcher.wait(None)
+            if changed is None:
+                return None
+
+        # 等到连续 debounce 秒没有新写入，但最多推迟 max_delay 秒
+        deadline = time.monotonic() + self.max_delay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            more = watcher.wait(min(self.debounce, remaining))
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed |= more
+
+    def gather_changes(self, watcher, seconds):
+        """在 seconds 秒内收集变化的会话文件；无法确定具体文件时返回 None"""
+        changed = set()
+        deadline = time.monotonic() + seconds
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return changed
+            more = watcher.wait(remaining)
+            if more is None:
+                return None
+            changed |= more
+
+    def watch(self):
+        """监听模式：会话文件新增或追加后数秒内增量导出"""
+        self.projects_dir.mkdir(parents=True, exist_ok=True)
+        watcher = create_watcher(self.projects_dir)
+        self.log(f"Auto-backup watching {self.projects_dir} ({watcher.name})")
+
+        # 先补上启动前的变化
+        changed = None
         try:
-            interval = int(sys.argv[1])
-        except ValueError:
-            interval = 30
-    else:
+            while True:
+                self.backup(changed)
+                # 退避或有未完成的工作时，先等待一段时间并收集期间的变化
+                wait = max(RESUME_DELAY_SECONDS if self.has_pending_work() else 0, self.backoff_delay())
+                changed = self.gather_changes(watcher, wait) if wait else set()
+                if changed is not None and not changed and not self.has_pending_work():
+                    changed = self.wait_for_changes(watcher)
+        except KeyboardInterrupt:
+            self.log("Auto-backup daemon stopped")
+
+def main():
+    parser = argparse.ArgumentParser(description="Claude 对话历史自动备份守护进程")
+    parser.add_argument('interval', nargs='?', default='30',
+                        help="定时备份的间隔（分钟），默认 30")
+    parser.add_argument('--watch', action='store_true',
+                        help="监听模式：会话文件变化后数秒内只导出有变化的会话")
+    parser.add_argument('--debounce', type=float, default=2,
+                        help="监听模式下等待写入平静的秒数，默认 2")
+    parser.add_argument('--archive', action='store_true',
+                        help="同时归档原始 JSONL（去重压缩存储，并定期创建快照）")
+    parser.add_argument('--archive-dir', default=str(DEFAULT_ARCHIVE_DIR),
+                        help="归档目录（默认: ~/Documents/Claude History/archive）")
+    parser.add_argument('--archive-interval', type=float, default=60,
+                        help="两次快照之间的最短间隔（分钟），默认 60")
+    parser.add_argument('--budget', type=float, default=DEFAULT_BUDGET_SECONDS,
+                        help=f"每次导出的时间预算（秒），到时后剩余的会话留到下一次，默认 {DEFAULT_BUDGET_SECONDS}")
+    parser.add_argument('--max-backoff', type=float, default=300,
+                        help="导出超出预算或出错后推迟下一次导出的最长秒数，默认 300")
+    parser.add_argument('--profile', action='store_true',
+                        help="在日志中记录每次导出的各阶段耗时（报告保存在 ~/.claude/auto-backup-metrics.json）")
+    parser.add_argument('--snapshot', action='store_true', help="立即创建一次快照后退出")
+    parser.add_argument('--list-snapshots', action='store_true', help="列出所有快照后退出")
+    parser.add_argument('--restore', metavar='SNAPSHOT', help="将指定快照还原到 --restore-to 目录后退出")
+    parser.add_argument('--restore-to', metavar='DIR', help="还原目标目录（必须为空或不存在）")
+    parser.add_argument('--prune', action='store_true',
+                        help="删除不再被任何快照引用的数据块后退出（配合 --keep 先删除较早的快照）")
+    parser.add_argument('--keep', type=int, metavar='N', help="--prune 时只保留最近 N 个快照")
+    args = parser.parse_args()
+
+    if args.keep is not None and (not args.prune or args.keep < 1):
+        parser.error("--keep requires --prune and must be at least 1")
+    if args.snapshot or args.list_snapshots or args.restore or args.prune:
+        archive = HistoryArchive(args.archive_dir)
+        if args.prune:
+            snapshots, chunks = archive.prune(args.keep)
+            print(f"Removed {snapshots} snapshots and {chunks} unreferenced chunks")
+        elif args.list_snapshots:
+            for name in archive.list_snapshots():
+                snapshot = archive.load_snapshot(name)
+                size = sum(record['size'] for record in snapshot['files'].values())
+                print(f"{name}  {len(snapshot['files'])} files  {size / 1024 / 1024:.1f} MB")
+        elif args.restore:
+            if not args.restore_to:
+                parser.error("--restore requires --restore-to")
+            count = archive.restore(args.restore, args.restore_to)
+            print(f"Restored {count} files from snapshot {args.restore} to {args.restore_to}")
+        else:
+            AutoBackup(archive_dir=args.archive_dir).archive_history()
+        return
+
+    try:
+        interval = int(args.interval)
+    except ValueError:
         interval = 30
 
     print(f"Starting auto-backup daemon...")
-    print(f"Backup interval: {interval} minutes")
+    if args.watch:
+        print(f"Mode: watch (debounce {args.debounce:g}s)")
+    else:
+        print(f"Backup interval: {interval} minutes")
+    if args.archive:
+        print(f"Archive: {args.archive_dir} (every {args.archive_interval:g} minutes)")
     print(f"Press Ctrl+C to stop\n")
 
-    daemon = AutoBackup(interval_minutes=interval)
-    daemon.run()
+    daemon = AutoBackup(interval_minutes=interval, debounce_seconds=args.debounce,
+                        archive_dir=args.archive_dir if args.archive else None,
+                        archive_interval_minutes=args.archive_interval,
+                        profile=args.profile, budget_seconds=args.budget,
+                        max_backoff_seconds=args.max_backoff)
+    if args.watch:
+        daemon.watch()
+    else:
+        daemon.run()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史导出基准测试
+生成合成的 ~/.claude/projects 历史，测量扫描、解析、渲染和完整导出的耗时、吞吐和峰值内存
+"""
+
+import argparse
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from history_metrics import peak_rss_bytes
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+
+# 合成中文文本使用的常用字
+CJK_TEXT = (
+    "的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说"
+    "产种面而方后多定行学法所民得经十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使"
+    "点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明"
+    "看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料"
+)
+LATIN_WORDS = (
+    "the function returns a list of values when called with deploy config server request "
+    "response error fix test build component state props render update database query index"
+).split()
+
+STAGES = ('scan', 'parse', 'markdown', 'html', 'export', 'export_noop', 'export_append')
+
+
+def load_manager_module():
+    """加载 claude-history-manager.py（文件名含连字符，不能直接 import）"""
+    sys.path.insert(0, str(SCRIPT_DIR))
+    spec = importlib.util.spec_from_file_location(
+        'claude_history_manager', SCRIPT_DIR / 'claude-history-manager.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class HistoryGenerator:
+    """生成与 Claude Code 写出格式一致的合成会话文件"""
+
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+
+    def text(self):
+        """按对数正态分布生成一段中英混合文本"""
+        args = self.args
+        length = int(self.rng.lognormvariate(math.log(args.median_chars), args.size_sigma))
+        length = max(1, min(length, args.max_chars))
+        parts = []
+        size = 0
+        while size < length:
+            if self.rng.random() < args.cjk_ratio:
+                piece = ''.join(self.rng.choices(CJK_TEXT, k=self.rng.randint(4, 30)))
+            else:
+                piece = ' '.join(self.rng.choices(LATIN_WORDS, k=self.rng.randint(3, 12))) + ' '
+            parts.append(piece)
+            size += len(piece)
+        return ''.join(parts)[:length]
+
+    def record(self, record_type, session_id, parent, timestamp, message):
+        return {
+            'parentUuid': parent,
+            'isSidechain': False,
+            'userType': 'external',
+            'cwd': '/home/user/project',
+            'sessionId': session_id,
+            'version': '1.0.0',
+            'type': record_type,
+            'message': message,
+            'uuid': str(uuid.UUID(int=self.rng.getrandbits(128))),
+            'timestamp': timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + f"{timestamp.microsecond // 1000:03d}Z",
+        }
+
+    def session_records(self, session_id, start):
+        """产出一个会话的所有记录"""
+        args = self.args
+        timestamp = start
+        parent = None
+        yield {'type': 'summary', 'summary': self.text()[:60], 'leafUuid': str(uuid.uuid4())}
+
+        for i in range(args.messages):
+            timestamp += timedelta(seconds=self.rng.randint(2, 300))
+            if i % 2 == 0:
+                # 用户输入一半是纯字符串，一半是内容块
+                text = self.text()
+                content = text if self.rng.random() < 0.5 else [{'type': 'text', 'text': text}]
+                record = self.record('user', session_id, parent,
+                                     timestamp, {'role': 'user', 'content': content})
+            else:
+                record = self.record('assistant', session_id, parent, timestamp, {
+                    'id': f"msg_{self.rng.getrandbits(64):016x}",
+                    'type': 'message',
+                    'role': 'assistant',
+                    'model': self.rng.choice(('claude-sonnet-4-20250514', 'claude-opus-4-20250514')),
+                    'content': [{'type': 'text', 'text': self.text()}],
+                    'stop_reason': 'end_turn',
+                    'usage': {
+                        'input_tokens': self.rng.randint(10, 4000),
+                        'cache_read_input_tokens': self.rng.randint(0, 20000),
+                        'output_tokens': self.rng.randint(10, 2000),
+                    },
+                })
+            parent = record['uuid']
+            yield record
+
+            if i % 2 == 1 and self.rng.random() < args.tool_ratio:
+                # 工具调用及其（通常很大的）结果
+                tool_id = f"toolu_{self.rng.getrandbits(64):016x}"
+                record = self.record('assistant', session_id, parent, timestamp, {
+                    'role': 'assistant',
+                    'content': [{'type': 'tool_use', 'id': tool_id, 'name': 'Read',
+                                 'input': {'file_path': '/home/user/project/src/App.jsx'}}],
+                })
+                parent = record['uuid']
+                yield record
+                payload = 'x' * int(self.rng.expovariate(1 / args.tool_bytes))
+                record = self.record('user', session_id, parent, timestamp, {
+                    'role': 'user',
+                    'content': [{'type': 'tool_result', 'tool_use_id': tool_id, 'content': payload}],
+                })
+                parent = record['uuid']
+                yield record
+
+    def generate(self, claude_dir):
+        """在 claude_dir/projects 下生成全部项目，返回数据集统计"""
+        args = self.args
+        projects_dir = Path(claude_dir) / 'projects'
+        stats = {'projects': args.projects, 'sessions': 0, 'bytes': 0, 'lines': 0}
+        start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+        for p in range(args.projects):
+            project_dir = projects_dir / f"e-----bench-project-{p:04d}"
+            project_dir.mkdir(parents=True, exist_ok=True)
+            for s in range(args.sessions):
+                session_id = str(uuid.UUID(int=self.rng.getrandbits(128)))
+                path = project_dir / f"{session_id}.jsonl"
+                session_start = start + timedelta(days=self.rng.randint(0, 365))
+                with open(path, 'w', encoding='utf-8') as f:
+                    for record in self.session_records(session_id, session_start):
+                        f.write(json.dumps(record, ensure_ascii=False, separators=(',', ':')))
+                        f.write('\n')
+                        stats['lines'] += 1
+                stats['sessions'] += 1
+                stats['bytes'] += path.stat().st_size
+        return stats
+
+
+def append_messages(claude_dir, sessions, messages):
+    """向前若干个会话追加新消息，模拟增量导出"""
+    paths = sorted((Path(claude_dir) / 'projects').glob('*/*.jsonl'))[:sessions]
+    timestamp = datetime(2027, 1, 1, tzinfo=timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    for path in paths:
+        with open(path, 'a', encoding='utf-8') as f:
+            for i in range(messages):
+                record = {'type': 'user' if i % 2 == 0 else 'assistant', 'timestamp': timestamp,
+                          'message': {'content': [{'type': 'text', 'text': f"appended message {i}"}]}}
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    return len(paths) * messages
+
+
+def unread_bytes(output_dir, files):
+    """导出需要读取的字节数：各会话超出清单中已解析位置的部分（没有清单时为全部）"""
+    try:
+        with open(Path(output_dir) / '.manifest.json', 'r', encoding='utf-8') as f:
+            entries = json.load(f).get('files', {})
+    except (OSError, ValueError):
+        entries = {}
+    total = 0
+    for path in files:
+        entry = entries.get(str(path))
+        total += max(0, path.stat().st_size - (entry['offset'] if entry else 0))
+    return total
+
+
+def run_stage(stage, claude_dir, output_dir, jobs):
+    """在当前进程中执行单个阶段，返回测量结果"""
+    module = load_manager_module()
+    manager = module.ClaudeHistoryManager(jobs=jobs, claude_dir=claude_dir, output_dir=output_dir)
+    projects = manager.get_all_projects()
+    files = [f for project in projects for f in sorted(project['conversations'])]
+    total_bytes = sum(f.stat().st_size for f in files)
+    result = {}
+
+    started = time.perf_counter()
+    if stage == 'scan':
+        for _ in range(10):
+            projects = manager.get_all_projects()
+        result['items'] = sum(len(p['conversations']) for p in projects) * 10
+    elif stage == 'parse':
+        result['items'] = sum(len(manager.parse_conversation(f)[0]) for f in files)
+        result['bytes'] = total_bytes
+    elif stage == 'markdown':
+        scratch = Path(output_dir) / 'markdown'
+        scratch.mkdir(parents=True, exist_ok=True)
+        count = 0
+        for project in projects:
+            for f in sorted(project['conversations']):
+                count += manager.render_session_markdown(
+                    scratch / f"{f.stem}.md", project, f.stem, 0, module.iter_messages(f))
+        result['items'] = count
+        result['bytes'] = total_bytes
+    elif stage == 'html':
+        # 各会话的分页 HTML 和目录页，最后生成 index.html
+        count = 0
+        projects_info = []
+        for project in projects:
+            for f in sorted(project['conversations']):
+                session_dir = Path(output_dir) / 'html' / f.stem
+                session_dir.mkdir(parents=True, exist_ok=True)
+                pages, batch, page_start, messages = [], [], 0, 0
+                for conv in manager.iter_session(f):
+                    if len(batch) == module.SESSION_PAGE_SIZE:
+                        pages.append(manager.write_session_page(session_dir, project, f.stem, len(pages) + 1,
+                                                                page_start, batch, True))
+                        page_start = batch[-1].offset
+                        batch = []
+                    batch.append(conv)
+                    messages += 1
+                pages.append(manager.write_session_page(session_dir, project, f.stem, len(pages) + 1,
+                                                        page_start, batch, False))
+                manager.render_session_toc(session_dir, project, f.stem, pages, messages)
+                count += messages
+                projects_info.append({
+                    'name': project['name'],
+                    'display_name': manager.clean_project_name(project['name']),
+                    'filename': f"{f.stem}.md",
+                    'count': messages,
+                    'summary': pages[0][2],
+                    'last_updated': '2026-01-01 00:00:00',
+                })
+        manager.generate_index_html(projects_info)
+        result['items'] = count
+        result['bytes'] = total_bytes
+    else:
+        # 以命令行方式运行导出脚本，测量真实的端到端耗时（含并行导出的子进程）；
+        # 吞吐按实际需要读取的字节计算，没有变化时为 0
+        result['bytes'] = unread_bytes(output_dir, files)
+        started = time.perf_counter()
+        subprocess.run([
+            sys.executable, str(SCRIPT_DIR / 'claude-history-manager.py'), '--no-browser',
+            '--jobs', str(jobs), '--claude-dir', str(claude_dir), '--output-dir', str(output_dir),
+        ], check=True, stdout=subprocess.DEVNULL)
+        result['items'] = len(files)
+    seconds = time.perf_counter() - started
+
+    result['seconds'] = round(seconds, 4)
+    result['items_per_second'] = round(result['items'] / seconds, 1) if seconds else None
+    if 'bytes' in result:
+        result['mb_per_second'] = round(result['bytes'] / seconds / 2 ** 20, 2) \
+            if seconds and result['bytes'] else None
+    rss = peak_rss_bytes()
+    result['peak_rss_mb'] = round(rss / 2 ** 20, 1) if rss else None
+    return result
+
+
+def spawn_stage(stage, claude_dir, output_dir, jobs):
+    """在独立子进程中执行阶段，使峰值内存只反映该阶段"""
+    with tempfile.NamedTemporaryFile('r', suffix='.json', delete=False) as f:
+        result_file = f.name
+    try:
+        subprocess.run([
+            sys.executable, str(Path(__file__).resolve()), '--run-stage', stage,
+            '--claude-dir', str(claude_dir), '--output-dir', str(output_dir),
+            '--jobs', str(jobs), '--result-file', result_file,
+        ], check=True)
+        with open(result_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    finally:
+        os.unlink(result_file)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=SCRIPT_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report, baseline=None):
+    """打印结果表格；提供基准结果时同时显示变化比例"""
+    dataset = report['dataset']
+    print(f"\nDataset: {dataset['projects']} projects, {dataset['sessions']} sessions, "
+          f"{dataset['lines']} lines, {dataset['bytes'] / 2 ** 20:.1f} MB")
+    print(f"{'stage':<15}{'seconds':>10}{'items/s':>14}{'MB/s':>10}{'peak RSS MB':>14}"
+          + (f"{'vs baseline':>14}" if baseline else ''))
+    for stage, result in report['stages'].items():
+        # 不读取数据的阶段（扫描、没有变化的导出）没有 MB/s
+        mb_per_second = result.get('mb_per_second')
+        mb_column = f"{mb_per_second:>10.1f}" if mb_per_second else f"{'-':>10}"
+        line = (f"{stage:<15}{result['seconds']:>10.3f}{result['items_per_second'] or 0:>14,.0f}"
+                f"{mb_column}{result['peak_rss_mb'] or 0:>14.1f}")
+        old = baseline['stages'].get(stage) if baseline else None
+        if old and old['seconds']:
+            line += f"{result['seconds'] / old['seconds']:>13.2f}x"
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Claude 对话历史导出基准测试")
+    parser.add_argument('--projects', type=int, default=10, help="项目数")
+    parser.add_argument('--sessions', type=int, default=5, help="每个项目的会话数")
+    parser.add_argument('--messages', type=int, default=400, help="每个会话的消息数")
+    parser.add_argument('--median-chars', type=int, default=300, help="消息长度中位数（字符）")
+    parser.add_argument('--size-sigma', type=float, default=1.2, help="消息长度对数正态分布的 sigma")
+    parser.add_argument('--max-chars', type=int, default=200000, help="单条消息最大长度")
+    parser.add_argument('--cjk-ratio', type=float, default=0.7, help="中文文本片段所占比例")
+    parser.add_argument('--tool-ratio', type=float, default=0.5, help="助手回复后附带工具调用的比例")
+    parser.add_argument('--tool-bytes', type=int, default=20000, help="工具结果的平均字节数")
+    parser.add_argument('--seed', type=int, default=42, help="随机种子")
+    parser.add_argument('--jobs', type=int, default=1, help="导出阶段使用的进程数")
+    parser.add_argument('--stages', default=','.join(STAGES), help="要执行的阶段，逗号分隔")
+    parser.add_argument('--workdir', help="合成数据目录（默认使用临时目录并在结束后删除）")
+    parser.add_argument('--output', help="结果 JSON 路径（默认 bench-results/<时间>-<提交>.json）")
+    parser.add_argument('--compare', help="与之前保存的结果 JSON 对比")
+    # 内部使用：在子进程中执行单个阶段
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--claude-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--output-dir', help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        result = run_stage(args.run_stage, args.claude_dir, args.output_dir, args.jobs)
+        with open(args.result_file, 'w', encoding='utf-8') as f:
+            json.dump(result, f)
+        return
+
+    workdir = Path(args.workdir) if args.workdir else Path(tempfile.mkdtemp(prefix='claude-bench-'))
+    claude_dir = workdir / '.claude'
+    output_dir = workdir / 'output'
+    try:
+        print(f"Generating synthetic history in {workdir}...")
+        if claude_dir.exists():
+            shutil.rmtree(claude_dir)
+        started = time.perf_counter()
+        dataset = HistoryGenerator(args).generate(claude_dir)
+        print(f"Generated {dataset['sessions']} sessions ({dataset['bytes'] / 2 ** 20:.1f} MB) "
+              f"in {time.perf_counter() - started:.1f}s")
+
+        stages = {}
+        for stage in args.stages.split(','):
+            if stage not in STAGES:
+                parser.error(f"unknown stage: {stage}")
+            if stage == 'export' and output_dir.exists():
+                shutil.rmtree(output_dir)
+            if stage == 'export_append':
+                append_messages(claude_dir, max(1, dataset['sessions'] // 10), 20)
+            print(f"Running {stage}...")
+            stages[stage] = spawn_stage(stage, claude_dir, output_dir, args.jobs)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'commit': git_commit(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'params': {k: v for k, v in vars(args).items()
+                       if k not in ('run_stage', 'claude_dir', 'output_dir', 'result_file')},
+        },
+        'dataset': dataset,
+        'stages': stages,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    output = Path(args.output) if args.output else (
+        SCRIPT_DIR / 'bench-results'
+        / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}-{report['meta']['commit'] or 'nogit'}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nResults saved to: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,81 +5,433 @@ Claude 对话历史管理器
 自动扫描并管理所有 Claude Code 对话历史
 """
 
+import argparse
+import contextlib
+import gzip
+import hashlib
+import io
 import json
+import os
+import pickle
+import re
+import sqlite3
 import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, repeat
 from pathlib import Path
 from datetime import datetime
+from html import escape
 import shutil
 
+from history_merge import merge_files
+from history_metrics import Metrics, format_report
+from history_output import STREAM_BUFFER_SIZE, AtomicFile, write_if_changed
+from history_parser import DEFAULT_BLOCK_CAP, INTERN_MIN_SIZE, BlockInterner, iter_messages
+from history_search import SearchIndex
+from history_stats import METRICS, UsageCollector, UsageStats, format_tokens
+from history_store import (STORE_VERSION, MessageStore, MessageStoreWriter, decode_time, iter_time_range,
+                           parse_time, read_head_fingerprint, session_view, timestamp_ms)
+from history_thread import THREAD_VERSION, ThreadIndex, uuid_hash
+
+# 增量导出清单的格式版本，结构变化时递增以触发全量重建
+MANIFEST_VERSION = 5
+
+# 输出格式的版本，模板变化时递增：只由消息存储重新渲染所有输出，不重新解析 JSONL
+OUTPUT_VERSION = 2
+
+# 会话中未采用的分支：只显示当前分支，或全部显示并注明分出处
+BRANCH_MODES = ('active', 'all')
+
+# 分页 HTML 中每页的消息数
+SESSION_PAGE_SIZE = 50
+
+# 索引页用量图表显示的天数
+USAGE_CHART_DAYS = 30
+
 class ClaudeHistoryManager:
-    def __init__(self):
-        self.claude_dir = Path.home() / ".claude"
-        self.projects_dir = self.claude_dir / "projects"
-        self.output_dir = Path.home() / "Documents" / "Claude History"
+    def __init__(self, jobs=1, claude_dir=None, output_dir=None, html_pages=False, profile=False,
+                 block_cap=DEFAULT_BLOCK_CAP, branches='active'):
+        # 可指定多个数据目录（例如从几台电脑同步来的 ~/.claude），同名项目合并为一个
+        if isinstance(claude_dir, (list, tuple)):
+            self.claude_dirs = [Path(d) for d in claude_dir]
+        else:
+            self.claude_dirs = [Path(claude_dir) if claude_dir else Path.home() / ".claude"]
+        self.projects_dirs = [d / "projects" for d in self.claude_dirs]
+        self.output_dir = Path(output_dir) if output_dir else Path.home() / "Documents" / "Claude History"
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.jobs = max(1, jobs)
+        self.html_pages = html_pages
+        self.block_cap = block_cap
+        self.branches = branches
+        self.metrics = Metrics(enabled=profile)
+        self.manifest_path = self.output_dir / ".manifest.json"
+        self.index_cache_path = self.output_dir / ".index-cache.json"
+        self.manifest = self.load_manifest()
+        self.manifest_stamp = self.read_manifest_stamp()
+        # 因时间预算推迟到下一次导出的会话文件和输出（见 export_all 的 deadline）
+        self.carry_over = set()
+        self.deferred_outputs = {}
+        self.search_db_path = self.output_dir / "search.db"
+        self.search_index = None
+        self.search_enabled = True
+        # 工作进程中为真：全文索引只暂存，由主进程按任务顺序写入（见 SearchIndex）
+        self.stage_search = False
+        self.stats_path = self.output_dir / ".stats.bin"
+        self.stats = None
+        # 多个数据目录中同一会话的副本归并后的文件，及生成时各副本的状态
+        self.merged_dir = self.output_dir / ".merged"
+        self.merge_state_path = self.merged_dir / ".state.json"
+        self.merge_state = None
+        self.merged_sources = {}
+        self.merge_lock = threading.Lock()
+
+    def __getstate__(self):
+        # 传给子进程时不携带清单和数据库连接，子进程按需自行打开
+        state = self.__dict__.copy()
+        state['manifest'] = None
+        state['merge_lock'] = None
+        state['search_index'] = None
+        state['stats'] = None
+        return state
+
+    def get_search_index(self):
+        """打开全文索引；当前 SQLite 不支持 FTS5 时返回 None"""
+        if self.search_index is None and self.search_enabled:
+            try:
+                self.search_index = SearchIndex(self.search_db_path, staged=self.stage_search)
+            except sqlite3.OperationalError as e:
+                print(f"Search index disabled: {e}")
+                self.search_enabled = False
+        return self.search_index
+
+    def load_manifest(self):
+        """加载增量导出清单"""
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') == MANIFEST_VERSION:
+                manifest.setdefault('files', {})
+                manifest.setdefault('outputs', {})
+                manifest.setdefault('rollups', [])
+                return manifest
+        except (OSError, ValueError):
+            pass
+        return {'version': MANIFEST_VERSION, 'files': {}, 'outputs': {}, 'rollups': []}
+
+    def save_manifest(self):
+        """保存增量导出清单"""
+        self.save_json(self.manifest_path, self.manifest)
+        self.manifest_stamp = self.read_manifest_stamp()
+
+    def read_manifest_stamp(self):
+        """清单文件的 (修改时间, 大小)，用于发现其他进程写入的清单"""
+        try:
+            st = self.manifest_path.stat()
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def reload_if_changed(self):
+        """常驻进程在每次导出前调用：清单被其他进程改写（或删除）时重新加载
+
+        内存中的用量汇总表和推迟的任务都基于旧清单，一并丢弃。返回是否重新加载。
+        """
+        stamp = self.read_manifest_stamp()
+        if stamp == self.manifest_stamp:
+            return False
+        self.manifest = self.load_manifest()
+        self.manifest_stamp = stamp
+        self.stats = None
+        self.carry_over = set()
+        self.deferred_outputs = {}
+        return True
+
+    def save_json(self, path, data):
+        """保存 JSON 文件（先写临时文件再替换，内容未变化时不写）"""
+        write_if_changed(path, json.dumps(data, ensure_ascii=False, indent=1))
+
+    def get_stats(self):
+        """加载用量汇总表；与清单不一致（如上次导出中断）时由清单中各会话的用量重建"""
+        if self.stats is None:
+            stats = UsageStats.load(self.stats_path)
+            generation = self.manifest.get('stats_generation', 0)
+            if stats.generation != generation:
+                stats = UsageStats()
+                for key, entry in self.manifest['files'].items():
+                    stats.apply(Path(key).parent.name, entry.get('usage') or {})
+                stats.prune()
+                stats.generation = generation
+            self.stats = stats
+        return self.stats
+
+    def load_index_cache(self):
+        """加载仅刷新索引页时缓存的会话信息（格式与清单中的会话记录相同）"""
+        try:
+            with open(self.index_cache_path, 'r', encoding='utf-8') as f:
+                cache = json.load(f)
+            if cache.get('version') == MANIFEST_VERSION:
+                return cache['files']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
 
     def get_all_projects(self):
-        """获取所有项目"""
-        if not self.projects_dir.exists():
-            return []
+        """获取所有项目
+
+        多个数据目录中的同名项目合并为一个；同一会话在几个目录中都有时，
+        各副本先归并为 .merged/ 下的一个文件（见 merge_session）。
+        """
+        copies = {}
+        for projects_dir in self.projects_dirs:
+            if not projects_dir.exists():
+                continue
+            for project_dir in projects_dir.iterdir():
+                if project_dir.is_dir():
+                    # 查找 JSONL 文件
+                    for jsonl_file in project_dir.glob("*.jsonl"):
+                        project = copies.setdefault(project_dir.name, {'path': project_dir, 'sessions': {}})
+                        project['sessions'].setdefault(jsonl_file.stem, []).append(jsonl_file)
 
+        if len(self.projects_dirs) > 1:
+            with self.merge_lock:
+                return self.merge_projects(copies)
+        return [{'name': name, 'path': project['path'],
+                 'conversations': [files[0] for files in project['sessions'].values()]}
+                for name, project in copies.items()]
+
+    def merge_projects(self, copies):
+        """归并有多个副本的会话，删除已不再需要的归并文件，返回项目列表"""
+        if self.merge_state is None:
+            self.merge_state = self.load_merge_state()
+        state = self.merge_state
+        merged_sources = {}
         projects = []
-        for project_dir in self.projects_dir.iterdir():
-            if project_dir.is_dir():
-                # 查找 JSONL 文件
-                jsonl_files = list(project_dir.glob("*.jsonl"))
-                if jsonl_files:
-                    projects.append({
-                        'name': project_dir.name,
-                        'path': project_dir,
-                        'conversations': jsonl_files
-                    })
+        for name, project in copies.items():
+            conversations = []
+            for files in project['sessions'].values():
+                if len(files) == 1:
+                    conversations.append(files[0])
+                    continue
+                target = self.merge_session(name, files)
+                merged_sources.update((str(f), str(target)) for f in files)
+                conversations.append(target)
+            projects.append({'name': name, 'path': project['path'], 'conversations': conversations})
+
+        targets = set(merged_sources.values())
+        for key in [key for key in state if key not in targets]:
+            Path(key).unlink(missing_ok=True)
+            del state[key]
+        self.merged_sources = merged_sources
+        self.save_json(self.merge_state_path, {'version': MANIFEST_VERSION, 'files': state})
         return projects
 
-    def parse_conversation(self, jsonl_path):
-        """解析单个对话历史"""
-        conversations = []
+    def merge_session(self, project_name, files):
+        """将同一会话的多个副本按时间归并、按 uuid 去重，返回归并后的文件
 
+        各副本的大小和修改时间与上次归并时相同则直接使用已有的文件；
+        只有副本末尾增加了记录时，归并文件也只在末尾追加，会话仍可增量解析。
+        """
+        safe_name = project_name.replace('/', '_').replace('\\', '_')
+        target = self.merged_dir / safe_name / files[0].name
+        sources = []
+        for jsonl_file in files:
+            st = jsonl_file.stat()
+            sources.append([str(jsonl_file), st.st_ino, st.st_size, st.st_mtime])
+        if self.merge_state.get(str(target)) == sources and target.exists():
+            return target
+        status, duplicates = merge_files(files, target)
+        self.merge_state[str(target)] = sources
+        self.metrics.count('sessions_merged')
+        self.metrics.count('merged_duplicates', duplicates)
+        if status == 'rewritten':
+            self.metrics.count('merged_rewritten')
+        return target
+
+    def load_merge_state(self):
+        """加载各归并文件生成时副本的状态"""
         try:
-            with open(jsonl_path, 'r', encoding='utf-8') as f:
-                for line in f:
-                    try:
-                        data = json.loads(line)
-                        if data.get('type') == 'user':
-                            message = data.get('message', {})
-                            content_list = message.get('content', [])
-                            text = ''
-                            for item in content_list:
-                                if item.get('type') == 'text':
-                                    text = item.get('text', '')
-
-                            if text:
-                                conversations.append({
-                                    'role': 'user',
-                                    'content': text,
-                                    'timestamp': data.get('timestamp', '')
-                                })
-
-                        elif data.get('type') == 'assistant':
-                            message = data.get('message', {})
-                            content_list = message.get('content', [])
-                            text = ''
-                            for item in content_list:
-                                if item.get('type') == 'text':
-                                    text = item.get('text', '')
-
-                            if text:
-                                conversations.append({
-                                    'role': 'assistant',
-                                    'content': text,
-                                    'timestamp': data.get('timestamp', '')
-                                })
-                    except json.JSONDecodeError:
-                        continue
-        except Exception as e:
-            print(f"Error parsing {jsonl_path}: {e}")
+            with open(self.merge_state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            if state.get('version') == MANIFEST_VERSION:
+                return state['files']
+        except (OSError, ValueError, KeyError):
+            pass
+        return {}
+
+    def find_session_file(self, project_name, session):
+        """按项目和会话 id 查找会话文件：有归并文件时用它，否则取第一个包含该会话的数据目录"""
+        safe_name = project_name.replace('/', '_').replace('\\', '_')
+        merged = self.merged_dir / safe_name / f"{session}.jsonl"
+        if len(self.projects_dirs) > 1 and merged.is_file():
+            return merged
+        for projects_dir in self.projects_dirs:
+            path = projects_dir / project_name / f"{session}.jsonl"
+            if path.is_file():
+                return path
+        return None
+
+    def parse_conversation(self, jsonl_path, start_offset=0):
+        """解析单个对话历史
+
+        从 start_offset 字节处开始读取，返回 (消息列表, 已解析到的字节偏移)。
+        未写完的最后一行不会被消费，下次从返回的偏移继续。
+        """
+        # 重复的大段正文共享同一个字符串
+        stream = self.iter_session(jsonl_path, start_offset, interner=BlockInterner(keep_strings=True))
+        conversations = list(stream)
+        return conversations, stream.offset
+
+    def iter_session(self, jsonl_file, start_offset=0, end_offset=None, project=None, **kwargs):
+        """读取会话中的全部内容块；所有统计和渲染都经这里读取，消息序号保持一致
+
+        指定 project 时超出字节上限的内容块另存到该项目的 spill 目录，否则只保留开头。
+        """
+        spill = self.spill_writer(project['name']) if project else None
+        return iter_messages(jsonl_file, start_offset, end_offset, blocks=True,
+                             block_cap=self.block_cap, spill=spill, **kwargs)
+
+    def read_session(self, jsonl_file, entry, start_offset, project, interner):
+        """读取会话中 start_offset 之后、清单记录的位置之前的消息，用于渲染
+
+        消息存储与清单记录一致时直接从存储读取，否则（例如存储被删除）解析 JSONL。
+        """
+        store = MessageStore.open(self.store_path(jsonl_file))
+        if store and store.offset == entry['offset'] and len(store) == entry['count'] \
+                and store.block_cap == self.block_cap:
+            self.metrics.count('store_reads')
+            return self.iter_store(store, start_offset, interner)
+        if store:
+            store.close()
+        return self.iter_session(jsonl_file, start_offset, entry['offset'], project, interner=interner)
+
+    def iter_store(self, store, start_offset, interner):
+        with store:
+            yield from store.messages(store.index_after(start_offset), interner=interner)
+
+    def store_path(self, jsonl_file):
+        """会话消息存储的路径前缀（见 history_store）"""
+        safe_name = jsonl_file.parent.name.replace('/', '_').replace('\\', '_')
+        return self.output_dir / ".store" / safe_name / jsonl_file.stem
+
+    def thread_path(self, jsonl_file):
+        """会话对话树的路径（见 history_thread）"""
+        base = self.store_path(jsonl_file)
+        return base.with_name(base.name + '.thread')
+
+    def thread_view(self, jsonl_file, offset=None):
+        """读取会话的对话树视图；没有对话树、会话文件已被替换，或对话树不是建立到 offset 处时返回 None"""
+        thread, head = ThreadIndex.load(self.thread_path(jsonl_file), resumable=False)
+        if thread is None or (offset is not None and thread.offset != offset):
+            return None
+        try:
+            if self.read_head_fingerprint(jsonl_file, thread.offset) != head:
+                return None
+        except OSError:
+            return None
+        return thread.view()
+
+    def hidden_messages(self, jsonl_file, entry=None):
+        """未采用分支中的消息 {序号: 分出处的消息序号}，渲染时据此跳过或注明"""
+        view = self.thread_view(jsonl_file, entry['offset'] if entry else None)
+        return view.hidden if view else {}
+
+    def show_message(self, i, conv, hidden):
+        """第 i 条消息是否显示；属于未采用的分支时按 branches 跳过或注明分出处
+
+        引用的首次出现处不显示时，重复的正文完整写出。
+        """
+        if not hidden:
+            return True
+        fork = hidden.get(i)
+        if fork is not None:
+            if self.branches == 'active':
+                return False
+            conv.branch_of = fork
+        elif self.branches == 'active' and conv.repeat_of in hidden:
+            conv.repeat_of = None
+        return True
+
+    def continued_link(self, entry, output_path, from_path):
+        """该会话接续的会话 (名称, 从 from_path 出发的相对链接)；output_path 给出会话输出相对输出目录的路径"""
+        source = entry.get('continued_from')
+        if not source:
+            return None
+        source = Path(source)
+        target = self.output_dir / output_path(source.parent.name, source.stem)
+        return source.stem, Path(os.path.relpath(target, from_path.parent)).as_posix()
+
+    def link_continued_sessions(self, files, keys):
+        """为 keys 中新发现接续关系的会话找出被接续的会话，记入 continued_from
+
+        先与各会话当前分支的最后一条记录比较（通常接在那里），找不到时再逐个查对话树；
+        没有找到的记为空，直到接续的 uuid 改变时才重新查找。
+        """
+        wanted = {}
+        for key in keys:
+            entry = files[key]
+            if entry.get('continues') and 'continued_from' not in entry:
+                wanted.setdefault(uuid_hash(entry['continues']), []).append(key)
+        if not wanted:
+            return
+        found = {}
+        for key, entry in files.items():
+            if entry.get('leaf') in wanted:
+                found.setdefault(entry['leaf'], key)
+        missing = set(wanted) - set(found)
+        if missing:
+            for key in files:
+                thread, _ = ThreadIndex.load(self.thread_path(Path(key)), resumable=False)
+                if thread is None:
+                    continue
+                for h in [h for h in missing if thread.contains(h)]:
+                    found[h] = key
+                    missing.discard(h)
+                if not missing:
+                    break
+        for h, sessions in wanted.items():
+            for key in sessions:
+                source = found.get(h, '')
+                files[key]['continued_from'] = source if source != key else ''
+                self.metrics.count('sessions_linked' if files[key]['continued_from'] else 'sessions_unlinked')
+
+    def update_search_hidden(self, entries):
+        """按各会话的对话树把未采用分支中的消息移出全文索引，检索结果与导出的会话一致
 
-        return conversations
+        只处理对话树变化或有新消息写入索引的会话；branches 为 all 时这些消息照常显示，不排除。
+        """
+        index = self.search_index
+        for key, digest in index.hidden_digests().items():
+            entry = entries.get(key)
+            if not entry or not entry.get('hidden'):
+                continue
+            target = entry['hidden'] if self.branches == 'active' else ''
+            if digest == target:
+                continue
+            if not target:
+                index.set_hidden(key, (), target)
+                continue
+            view = self.thread_view(Path(key), entry['offset'])
+            if view is not None:
+                index.set_hidden(key, view.hidden, target)
+
+    def spill_writer(self, project_name):
+        """返回把超长内容块按内容哈希压缩另存的函数，其返回值为 spill 目录中的文件名"""
+        safe_name = project_name.replace('/', '_').replace('\\', '_')
+        spill_dir = self.output_dir / "sessions" / safe_name / "spill"
+
+        def spill(data):
+            name = hashlib.sha1(data).hexdigest()[:20] + ".txt.gz"
+            path = spill_dir / name
+            if not path.exists():
+                spill_dir.mkdir(parents=True, exist_ok=True)
+                # mtime=0 使压缩结果只取决于内容
+                if write_if_changed(path, gzip.compress(data, 6, mtime=0)):
+                    self.metrics.count('spill_files')
+            return name
+
+        return spill
 
     def format_timestamp(self, iso_timestamp):
         """格式化时间戳"""
@@ -96,36 +448,502 @@ class ClaudeHistoryManager:
 
         # 获取第一条用户消息作为摘要
         for conv in conversations:
-            if conv['role'] == 'user' and conv['content']:
-                summary = conv['content'][:100]
-                if len(conv['content']) > 100:
+            if conv.role == 'user' and conv.content:
+                summary = conv.content[:100]
+                if len(conv.content) > 100:
                     summary += "..."
                 return summary
 
         return "No content"
 
-    def generate_project_markdown(self, project, conversations):
-        """为单个项目生成 Markdown"""
+    def generate_markdown_header(self, project, session, count, hidden=None, continued=None):
+        """生成会话 Markdown 的表头
+
+        hidden 为未采用分支中的消息（见 hidden_messages），continued 为接续的会话 (名称, 相对链接)。
+        """
         md = f"# {project['name']}\n\n"
-        md += f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-        md += f"对话数量: {len(conversations)} 条\n\n"
-        md += "---\n\n"
+        md += f"会话: {session}\n\n"
+        if continued:
+            md += f"接续自: [{continued[0]}]({continued[1]})\n\n"
+        md += f"对话数量: {count} 条"
+        if hidden and self.branches == 'active':
+            md += f"（其中 {len(hidden)} 条在未采用的分支中，未显示）"
+        md += "\n\n---\n\n"
+        return md
 
-        for i, conv in enumerate(conversations, 1):
-            if not conv['content']:
-                continue
+    def branch_note(self, conv):
+        """未采用分支中的消息标题下的说明"""
+        if conv.branch_of:
+            return f"↩️ 未采用的分支（自第 {conv.branch_of} 条消息后分出）"
+        return "↩️ 未采用的分支（自会话开头分出）"
+
+    def message_label(self, conv):
+        """消息标题中的角色；只含工具结果的用户记录显示为工具结果"""
+        if conv.role != 'user':
+            return "🤖 Claude"
+        if not conv.content and conv.blocks and all(b.type == 'tool_result' for b in conv.blocks):
+            return "📤 工具结果"
+        return "👤 用户"
+
+    def write_message_markdown(self, f, i, conv, spill_dir='spill'):
+        """将单条消息写入 Markdown 文件；重复的大段正文只写对首次出现的折叠引用
+
+        spill_dir 为超长内容另存目录相对该 Markdown 文件的路径。
+        """
+        role = self.message_label(conv)
+        timestamp = self.format_timestamp(conv.timestamp) if conv.timestamp else ''
+
+        if conv.repeat_of is None and len(conv.content) >= INTERN_MIN_SIZE:
+            # 之后可能被引用的消息加上锚点
+            f.write(f'<a id="m{i}"></a>\n\n')
+        f.write(f"## {i}. {role}\n\n")
+        if conv.branch_of is not None:
+            f.write(f"> {self.branch_note(conv)}\n\n")
+        if timestamp:
+            f.write(f"*{timestamp}*\n\n")
+        if conv.blocks is None:
+            self.write_text_markdown(f, conv)
+        else:
+            separator = ''
+            text_written = False
+            for block in conv.blocks:
+                if block.type == 'text':
+                    # 正文重复时所有文本块合并为一处引用
+                    if text_written:
+                        continue
+                    f.write(separator)
+                    text_written = conv.repeat_of is not None
+                    if text_written:
+                        self.write_text_markdown(f, conv)
+                    else:
+                        f.write(block.text)
+                else:
+                    f.write(separator)
+                    self.write_block_markdown(f, block, spill_dir)
+                separator = "\n\n"
+        f.write("\n\n---\n\n")
+
+    def write_text_markdown(self, f, conv):
+        """写出消息正文，重复的正文写为折叠引用"""
+        if conv.repeat_of is None:
+            f.write(conv.content)
+            return
+        first = conv.repeat_of
+        f.write(f"<details>\n<summary>🔁 与第 {first} 条消息内容相同（{self.format_size(conv.content)}），已折叠</summary>\n\n")
+        f.write(f"[跳转到第 {first} 条消息](#m{first})\n\n")
+        f.write(f"> {self.get_repeat_preview(conv.content)}\n\n</details>")
+
+    def write_block_markdown(self, f, block, spill_dir='spill'):
+        """写出工具调用、工具结果、思考过程或图片块"""
+        if block.type == 'image':
+            f.write(f"🖼️ *图片（{block.title or 'image'}）*")
+            return
+        fence = self.code_fence(block.text)
+        if block.type == 'tool_use':
+            f.write(f"**🔧 调用工具 {block.title}**\n\n{fence}json\n{block.text}\n{fence}")
+            f.write(self.block_note_markdown(block, spill_dir))
+            return
+        if block.type == 'thinking':
+            f.write("<details>\n<summary>💭 思考过程</summary>\n\n")
+            f.write(block.text)
+        else:
+            error = " ⚠️ 出错" if block.error else ""
+            f.write(f"<details>\n<summary>📤 工具结果（{self.format_bytes(block.size)}）{error}</summary>\n\n")
+            f.write(f"{fence}\n{block.text}\n{fence}")
+        f.write(self.block_note_markdown(block, spill_dir))
+        f.write("\n\n</details>")
+
+    def block_note_markdown(self, block, spill_dir='spill'):
+        """超出字节上限的内容块附上说明和完整内容的链接"""
+        if block.size <= self.block_cap:
+            return ""
+        note = f"\n\n*内容过长，仅显示前 {self.format_bytes(self.block_cap)}，共 {self.format_bytes(block.size)}"
+        if block.spill:
+            note += f"；[完整内容（gzip）]({spill_dir}/{block.spill})"
+        return note + "*"
+
+    def code_fence(self, text):
+        """比内容中最长的连续反引号多一个的代码块围栏"""
+        longest = max((len(run) for run in re.findall(r'`{3,}', text)), default=2)
+        return '`' * (longest + 1)
+
+    def format_size(self, content):
+        """正文的 UTF-8 大小，如 12.3 KB"""
+        return self.format_bytes(len(content.encode('utf-8')))
+
+    def format_bytes(self, size):
+        """字节数格式化为 KB 或 MB"""
+        if size >= 1024 * 1024:
+            return f"{size / 1024 / 1024:.1f} MB"
+        return f"{size / 1024:.1f} KB"
 
-            role = "👤 用户" if conv['role'] == 'user' else "🤖 Claude"
-            timestamp = self.format_timestamp(conv['timestamp']) if conv['timestamp'] else ''
+    def get_repeat_preview(self, content):
+        """重复正文折叠后显示的开头"""
+        preview = ' '.join(content[:300].split())
+        return preview[:200] + "…"
 
-            md += f"## {i}. {role}\n\n"
-            if timestamp:
-                md += f"*{timestamp}*\n\n"
-            md += f"{conv['content']}\n\n"
-            md += "---\n\n"
+    def render_session_markdown(self, md_path, project, session, count, conversations, hidden=None,
+                                continued=None):
+        """将会话 Markdown 流式写入文件，内存占用只取决于单条消息大小"""
+        written = 0
+        out = AtomicFile(md_path)
+        with out as f:
+            f.write(self.generate_markdown_header(project, session, count, hidden, continued))
+            for i, conv in enumerate(conversations, 1):
+                if self.show_message(i, conv, hidden):
+                    self.write_message_markdown(f, i, conv)
+                written = i
+        self.count_written(out)
+        return written
 
+    def append_session_markdown(self, md_path, project, session, total, new_conversations, start_index,
+                                hidden=None, continued=None):
+        """向已有 Markdown 追加新消息，并更新表头中的对话数量"""
+        out = AtomicFile(md_path)
+        with open(md_path, 'r', encoding='utf-8') as src, out as dst:
+            # 跳过旧表头（到第一条分隔线为止）
+            while True:
+                line = src.readline()
+                if not line or line == '---\n':
+                    break
+            src.readline()
+
+            dst.write(self.generate_markdown_header(project, session, total, hidden, continued))
+            shutil.copyfileobj(src, dst, STREAM_BUFFER_SIZE)
+            for i, conv in enumerate(new_conversations, start_index):
+                if self.show_message(i, conv, hidden):
+                    self.write_message_markdown(dst, i, conv)
+        self.count_written(out)
+
+    def generate_project_rollup(self, project, sessions):
+        """生成项目汇总 Markdown：列出各会话的消息数、最后更新时间和开头，链接到会话分片"""
+        total = sum(entry['count'] for _, entry in sessions)
+        last_timestamp = max(entry['last_timestamp'] for _, entry in sessions)
+        md = f"# {project['name']}\n\n"
+        md += f"会话数量: {len(sessions)} 个\n\n"
+        md += f"对话数量: {total} 条\n\n"
+        if last_timestamp:
+            md += f"最后更新: {self.format_timestamp(last_timestamp)}\n\n"
+        md += "---\n\n"
+        md += "| 会话 | 对话数 | 最后更新 | 开头 |\n"
+        md += "| --- | --- | --- | --- |\n"
+        for jsonl_file, entry in sessions:
+            session = jsonl_file.stem
+            link = self.session_markdown_path(project['name'], session)
+            last_time = self.format_timestamp(entry['last_timestamp']) if entry['last_timestamp'] else ''
+            summary = ' '.join((entry['summary'] or "No content").split()).replace('|', '\\|')
+            md += f"| [{session}]({link}) | {entry['count']} | {last_time} | {summary} |\n"
         return md
 
+    def write_project_rollup(self, project, sessions):
+        """写出项目汇总 Markdown，内容未变化时不重写文件；返回其相对输出目录的路径"""
+        safe_name = project['name'].replace('/', '_').replace('\\', '_')
+        rollup_key = f"{safe_name}.md"
+        if write_if_changed(self.output_dir / rollup_key, self.generate_project_rollup(project, sessions)):
+            self.metrics.count('files_written')
+        return rollup_key
+
+    def generate_session_html_head(self, title):
+        """生成会话分页 HTML 的页头（样式与 index.html 一致）"""
+        return f"""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+    <meta charset="UTF-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1.0">
+    <title>{escape(title)}</title>
+    <style>
+        * {{
+            margin: 0;
+            padding: 0;
+            box-sizing: border-box;
+        }}
+        body {{
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Arial, sans-serif;
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            min-height: 100vh;
+            padding: 40px 20px;
+        }}
+        .container {{
+            max-width: 960px;
+            margin: 0 auto;
+        }}
+        header {{
+            color: white;
+            margin-bottom: 20px;
+        }}
+        header h1 {{
+            font-size: 1.8em;
+            margin-bottom: 5px;
+            word-break: break-word;
+        }}
+        header p {{
+            opacity: 0.9;
+        }}
+        .nav {{
+            display: flex;
+            justify-content: space-between;
+            margin: 20px 0;
+        }}
+        .nav a, .nav span {{
+            background: rgba(255, 255, 255, 0.2);
+            color: white;
+            padding: 8px 20px;
+            border-radius: 20px;
+            text-decoration: none;
+        }}
+        .nav span {{
+            opacity: 0.4;
+        }}
+        .message, .toc {{
+            background: white;
+            border-radius: 15px;
+            padding: 20px 25px;
+            margin-bottom: 15px;
+            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
+        }}
+        .message.user {{
+            border-left: 5px solid #667eea;
+        }}
+        .message.assistant {{
+            border-left: 5px solid #764ba2;
+        }}
+        .message h3 {{
+            font-size: 1em;
+            color: #333;
+        }}
+        .message-time {{
+            font-size: 0.85em;
+            color: #999;
+            margin-bottom: 10px;
+        }}
+        .message-branch {{
+            font-size: 0.85em;
+            color: #b9770e;
+            margin-bottom: 6px;
+        }}
+        .message.branch {{
+            opacity: 0.75;
+        }}
+        .message-content {{
+            color: #333;
+            line-height: 1.6;
+            white-space: pre-wrap;
+            word-break: break-word;
+        }}
+        .message-repeat summary {{
+            color: #888;
+            cursor: pointer;
+            margin-bottom: 8px;
+        }}
+        .message-repeat summary a {{
+            color: #667eea;
+        }}
+        .message-repeat .message-content {{
+            color: #999;
+        }}
+        .block {{
+            margin: 10px 0;
+        }}
+        .block summary, .block-title {{
+            color: #764ba2;
+            font-weight: 600;
+            cursor: pointer;
+        }}
+        .block pre {{
+            background: #f7f7fb;
+            border-radius: 8px;
+            padding: 10px 12px;
+            margin-top: 6px;
+            font-size: 0.85em;
+            white-space: pre-wrap;
+            word-break: break-word;
+            max-height: 600px;
+            overflow: auto;
+        }}
+        .block.error summary {{
+            color: #c0392b;
+        }}
+        .block-note {{
+            font-size: 0.85em;
+            color: #888;
+            margin-top: 4px;
+        }}
+        .block-note a {{
+            color: #667eea;
+        }}
+        .toc table {{
+            width: 100%;
+            border-collapse: collapse;
+        }}
+        .toc th, .toc td {{
+            text-align: left;
+            padding: 10px;
+            border-bottom: 1px solid #eee;
+            vertical-align: top;
+        }}
+        .toc td a {{
+            color: #667eea;
+            font-weight: 600;
+            white-space: nowrap;
+        }}
+        .toc .summary {{
+            color: #555;
+            word-break: break-word;
+        }}
+    </style>
+</head>
+<body>
+    <div class="container">
+"""
+
+    def generate_session_html_tail(self):
+        """生成会话分页 HTML 的页尾，左右方向键翻页"""
+        return """    </div>
+    <script>
+        document.addEventListener('keydown', (e) => {
+            const rel = {ArrowLeft: 'prev', ArrowRight: 'next'}[e.key];
+            const link = rel && document.querySelector('.nav a[rel="' + rel + '"]');
+            if (link) {
+                location.href = link.href;
+            }
+        });
+    </script>
+</body>
+</html>
+"""
+
+    def generate_session_page_nav(self, page, has_next):
+        """生成分页导航：上一页 / 目录 / 下一页"""
+        prev_link = f'<a rel="prev" href="page-{page - 1}.html">« 上一页</a>' if page > 1 else '<span>« 上一页</span>'
+        next_link = f'<a rel="next" href="page-{page + 1}.html">下一页 »</a>' if has_next else '<span>下一页 »</span>'
+        return f'<div class="nav">{prev_link}<a href="index.html">目录</a>{next_link}</div>\n'
+
+    def write_message_html(self, f, i, conv):
+        """将单条消息写入分页 HTML，id 为 m{序号} 便于直接定位"""
+        role = self.message_label(conv)
+        timestamp = self.format_timestamp(conv.timestamp) if conv.timestamp else ''
+
+        css = "message branch" if conv.branch_of is not None else "message"
+        f.write(f'<div class="{css} {escape(conv.role)}" id="m{i}">\n')
+        f.write(f'<h3>{i}. {role}</h3>\n')
+        if conv.branch_of is not None:
+            f.write(f'<div class="message-branch">{escape(self.branch_note(conv))}</div>\n')
+        if timestamp:
+            f.write(f'<div class="message-time">{escape(timestamp)}</div>\n')
+        if conv.blocks is None:
+            self.write_text_html(f, conv)
+        else:
+            text_written = False
+            for block in conv.blocks:
+                if block.type == 'text':
+                    if text_written:
+                        continue
+                    text_written = conv.repeat_of is not None
+                    if text_written:
+                        self.write_text_html(f, conv)
+                    else:
+                        f.write(f'<div class="message-content">{escape(block.text, quote=False)}</div>\n')
+                else:
+                    self.write_block_html(f, block)
+        f.write('</div>\n')
+
+    def write_text_html(self, f, conv):
+        """写出消息正文；重复的大段正文只输出指向首次出现处的折叠引用"""
+        if conv.repeat_of is None:
+            f.write('<div class="message-content">')
+            f.write(escape(conv.content, quote=False))
+            f.write('</div>\n')
+            return
+        first = conv.repeat_of
+        page = (first - 1) // SESSION_PAGE_SIZE + 1
+        f.write(f'<details class="message-repeat"><summary>🔁 与<a href="page-{page}.html#m{first}">第 {first} 条消息</a>'
+                f'内容相同（{self.format_size(conv.content)}），已折叠</summary>')
+        f.write(f'<div class="message-content">{escape(self.get_repeat_preview(conv.content), quote=False)}</div>')
+        f.write('</details>\n')
+
+    def write_block_html(self, f, block):
+        """写出工具调用、工具结果、思考过程或图片块"""
+        if block.type == 'image':
+            f.write(f'<div class="block image">🖼️ 图片（{escape(block.title or "image")}）</div>\n')
+            return
+        text = escape(block.text, quote=False)
+        note = ""
+        if block.size > self.block_cap:
+            note = (f'<div class="block-note">内容过长，仅显示前 {self.format_bytes(self.block_cap)}，'
+                    f'共 {self.format_bytes(block.size)}')
+            if block.spill:
+                note += f' · <a href="../spill/{escape(block.spill)}">完整内容（gzip）</a>'
+            note += '</div>'
+        if block.type == 'tool_use':
+            f.write(f'<div class="block tool-use"><div class="block-title">🔧 调用工具 {escape(block.title)}</div>'
+                    f'<pre>{text}</pre>{note}</div>\n')
+        elif block.type == 'thinking':
+            f.write(f'<details class="block thinking"><summary>💭 思考过程</summary>'
+                    f'<div class="message-content">{text}</div>{note}</details>\n')
+        else:
+            error = " ⚠️ 出错" if block.error else ""
+            css = "block tool-result error" if block.error else "block tool-result"
+            f.write(f'<details class="{css}"><summary>📤 工具结果（{self.format_bytes(block.size)}）{error}</summary>'
+                    f'<pre>{text}</pre>{note}</details>\n')
+
+    def render_session_page(self, session_dir, project, session, page, start_index, conversations, has_next,
+                            hidden=None):
+        """写出会话的一页 HTML"""
+        out = AtomicFile(session_dir / f"page-{page}.html")
+        with out as f:
+            self.write_session_page_html(f, project, session, page, start_index, conversations, has_next, hidden)
+        self.count_written(out)
+
+    def write_session_page_html(self, f, project, session, page, start_index, conversations, has_next,
+                                hidden=None):
+        """将会话的一页 HTML 写入文件对象；页按消息序号划分，未采用分支中的消息不显示时该页消息少于每页条数"""
+        display_name = self.clean_project_name(project['name'])
+        nav = self.generate_session_page_nav(page, has_next)
+        f.write(self.generate_session_html_head(f"{display_name} - 第 {page} 页"))
+        f.write(f'<header><h1>{escape(display_name)}</h1>'
+                f'<p>会话 {escape(session)} · 第 {page} 页</p></header>\n')
+        f.write(nav)
+        for i, conv in enumerate(conversations, start_index):
+            if self.show_message(i, conv, hidden):
+                self.write_message_html(f, i, conv)
+        f.write(nav)
+        f.write(self.generate_session_html_tail())
+
+    def render_session_toc(self, session_dir, project, session, pages, count, continued=None):
+        """写出会话目录页"""
+        out = AtomicFile(session_dir / "index.html")
+        with out as f:
+            self.write_session_toc_html(f, project, session, pages, count, continued)
+        self.count_written(out)
+
+    def write_session_toc_html(self, f, project, session, pages, count, continued=None):
+        """将会话目录页写入文件对象：每页的消息范围、起始时间和第一条用户消息
+
+        continued 为接续的会话 (名称, 相对链接)。
+        """
+        display_name = self.clean_project_name(project['name'])
+        rows = ""
+        for page, (_, first_timestamp, summary) in enumerate(pages, 1):
+            first = (page - 1) * SESSION_PAGE_SIZE + 1
+            last = min(page * SESSION_PAGE_SIZE, count)
+            timestamp = self.format_timestamp(first_timestamp) if first_timestamp else ''
+            rows += (f'<tr><td><a href="page-{page}.html">第 {page} 页</a></td>'
+                     f'<td>{first} - {last}</td><td>{escape(timestamp)}</td>'
+                     f'<td class="summary">{escape(summary)}</td></tr>\n')
+
+        f.write(self.generate_session_html_head(f"{display_name} - {session}"))
+        f.write(f'<header><h1>{escape(display_name)}</h1>'
+                f'<p>会话 {escape(session)} · {count} 条对话 · {len(pages)} 页</p></header>\n')
+        f.write('<div class="nav"><a href="../../../index.html">« 返回索引</a>')
+        if continued:
+            f.write(f'<a href="{escape(continued[1])}">接续自 {escape(continued[0])}</a>')
+        f.write('</div>\n')
+        f.write('<div class="toc"><table>\n'
+                '<tr><th>页码</th><th>消息</th><th>时间</th><th>内容</th></tr>\n')
+        f.write(rows)
+        f.write('</table></div>\n')
+        f.write(self.generate_session_html_tail())
+
     def generate_index_html(self, projects_info):
         """生成索引 HTML"""
         html = """<!DOCTYPE html>
@@ -189,6 +1007,28 @@ class ClaudeHistoryManager:
             grid-template-columns: repeat(auto-fill, minmax(350px, 1fr));
             gap: 20px;
         }
+        .projects-viewport {
+            position: relative;
+        }
+        .projects-viewport .projects-grid {
+            position: absolute;
+            top: 0;
+            left: 0;
+            right: 0;
+        }
+        .sessions-toolbar {
+            display: flex;
+            justify-content: space-between;
+            align-items: center;
+            color: white;
+            margin-bottom: 15px;
+        }
+        .sessions-toolbar select {
+            padding: 6px 10px;
+            border-radius: 8px;
+            border: none;
+            font-size: 0.95em;
+        }
         .project-card {
             background: white;
             border-radius: 15px;
@@ -196,6 +1036,11 @@ class ClaudeHistoryManager:
             box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
             transition: transform 0.3s, box-shadow 0.3s;
             cursor: pointer;
+            /* 固定高度，滚动时按行号直接算出位置 */
+            height: 230px;
+            display: flex;
+            flex-direction: column;
+            overflow: hidden;
         }
         .project-card:hover {
             transform: translateY(-5px);
@@ -218,6 +1063,10 @@ class ClaudeHistoryManager:
             color: #333;
             margin-bottom: 5px;
             word-break: break-word;
+            display: -webkit-box;
+            -webkit-line-clamp: 2;
+            -webkit-box-orient: vertical;
+            overflow: hidden;
         }
         .project-date {
             font-size: 0.9em;
@@ -228,6 +1077,12 @@ class ClaudeHistoryManager:
             line-height: 1.6;
             margin-bottom: 15px;
             font-size: 0.95em;
+            flex: 1;
+            display: -webkit-box;
+            -webkit-line-clamp: 2;
+            -webkit-box-orient: vertical;
+            overflow: hidden;
+            word-break: break-word;
         }
         .project-footer {
             display: flex;
@@ -274,6 +1129,88 @@ class ClaudeHistoryManager:
         .search-box input:focus {
             border-color: #667eea;
         }
+        .search-results {
+            background: white;
+            border-radius: 10px;
+            margin-bottom: 30px;
+            box-shadow: 0 5px 20px rgba(0, 0, 0, 0.1);
+            display: none;
+        }
+        .search-results h4 {
+            padding: 15px 20px;
+            color: #667eea;
+            border-bottom: 1px solid #eee;
+        }
+        .search-hit {
+            display: block;
+            padding: 12px 20px;
+            border-bottom: 1px solid #f3f3f3;
+            color: #333;
+            text-decoration: none;
+        }
+        .search-hit:hover {
+            background: #f7f7ff;
+        }
+        .search-hit-meta {
+            font-size: 0.85em;
+            color: #888;
+            margin-bottom: 4px;
+        }
+        .search-hit-text {
+            font-size: 0.95em;
+            line-height: 1.5;
+        }
+        .usage {
+            background: white;
+            border-radius: 15px;
+            padding: 25px;
+            margin-bottom: 30px;
+            box-shadow: 0 10px 30px rgba(0, 0, 0, 0.2);
+        }
+        .usage h2 {
+            color: #333;
+            margin-bottom: 15px;
+        }
+        .usage h4 {
+            color: #667eea;
+            margin: 15px 0 8px;
+        }
+        .usage-chart svg {
+            width: 100%;
+            height: 120px;
+            display: block;
+        }
+        .usage-chart rect {
+            fill: #667eea;
+        }
+        .usage-chart rect:hover {
+            fill: #764ba2;
+        }
+        .usage-axis {
+            display: flex;
+            justify-content: space-between;
+            font-size: 0.8em;
+            color: #888;
+        }
+        .usage-tables {
+            display: grid;
+            grid-template-columns: repeat(auto-fit, minmax(400px, 1fr));
+            gap: 20px;
+        }
+        .usage-table {
+            width: 100%;
+            border-collapse: collapse;
+            font-size: 0.9em;
+        }
+        .usage-table th, .usage-table td {
+            padding: 6px 8px;
+            border-bottom: 1px solid #eee;
+            text-align: right;
+        }
+        .usage-table th:first-child, .usage-table td:first-child {
+            text-align: left;
+            word-break: break-word;
+        }
         .empty-state {
             text-align: center;
             color: white;
@@ -301,74 +1238,366 @@ class ClaudeHistoryManager:
                 <h3>__TOTAL_CONVERSATIONS__</h3>
                 <p>对话总数</p>
             </div>
+            <div class="stat-card">
+                <h3>__TOTAL_TOKENS__</h3>
+                <p>Token 用量</p>
+            </div>
         </div>
 
+        __USAGE_HTML__
+
         <div class="search-box">
             <input type="text" id="searchInput" placeholder="🔍 搜索项目或对话内容...">
         </div>
 
-        <div class="projects-grid" id="projectsGrid">
-            __PROJECTS_HTML__
+        <div class="search-results" id="searchResults"></div>
+
+        <div class="sessions-toolbar">
+            <span id="sessionCount"></span>
+            <select id="sortSelect">
+                <option value="recent">按最近更新</option>
+                <option value="count">按对话数量</option>
+                <option value="project">按项目</option>
+            </select>
+        </div>
+
+        <div class="projects-viewport" id="projectsViewport">
+            <div class="projects-grid" id="projectsGrid"></div>
         </div>
+        __EMPTY_HTML__
     </div>
 
+    <script type="application/json" id="sessionData">__SESSION_DATA__</script>
     <script>
-        // 搜索功能
+        // 会话卡片：数据以 JSON 内嵌，每项为 [项目序号, 对话数, 最后更新, 摘要, 链接]，
+        // 只渲染可见的几行卡片，会话再多页面也只有几十个卡片元素
+        const CARD_HEIGHT = 230, CARD_GAP = 20, CARD_MIN_WIDTH = 350, OVERSCAN_ROWS = 2;
+        const sessionData = JSON.parse(document.getElementById('sessionData').textContent);
+        const sessions = sessionData.sessions;
+        // 筛选用的文本预先转为小写，输入时只需逐项 includes
+        const haystacks = sessions.map(s => (sessionData.projects[s[0]] + '\\n' + s[3] + '\\n' + s[2]).toLowerCase());
+        const viewport = document.getElementById('projectsViewport');
+        const grid = document.getElementById('projectsGrid');
+        const gridState = { order: [], view: [], query: '', columns: 1, rows: 0, first: -1, last: -1 };
+
+        function sortSessions(mode) {
+            const order = sessions.map((_, i) => i);
+            // 最后更新为 YYYY-MM-DD HH:MM:SS，可直接按字符串比较；未知的排在最后
+            const time = i => /^\\d/.test(sessions[i][2]) ? sessions[i][2] : '';
+            if (mode === 'recent') {
+                order.sort((a, b) => time(a) < time(b) ? 1 : time(a) > time(b) ? -1 : a - b);
+            } else if (mode === 'count') {
+                order.sort((a, b) => sessions[b][1] - sessions[a][1] || a - b);
+            }
+            return order;
+        }
+
+        function filterSessions(query) {
+            // 查询只是在上一次的基础上变长时，在上一次的结果中继续筛选
+            const source = gridState.query && query.startsWith(gridState.query) ? gridState.view : gridState.order;
+            gridState.query = query;
+            gridState.view = query ? source.filter(i => haystacks[i].includes(query)) : gridState.order;
+            document.getElementById('sessionCount').textContent = query
+                ? '匹配 ' + gridState.view.length + ' / ' + sessions.length + ' 个会话'
+                : '共 ' + sessions.length + ' 个会话';
+            layoutGrid();
+        }
+
+        function layoutGrid() {
+            const columns = Math.max(1, Math.floor((viewport.clientWidth + CARD_GAP) / (CARD_MIN_WIDTH + CARD_GAP)));
+            gridState.columns = columns;
+            gridState.rows = Math.ceil(gridState.view.length / columns);
+            viewport.style.height = Math.max(0, gridState.rows * (CARD_HEIGHT + CARD_GAP) - CARD_GAP) + 'px';
+            grid.style.gridTemplateColumns = 'repeat(' + columns + ', 1fr)';
+            renderWindow(true);
+        }
+
+        function cardHtml(i) {
+            const [project, count, updated, summary, link] = sessions[i];
+            return '<div class="project-card"><div class="project-header"><div class="project-icon">📁</div>' +
+                '<div class="project-title"><h3>' + escapeHtml(sessionData.projects[project]) + '</h3>' +
+                '<div class="project-date">' + escapeHtml(updated) + '</div></div></div>' +
+                '<div class="project-summary">' + escapeHtml(summary) + '</div>' +
+                '<div class="project-footer"><div class="conversation-count">💬 ' + count + ' 条对话</div>' +
+                '<a href="' + escapeHtml(link) + '" class="view-button">查看详情</a></div></div>';
+        }
+
+        function renderWindow(force) {
+            const rowHeight = CARD_HEIGHT + CARD_GAP;
+            const top = viewport.getBoundingClientRect().top;
+            const first = Math.min(gridState.rows, Math.max(0, Math.floor(-top / rowHeight) - OVERSCAN_ROWS));
+            const last = Math.min(gridState.rows, Math.ceil((window.innerHeight - top) / rowHeight) + OVERSCAN_ROWS);
+            if (!force && first === gridState.first && last === gridState.last) return;
+            gridState.first = first;
+            gridState.last = last;
+            const columns = gridState.columns;
+            grid.style.transform = 'translateY(' + first * rowHeight + 'px)';
+            grid.innerHTML = gridState.view.slice(first * columns, last * columns).map(cardHtml).join('');
+        }
+
+        let scrollFrame = 0;
+        window.addEventListener('scroll', () => {
+            if (!scrollFrame) {
+                scrollFrame = requestAnimationFrame(() => { scrollFrame = 0; renderWindow(false); });
+            }
+        }, { passive: true });
+        window.addEventListener('resize', layoutGrid);
+
+        document.getElementById('sortSelect').addEventListener('change', function(e) {
+            gridState.order = sortSessions(e.target.value);
+            const query = gridState.query;
+            gridState.query = '';
+            filterSessions(query);
+        });
+
+        let filterTimer = null;
         document.getElementById('searchInput').addEventListener('input', function(e) {
-            const searchTerm = e.target.value.toLowerCase();
-            const cards = document.querySelectorAll('.project-card');
+            clearTimeout(filterTimer);
+            const query = e.target.value.trim().toLowerCase();
+            filterTimer = setTimeout(() => filterSessions(query), 80);
+        });
+
+        gridState.order = sortSessions('recent');
+        filterSessions('');
+
+        // 全文检索：索引按前缀分片存放在 search/ 目录，只加载查询用到的分片
+        const CJK = '\\u3040-\\u30ff\\u3400-\\u4dbf\\u4e00-\\u9fff\\uf900-\\ufaff\\uac00-\\ud7af';
+        const CJK_RE = new RegExp('^[' + CJK + ']', 'u');
+        const TOKEN_RE = new RegExp('[' + CJK + ']+|(?:(?![' + CJK + '])[\\\\p{L}\\\\p{N}\\\\p{M}_])+', 'gu');
+        const MAX_HITS = 50;
+        const searchData = { shards: {}, docs: {}, meta: null, loading: {} };
+        let searchSeq = 0;
+
+        window.__searchShard = (key, postings) => { searchData.shards[key] = postings; };
+        window.__searchDocs = (chunk, docs) => { searchData.docs[chunk] = docs; };
+        window.__searchMeta = (meta) => { searchData.meta = meta; };
+
+        function loadScript(src) {
+            if (!searchData.loading[src]) {
+                searchData.loading[src] = new Promise(resolve => {
+                    const el = document.createElement('script');
+                    el.src = src;
+                    el.onload = resolve;
+                    el.onerror = resolve;  // 分片不存在即无命中
+                    document.head.appendChild(el);
+                });
+            }
+            return searchData.loading[src];
+        }
+
+        function shardKey(token) {
+            return CJK_RE.test(token) ? Array.from(token)[0] : Array.from(token).slice(0, 2).join('');
+        }
+
+        function shardFile(key) {
+            return 'search/s-' + Array.from(key).map(c => c.codePointAt(0).toString(16)).join('-') + '.js';
+        }
+
+        // 与 history_search.build_match_query 一致：中文连续段拆成二元组，其余按前缀匹配
+        function queryTerms(query) {
+            const terms = [];
+            for (const run of query.toLowerCase().match(TOKEN_RE) || []) {
+                const chars = Array.from(run);
+                if (CJK_RE.test(run) && chars.length > 1) {
+                    for (let i = 0; i < chars.length - 1; i++) {
+                        terms.push({ term: chars[i] + chars[i + 1], prefix: false });
+                    }
+                } else {
+                    terms.push({ term: run, prefix: true });
+                }
+            }
+            return terms;
+        }
 
-            cards.forEach(card => {
-                const text = card.textContent.toLowerCase();
-                card.style.display = text.includes(searchTerm) ? 'block' : 'none';
-            });
+        function decodePostings(deltas) {
+            const ids = [];
+            let id = 0;
+            for (const d of deltas) { id += d; ids.push(id); }
+            return ids;
+        }
+
+        function lookup(term, prefix) {
+            const shard = searchData.shards[shardKey(term)] || {};
+            const ids = new Set();
+            for (const [t, deltas] of Object.entries(shard)) {
+                if (t === term || (prefix && t.startsWith(term))) {
+                    decodePostings(deltas).forEach(id => ids.add(id));
+                }
+            }
+            return ids;
+        }
+
+        function escapeHtml(text) {
+            return text.replace(/[&<>"]/g, c => ({ '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;' })[c]);
+        }
+
+        async function searchContent(query) {
+            const seq = ++searchSeq;
+            const box = document.getElementById('searchResults');
+            const terms = queryTerms(query).filter(t => CJK_RE.test(t.term) || t.term.length > 1);
+            if (!terms.length) {
+                box.style.display = 'none';
+                return;
+            }
+
+            await Promise.all([loadScript('search/meta.js')]
+                .concat(terms.map(t => loadScript(shardFile(shardKey(t.term))))));
+            if (seq !== searchSeq || !searchData.meta) return;
+
+            let hits = null;
+            for (const t of terms) {
+                const ids = lookup(t.term, t.prefix);
+                hits = hits === null ? ids : new Set([...hits].filter(id => ids.has(id)));
+            }
+            const top = [...hits].sort((a, b) => b - a).slice(0, MAX_HITS);
+
+            const chunkSize = searchData.meta.docChunkSize;
+            const chunks = [...new Set(top.map(id => Math.floor(id / chunkSize)))];
+            await Promise.all(chunks.map(c => loadScript('search/d-' + c + '.js')));
+            if (seq !== searchSeq) return;
+
+            let html = '<h4>💬 对话内容匹配 ' + hits.size + ' 条' +
+                (hits.size > MAX_HITS ? '（显示最近 ' + MAX_HITS + ' 条）' : '') + '</h4>';
+            for (const id of top) {
+                const doc = (searchData.docs[Math.floor(id / chunkSize)] || {})[id];
+                if (!doc) continue;
+                const [sessionId, num, role, timestamp, preview] = doc;
+                const [displayName, session, link] = searchData.meta.sessions[sessionId];
+                html += '<a class="search-hit" href="' + escapeHtml(link) + '">' +
+                    '<div class="search-hit-meta">' + escapeHtml(displayName) + ' · #' + num + ' · ' +
+                    (role === 'user' ? '👤 用户' : '🤖 Claude') + ' · ' + escapeHtml(timestamp.replace('T', ' ').slice(0, 19)) +
+                    '</div><div class="search-hit-text">' + escapeHtml(preview) + '</div></a>';
+            }
+            box.innerHTML = html;
+            box.style.display = 'block';
+        }
+
+        let searchTimer = null;
+        document.getElementById('searchInput').addEventListener('input', function(e) {
+            clearTimeout(searchTimer);
+            const query = e.target.value;
+            searchTimer = setTimeout(() => searchContent(query), 150);
         });
     </script>
 </body>
 </html>"""
 
-        # 生成项目卡片
-        projects_html = ""
+        # 会话卡片的数据：项目名称只存一次，每个会话为 [项目序号, 对话数, 最后更新, 摘要, 链接]
+        names = {}
+        sessions = []
         total_conversations = 0
 
         for info in projects_info:
             total_conversations += info['count']
+            project = names.setdefault(info['display_name'], len(names))
+            sessions.append([project, info['count'], info['last_updated'], info['summary'], info['filename']])
 
-            projects_html += f"""
-            <div class="project-card">
-                <div class="project-header">
-                    <div class="project-icon">📁</div>
-                    <div class="project-title">
-                        <h3>{info['display_name']}</h3>
-                        <div class="project-date">{info['last_updated']}</div>
-                    </div>
-                </div>
-                <div class="project-summary">
-                    {info['summary']}
-                </div>
-                <div class="project-footer">
-                    <div class="conversation-count">
-                        💬 {info['count']} 条对话
-                    </div>
-                    <a href="{info['filename']}" class="view-button">查看详情</a>
-                </div>
-            </div>
-            """
+        # 内嵌在 <script> 中，转义 < 避免提前结束标签
+        session_data = json.dumps({'projects': list(names), 'sessions': sessions},
+                                  ensure_ascii=False, separators=(',', ':')).replace('<', '\\u003c')
 
-        if not projects_html:
-            projects_html = """
-            <div class="empty-state">
-                <h2>暂无对话历史</h2>
-                <p>开始使用 Claude Code 后，对话历史将自动保存在这里</p>
-            </div>
-            """
+        empty_html = ""
+        if not sessions:
+            empty_html = """
+        <div class="empty-state">
+            <h2>暂无对话历史</h2>
+            <p>开始使用 Claude Code 后，对话历史将自动保存在这里</p>
+        </div>
+        """
+
+        stats = self.get_stats()
+        model_totals = stats.totals('m:')
+        total_tokens = sum(row[3] + row[4] for row in model_totals.values())
 
         html = html.replace('__TOTAL_PROJECTS__', str(len(projects_info)))
         html = html.replace('__TOTAL_CONVERSATIONS__', str(total_conversations))
-        html = html.replace('__PROJECTS_HTML__', projects_html)
+        html = html.replace('__TOTAL_TOKENS__', format_tokens(total_tokens))
+        html = html.replace('__USAGE_HTML__', self.generate_usage_html(stats))
+        html = html.replace('__EMPTY_HTML__', empty_html)
+        # 会话数据最后替换，其中的文本不会被当作占位符
+        html = html.replace('__SESSION_DATA__', session_data)
 
         return html
 
+    def generate_usage_html(self, stats):
+        """生成索引页的用量统计：最近每日的消息数和 token 柱状图，以及按项目、模型的汇总表"""
+        days = stats.daily(skip_empty=False)
+        while days and not any(days[-1][1]):
+            days.pop()
+        days = days[-USAGE_CHART_DAYS:]
+        if not days:
+            return ""
+
+        def chart(title, values, unit):
+            peak = max(values) or 1
+            bars = "".join(
+                f'<rect x="{i * 10 + 1}" y="{100 - value * 100 / peak:.1f}" width="8" '
+                f'height="{value * 100 / peak:.1f}"><title>{day.isoformat()}: {value:,} {unit}</title></rect>'
+                for i, ((day, _), value) in enumerate(zip(days, values)))
+            return f"""
+            <div class="usage-chart">
+                <h4>{title}</h4>
+                <svg viewBox="0 0 {len(days) * 10} 100" preserveAspectRatio="none">{bars}</svg>
+                <div class="usage-axis"><span>{days[0][0].isoformat()}</span><span>{days[-1][0].isoformat()}</span></div>
+            </div>"""
+
+        def table(title, label, totals, name, messages):
+            # 模型列不记录消息数
+            rows = sorted(totals.items(), key=lambda item: (-(item[1][3] + item[1][4]), item[0]))[:10]
+            body = "".join(
+                f"<tr><td>{escape(name(key))}</td>"
+                + (f"<td>{row[0] + row[1]:,}</td>" if messages else "")
+                + f"<td>{row[2]:,}</td><td>{format_tokens(row[3])}</td><td>{format_tokens(row[4])}</td>"
+                f"<td>{format_tokens(row[5])}</td></tr>"
+                for key, row in rows)
+            return f"""
+                <div>
+                    <h4>{title}</h4>
+                    <table class="usage-table">
+                        <tr><th>{label}</th>{"<th>消息</th>" if messages else ""}<th>请求</th><th>输入</th><th>输出</th><th>缓存读取</th></tr>
+                        {body}
+                    </table>
+                </div>"""
+
+        return f"""
+        <div class="usage">
+            <h2>📊 用量统计</h2>
+            {chart(f"最近 {len(days)} 天消息数", [row[0] + row[1] for _, row in days], "条消息")}
+            {chart(f"最近 {len(days)} 天 token 用量", [row[3] + row[4] for _, row in days], "tokens")}
+            <div class="usage-tables">
+                {table("按项目", "项目", stats.totals('p:'), self.clean_project_name, True)}
+                {table("按模型", "模型", stats.totals('m:'), lambda model: model, False)}
+            </div>
+        </div>"""
+
+    def session_link(self, project_name, session):
+        """会话对应的输出文件（相对 index.html 的链接）"""
+        if self.html_pages:
+            return f"{self.session_html_dir(project_name, session)}/index.html"
+        return self.session_markdown_path(project_name, session)
+
+    def session_markdown_path(self, project_name, session):
+        """会话 Markdown 分片（相对输出目录）"""
+        safe_name = project_name.replace('/', '_').replace('\\', '_')
+        return f"sessions/{safe_name}/{session}.md"
+
+    def session_html_dir(self, project_name, session):
+        """会话分页 HTML 所在目录（相对输出目录）"""
+        safe_name = project_name.replace('/', '_').replace('\\', '_')
+        return f"sessions/{safe_name}/{session}"
+
+    def export_search_shards(self):
+        """导出浏览器端全文检索使用的分片索引"""
+        index = self.get_search_index()
+        if not index:
+            return
+        shards, chunks = index.export_shards(
+            self.output_dir / "search",
+            lambda project, session: (self.clean_project_name(project),
+                                      self.session_link(project, session)))
+        if shards or chunks:
+            print(f"Updated {shards} search shards and {chunks} document chunks")
+
     def clean_project_name(self, name):
         """清理项目名称"""
         # 将路径分隔符替换为更友好的格式
@@ -377,65 +1606,550 @@ class ClaudeHistoryManager:
         name = name.replace('--', ' ')
         return name
 
-    def export_all(self):
-        """导出所有对话历史"""
+    def is_session_unchanged(self, jsonl_file, entry):
+        """根据 inode、大小和修改时间判断会话文件自上次导出后是否未变化"""
+        if not entry:
+            return False
+        st = jsonl_file.stat()
+        return entry['inode'] == st.st_ino and entry['size'] == st.st_size \
+            and entry['mtime'] == st.st_mtime
+
+    def is_index_behind(self, jsonl_file, entry, index_offsets=None):
+        """判断全文索引是否落后于清单记录（例如索引库被删除后）"""
+        if not entry or not self.get_search_index():
+            return False
+        if index_offsets is None:
+            state = self.search_index.session_state(jsonl_file)
+            return (state[1] if state else None) != entry['offset']
+        return index_offsets.get(str(jsonl_file)) != entry['offset']
+
+    def is_store_behind(self, jsonl_file, entry):
+        """会话的消息存储或对话树是否缺失、格式过旧，或按不同的块上限生成（改变 --block-cap 后需要重建）"""
+        if not entry:
+            return False
+        base = self.store_path(jsonl_file)
+        return entry.get('store_cap') != self.block_cap or entry.get('store_version') != STORE_VERSION \
+            or entry.get('thread_version') != THREAD_VERSION \
+            or not base.with_name(base.name + '.cols').exists() or not self.thread_path(jsonl_file).exists()
+
+    def update_session(self, jsonl_file, entry):
+        """按清单记录增量解析单个会话文件
+
+        返回 (新的清单记录, 本次解析前的 (偏移, 消息数), 是否从头重新解析)。
+        未变化的文件直接跳过；被截断或替换的文件从头重新解析。
+        """
+        unchanged = self.is_session_unchanged(jsonl_file, entry)
+        if unchanged and not self.is_index_behind(jsonl_file, entry) and not self.is_store_behind(jsonl_file, entry):
+            return entry, (entry['offset'], entry['count']), False
+
+        st = jsonl_file.stat()
+        # 文件未变化时（只是索引或存储落后）沿用记录；块上限改变后存储中截断的内容不同，需要重新解析
+        reset = (not unchanged and self.needs_reparse(jsonl_file, entry, st)) \
+            or entry.get('store_cap') != self.block_cap
+        if reset:
+            entry = {'offset': 0, 'count': 0, 'summary': None, 'last_timestamp': ''}
+        delta = (entry['offset'], entry['count'])
+        start = delta[0]
+
+        # 消息存储缺失或与清单不一致时从头重建
+        store_writer = MessageStoreWriter(self.store_path(jsonl_file), self.block_cap)
+        if not reset and not store_writer.resume(*delta):
+            start = 0
+        # 对话树同样接着建立，缺失或不一致时从头重建
+        thread = ThreadIndex()
+        if not reset:
+            loaded, thread_head = ThreadIndex.load(self.thread_path(jsonl_file))
+            if loaded and loaded.offset == delta[0] \
+                    and thread_head == self.read_head_fingerprint(jsonl_file, delta[0]):
+                thread = loaded
+            else:
+                start = 0
+
+        # 全文索引与清单共用同一次读取；索引落后时从索引自己的偏移处补齐
+        index_writer = None
+        index = self.get_search_index()
+        if index:
+            project, session = jsonl_file.parent.name, jsonl_file.stem
+            index_writer = index.writer(jsonl_file, project, session, reset)
+            if index_writer.offset > delta[0]:
+                index_writer = index.writer(jsonl_file, project, session, reset=True)
+            if index_writer.offset < start and store_writer.offset == start:
+                # 索引落后（例如索引库被删除）的部分直接从消息存储补齐
+                with MessageStore.open(store_writer.base_path) as store:
+                    for conv in store.messages(store.index_after(index_writer.offset)):
+                        index_writer.add(conv)
+                index_writer.offset = start
+            start = min(start, index_writer.offset)
+
+        entry = dict(entry)
+        usage = UsageCollector(entry)
+        interner = BlockInterner(entry.get('blocks'), entry['count'])
+        # 会话中最早和最晚的时间（UTC 毫秒），筛选导出时据此跳过整个会话；只有从头读取时才能补上缺少的记录
+        bounds = list(entry['time_range']) if entry.get('time_range') else [None, None] if start == 0 else None
+
+        def on_usage(record, offset):
+            if offset > delta[0]:
+                usage.add_usage(record)
+
+        # 超长内容块在解析时即另存，渲染时只需读取存储中的文件名
+        stream = self.iter_session(jsonl_file, start, project={'name': jsonl_file.parent.name},
+                                   on_usage=on_usage, on_record=thread.add_line)
+        seq = 0
+        for conv in stream:
+            # 从头读取时（包括重建对话树）seq 即消息序号
+            seq += 1
+            if index_writer and conv.offset > index_writer.offset:
+                index_writer.add(conv)
+            if conv.offset > store_writer.offset:
+                store_writer.add(conv)
+            ms = timestamp_ms(conv.timestamp) if bounds else None
+            if ms is not None:
+                if bounds[0] is None or ms < bounds[0]:
+                    bounds[0] = ms
+                if bounds[1] is None or ms > bounds[1]:
+                    bounds[1] = ms
+            if conv.offset <= delta[0]:
+                if start == 0:
+                    thread.mark_message(conv.offset, seq)
+                continue
+            entry['count'] += 1
+            thread.mark_message(conv.offset, entry['count'])
+            if conv.content:
+                usage.add_message(conv)
+            interner.add(conv)
+            if not entry['summary'] and conv.role == 'user' and conv.content:
+                entry['summary'] = self.get_conversation_summary([conv])
+            if conv.timestamp:
+                entry['last_timestamp'] = conv.timestamp
+        if index_writer:
+            index_writer.flush(stream.offset)
+        head = self.read_head_fingerprint(jsonl_file, stream.offset)
+        store_writer.commit(stream.offset, head)
+        thread.offset = stream.offset
+        thread.save(self.thread_path(jsonl_file), head)
+        entry['store_cap'] = self.block_cap
+        entry['store_version'] = STORE_VERSION
+        entry['thread_version'] = THREAD_VERSION
+        view = thread.view()
+        if not reset and entry.get('hidden', view.digest(delta[1])) != view.digest(delta[1]):
+            # 已写出的消息中有的改为属于未采用的分支（或相反），输出需要整体重写
+            reset = True
+        entry['hidden'] = view.digest()
+        # 当前分支的最后一条记录，及接续的其他会话中的记录（由 export_all 解析为会话）
+        entry['leaf'] = view.leaf
+        if view.continues != entry.get('continues'):
+            entry.pop('continued_from', None)
+        if view.continues:
+            entry['continues'] = view.continues
+        else:
+            entry.pop('continues', None)
+        if bounds and bounds[0] is not None:
+            entry['time_range'] = bounds
+        usage.update(entry)
+        # 会话内重复大段正文的哈希表，渲染时据此输出引用
+        entry['blocks'] = interner.blocks
+        self.metrics.record_stream(stream, start)
+        self.metrics.count('sessions_parsed')
+
+        entry.update({
+            'inode': st.st_ino,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'offset': stream.offset,
+            'head': head,
+        })
+        return entry, delta, reset
+
+    def needs_reparse(self, jsonl_file, entry, st):
+        """会话文件是否需要从头解析：没有记录，或文件被替换、截断、改写"""
+        return (
+            not entry
+            or entry['inode'] != st.st_ino
+            or st.st_size <= entry['size']
+            or entry['head'] != self.read_head_fingerprint(jsonl_file, entry['offset'])
+        )
+
+    def summarize_session(self, jsonl_file, entry):
+        """只更新索引页需要的消息数、摘要、最后时间和用量，不写任何输出
+
+        追加写入的文件只解析新增部分，摘要沿用记录；被替换的文件从头解析。
+        """
+        if self.is_session_unchanged(jsonl_file, entry):
+            return entry
+
+        st = jsonl_file.stat()
+        if self.needs_reparse(jsonl_file, entry, st):
+            entry = {'offset': 0, 'count': 0, 'summary': None, 'last_timestamp': ''}
+        entry = dict(entry)
+        start = entry['offset']
+        usage = UsageCollector(entry)
+        stream = self.iter_session(jsonl_file, start, on_usage=lambda record, offset: usage.add_usage(record))
+        for conv in stream:
+            entry['count'] += 1
+            if conv.content:
+                usage.add_message(conv)
+            if not entry['summary'] and conv.role == 'user' and conv.content:
+                entry['summary'] = self.get_conversation_summary([conv])
+            if conv.timestamp:
+                entry['last_timestamp'] = conv.timestamp
+        usage.update(entry)
+        self.metrics.record_stream(stream, start)
+        self.metrics.count('sessions_parsed')
+
+        entry.update({
+            'inode': st.st_ino,
+            'size': st.st_size,
+            'mtime': st.st_mtime,
+            'offset': stream.offset,
+            'head': self.read_head_fingerprint(jsonl_file, stream.offset),
+        })
+        return entry
+
+    def read_head_fingerprint(self, jsonl_path, limit):
+        """读取文件开头（最多 4KB）作为指纹，用于识别被替换的文件"""
+        return read_head_fingerprint(jsonl_path, limit)
+
+    def is_output_current(self, record, jsonl_file, entry, reset, path):
+        """输出文件是否已与会话记录一致，一致时无需生成写出任务"""
+        return bool(record) and record['source'] == str(jsonl_file) and not reset \
+            and record['count'] == entry['count'] and path.exists()
+
+    def write_session_markdown(self, project, jsonl_file, entry, delta, reset, record):
+        """写出会话 Markdown 分片：未变化则跳过，仅追加则只写新增部分
+
+        返回该分片新的输出记录。
+        """
+        source = str(jsonl_file)
+        session = jsonl_file.stem
+        md_path = self.output_dir / self.session_markdown_path(project['name'], session)
+        delta_offset, delta_count = delta
+        hidden = self.hidden_messages(jsonl_file, entry)
+        continued = self.continued_link(entry, self.session_markdown_path, md_path)
+
+        if record and record['source'] == source and not reset and md_path.exists():
+            if record['count'] == entry['count']:
+                return record
+            if record['count'] == delta_count:
+                new_conversations = self.read_session(jsonl_file, entry, delta_offset, project,
+                                                      BlockInterner(entry.get('blocks'), delta_count))
+                self.append_session_markdown(
+                    md_path, project, session, entry['count'], new_conversations, delta_count + 1,
+                    hidden, continued)
+                return {'source': source, 'count': entry['count']}
+
+        md_path.parent.mkdir(parents=True, exist_ok=True)
+        conversations = self.read_session(jsonl_file, entry, 0, project, BlockInterner(entry.get('blocks')))
+        count = self.render_session_markdown(md_path, project, session, entry['count'], conversations,
+                                             hidden, continued)
+        return {'source': source, 'count': count}
+
+    def count_written(self, out):
+        """记录实际替换的文件数和字节数（AtomicFile）"""
+        if out.changed:
+            self.metrics.count('files_written')
+            self.metrics.count('bytes_written', out.size)
+
+    def write_session_html(self, project, jsonl_file, entry, delta, reset, record):
+        """写出会话的分页 HTML：未变化则跳过，仅追加则只重写原最后一页及之后的页
+
+        返回新的输出记录，pages 中每页记录 [起始字节偏移, 首条时间, 摘要]。
+        """
+        source = str(jsonl_file)
+        session = jsonl_file.stem
+        session_dir = self.output_dir / self.session_html_dir(project['name'], session)
+        count = entry['count']
+        hidden = self.hidden_messages(jsonl_file, entry)
+
+        pages = []
+        start_offset = 0
+        if record and record['source'] == source and not reset and (session_dir / "index.html").exists():
+            if record['count'] == count:
+                return record
+            if record['count'] == delta[1] and record['pages']:
+                # 原最后一页需要补充消息或增加“下一页”链接，之前的页保持不变
+                pages = record['pages'][:-1]
+                start_offset = record['pages'][-1][0]
+        session_dir.mkdir(parents=True, exist_ok=True)
+
+        written = len(pages) * SESSION_PAGE_SIZE
+        page_start = start_offset
+        batch = []
+        interner = BlockInterner(entry.get('blocks'), written)
+        for conv in self.read_session(jsonl_file, entry, start_offset, project, interner):
+            batch.append(conv)
+            if len(batch) < SESSION_PAGE_SIZE:
+                continue
+            written += len(batch)
+            pages.append(self.write_session_page(session_dir, project, session, len(pages) + 1,
+                                                 page_start, batch, written < count, hidden))
+            page_start = conv.offset
+            batch = []
+        if batch or not pages:
+            written += len(batch)
+            pages.append(self.write_session_page(session_dir, project, session, len(pages) + 1,
+                                                 page_start, batch, False, hidden))
+
+        # 重新解析后页数可能变少，删除多余的旧页
+        if not start_offset:
+            for path in session_dir.glob("page-*.html"):
+                if int(path.stem[5:]) > len(pages):
+                    path.unlink()
+
+        continued = self.continued_link(entry, lambda p, s: f"{self.session_html_dir(p, s)}/index.html",
+                                        session_dir / "index.html")
+        self.render_session_toc(session_dir, project, session, pages, written, continued)
+        return {'source': source, 'count': written, 'pages': pages}
+
+    def write_session_page(self, session_dir, project, session, page, page_start, batch, has_next, hidden=None):
+        """写出一页并返回它在输出记录中的条目"""
+        start_index = (page - 1) * SESSION_PAGE_SIZE + 1
+        self.render_session_page(session_dir, project, session, page, start_index, batch, has_next, hidden)
+        first_timestamp = batch[0].timestamp if batch else ''
+        return [page_start, first_timestamp, self.get_conversation_summary(batch)]
+
+    def scan_session_pages(self, jsonl_file):
+        """扫描会话得到分页索引，不渲染内容
+
+        返回 (各页 [起始字节偏移, 首条时间, 摘要], 消息数, 已解析到的字节偏移, 重复正文哈希表)。
+        """
+        pages = []
+        count = 0
+        page_start = 0
+        interner = BlockInterner()
+        stream = self.iter_session(jsonl_file, interner=interner)
+        for conv in stream:
+            if count % SESSION_PAGE_SIZE == 0:
+                pages.append([page_start, conv.timestamp, None])
+            if pages[-1][2] is None and conv.role == 'user' and conv.content:
+                pages[-1][2] = self.get_conversation_summary([conv])
+            count += 1
+            page_start = conv.offset
+        for page in pages:
+            page[2] = page[2] or "No content"
+        return pages, count, stream.offset, interner.blocks
+
+    def write_indexed_session_page(self, f, project, jsonl_file, pages, page, end_offset, blocks):
+        """根据分页索引只读取第 page 页的消息并写入文件对象"""
+        interner = BlockInterner(blocks, (page - 1) * SESSION_PAGE_SIZE)
+        conversations = islice(self.iter_session(jsonl_file, pages[page - 1][0], end_offset, project,
+                                                 interner=interner), SESSION_PAGE_SIZE)
+        self.write_session_page_html(f, project, jsonl_file.stem, page, (page - 1) * SESSION_PAGE_SIZE + 1,
+                                     conversations, page < len(pages), self.hidden_messages(jsonl_file))
+
+    def run_tasks(self, method_name, tasks, deadline=None):
+        """依次或并行执行一批任务，结果顺序始终与任务顺序一致
+
+        deadline 为 time.monotonic() 时刻，过时后不再开始新任务（至少执行第一个），
+        未执行的任务结果为 None。
+        """
+        if self.jobs <= 1 or len(tasks) < 2:
+            method = getattr(self, method_name)
+            results = []
+            for args in tasks:
+                if deadline is not None and results and time.monotonic() >= deadline:
+                    results.append(None)
+                else:
+                    results.append(method(*args))
+            return results
+
+        workers = min(self.jobs, len(tasks))
+        chunksize = max(1, len(tasks) // (workers * 4))
+        results = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                 initargs=(pickle.dumps(self),)) as executor:
+            if deadline is None:
+                outcomes = executor.map(_run_worker_task, repeat(method_name), tasks, chunksize=chunksize)
+            else:
+                outcomes = _collect_until([executor.submit(_run_worker_task, method_name, args)
+                                           for args in tasks], deadline)
+            for outcome in outcomes:
+                if outcome is None:
+                    results.append(None)
+                    continue
+                result, counters, output = outcome
+                # 工作进程中的计数和输出随结果一起传回，按任务顺序输出到当前的 stdout
+                if counters:
+                    self.metrics.merge(counters)
+                if output:
+                    sys.stdout.write(output)
+                results.append(result)
+        return results
+
+    def export_all(self, only=None, deadline=None, rerender=False):
+        """导出所有对话历史
+
+        only 为会话文件路径集合时只解析这些文件，其余会话沿用清单中的记录。
+        deadline 为 time.monotonic() 时刻，到时后剩余的解析和写出任务留到下一次调用
+        （记录在 carry_over 和 deferred_outputs 中，只在同一进程内有效）。
+        rerender 时由消息存储重新生成所有输出（输出格式版本变化时也会如此）。
+        """
         print("Scanning Claude projects...")
-        projects = self.get_all_projects()
+        with self.metrics.stage('scan'):
+            projects = self.get_all_projects()
 
         if not projects:
             print("No projects found!")
-            return
+            # 之前导出的会话都已不存在时，照常走完下面的流程以清理它们的输出
+            if not self.manifest['files'] and not self.manifest['outputs'] and not self.manifest['rollups']:
+                return None
+        else:
+            print(f"Found {len(projects)} projects")
+        self.metrics.count('sessions', sum(len(p['conversations']) for p in projects))
 
-        print(f"Found {len(projects)} projects")
+        # 第一步：增量解析有变化的会话文件（可并行）
+        files = self.manifest['files']
+        session_files = [f for project in projects for f in sorted(project['conversations'])]
+        candidates = session_files
+        if only is not None:
+            # 有多个副本的会话以归并后的文件代替
+            only = {self.merged_sources.get(str(Path(p)), str(Path(p))) for p in only} | self.carry_over
+            candidates = [f for f in session_files if str(f) in only]
+        with self.metrics.stage('parse'):
+            index_offsets = self.get_search_index().session_offsets() if self.get_search_index() else {}
+            changed = [(f, files.get(str(f))) for f in candidates
+                       if not self.is_session_unchanged(f, files.get(str(f)))
+                       or self.is_index_behind(f, files.get(str(f)), index_offsets)
+                       or self.is_store_behind(f, files.get(str(f)))]
+            results = {}
+            self.carry_over = set()
+            for (f, _), result in zip(changed, self.run_tasks('update_session', changed, deadline)):
+                if result is None:
+                    # 未解析的会话清单记录不变，下次照常视为有变化
+                    self.carry_over.add(str(f))
+                else:
+                    results[str(f)] = result
+            # 接续关系在所有会话的对话树都已建立后再解析，被接续的会话可能在同一批中
+            entries = dict(files)
+            entries.update((key, result[0]) for key, result in results.items())
+            if self.get_search_index():
+                # 工作进程暂存的索引按任务顺序写入，消息 id 与依次解析时相同
+                self.search_index.apply_staged(f for f, _ in changed if str(f) in results)
+                self.update_search_hidden(entries)
+            self.link_continued_sessions(entries, results)
 
         projects_info = []
+        markdown_tasks = []
+        html_tasks = []
+        rollups = []
+        outputs = self.manifest['outputs']
+        if rerender or self.manifest.get('output_version') != OUTPUT_VERSION \
+                or self.manifest.get('branches', 'active') != self.branches:
+            # 没有输出记录的会话全部重新渲染；内容不变的文件不会被改写
+            outputs.clear()
+            self.deferred_outputs = {}
+            self.manifest['output_version'] = OUTPUT_VERSION
+            self.manifest['branches'] = self.branches
+        stats = self.get_stats()
+        stats_changed = False
 
         for project in projects:
             print(f"\nProcessing: {project['name']}")
 
-            # 处理每个对话文件
-            for jsonl_file in project['conversations']:
-                conversations = self.parse_conversation(jsonl_file)
+            # 处理每个对话文件；每个会话单独输出，只为有变化的会话生成写出任务
+            sessions = []
+            for jsonl_file in sorted(project['conversations']):
+                key = str(jsonl_file)
+                if key in results:
+                    entry, delta, reset = results[key]
+                    old_usage = files[key].get('usage') if key in files else None
+                    if entry.get('usage') != old_usage:
+                        # 用量汇总表减去会话原有的用量，再加上新的
+                        stats.apply(project['name'], old_usage or {}, -1)
+                        stats.apply(project['name'], entry['usage'])
+                        stats_changed = True
+                    files[key] = entry
+                elif key in files:
+                    entry = files[key]
+                    delta, reset = (entry['offset'], entry['count']), False
+                else:
+                    # 尚未导出且不在本次范围内的会话
+                    continue
 
-                if not conversations:
+                if not entry['count']:
                     continue
 
-                print(f"  - {len(conversations)} messages in {jsonl_file.name}")
+                new_count = entry['count'] - delta[1]
+                if new_count:
+                    print(f"  - {new_count} new messages in {jsonl_file.name}")
+                sessions.append((jsonl_file, entry))
 
-                # 生成 Markdown
-                md_content = self.generate_project_markdown(project, conversations)
+                md_key = self.session_markdown_path(project['name'], jsonl_file.stem)
+                record = outputs.get(md_key)
+                md_delta, md_reset = self.output_delta(md_key, delta, reset)
+                if not self.is_output_current(record, jsonl_file, entry, md_reset, self.output_dir / md_key):
+                    markdown_tasks.append((project, jsonl_file, entry, md_delta, md_reset, record))
 
-                # 保存 Markdown
-                safe_name = project['name'].replace('/', '_').replace('\\', '_')
-                md_filename = f"{safe_name}.md"
-                md_path = self.output_dir / md_filename
+                if self.html_pages:
+                    html_key = self.session_html_dir(project['name'], jsonl_file.stem)
+                    record = outputs.get(html_key)
+                    html_delta, html_reset = self.output_delta(html_key, delta, reset)
+                    if not self.is_output_current(record, jsonl_file, entry, html_reset,
+                                                  self.output_dir / html_key / "index.html"):
+                        html_tasks.append((project, jsonl_file, entry, html_delta, html_reset, record))
 
-                with open(md_path, 'w', encoding='utf-8') as f:
-                    f.write(md_content)
+                # 添加到索引
+                projects_info.append(self.build_project_info(project, jsonl_file, entry))
 
-                # 获取最后更新时间
-                last_conv = conversations[-1] if conversations else None
-                last_time = "Unknown"
-                if last_conv and last_conv['timestamp']:
-                    last_time = self.format_timestamp(last_conv['timestamp'])
+            if sessions:
+                rollups.append((project, sessions))
 
-                # 添加到索引
-                projects_info.append({
-                    'name': project['name'],
-                    'display_name': self.clean_project_name(project['name']),
-                    'filename': md_filename,
-                    'count': len(conversations),
-                    'summary': self.get_conversation_summary(conversations),
-                    'last_updated': last_time
-                })
+        # 第二步：写出有变化的会话 Markdown 分片（可并行）
+        with self.metrics.stage('render'):
+            records = self.run_tasks('write_session_markdown', markdown_tasks, deadline)
+            written = self.store_output_records(
+                markdown_tasks, records, lambda task: self.session_markdown_path(task[0]['name'], task[1].stem))
+            if written:
+                print(f"\nWrote {written} session files")
+
+            # 项目汇总页，内容不变时不重写
+            rollup_keys = [self.write_project_rollup(project, sessions) for project, sessions in rollups]
+
+            # 分页 HTML（可并行）
+            records = self.run_tasks('write_session_html', html_tasks, deadline)
+            self.store_output_records(
+                html_tasks, records, lambda task: self.session_html_dir(task[0]['name'], task[1].stem))
+
+        # 清理已不存在的会话记录，以及旧版按项目输出的记录
+        seen_files = set(map(str, session_files))
+        for key in [k for k in files if k not in seen_files]:
+            if files[key].get('usage'):
+                stats.apply(Path(key).parent.name, files[key]['usage'], -1)
+                stats_changed = True
+            del files[key]
+            base = self.store_path(Path(key))
+            for suffix in ('.cols', '.blob', '.thread'):
+                base.with_name(base.name + suffix).unlink(missing_ok=True)
+        index = self.get_search_index()
+        if index:
+            # 包括已不在清单中的会话（例如归并到 .merged/ 之前的原路径）
+            removed = sum(index.remove_session(key) for key in index.session_offsets() if key not in seen_files)
+            if removed:
+                self.metrics.count('sessions_unindexed', removed)
+        for key in [k for k in outputs if not k.startswith("sessions/")]:
+            del outputs[key]
+        self.remove_stale_outputs(projects, seen_files)
+        self.remove_stale_rollups(rollup_keys)
+        with self.metrics.stage('manifest'):
+            if stats_changed:
+                stats.prune()
+                stats.generation += 1
+                self.manifest['stats_generation'] = stats.generation
+            # 汇总表先于清单保存，两者的 generation 不一致时下次由清单重建
+            stats.save(self.stats_path)
+            self.save_manifest()
+        # 待导出的分片记录在 search.db 中，留有未完成的工作时等全部完成后再统一导出
+        if not self.has_pending_work():
+            with self.metrics.stage('search'):
+                self.export_search_shards()
 
         # 生成索引 HTML
         print("\nGenerating index...")
-        index_html = self.generate_index_html(projects_info)
-        index_path = self.output_dir / "index.html"
+        with self.metrics.stage('index'):
+            index_path = self.write_index_html(projects_info)
 
-        with open(index_path, 'w', encoding='utf-8') as f:
-            f.write(index_html)
+        if self.has_pending_work():
+            print(f"\nTime budget reached: {len(self.carry_over)} sessions to parse and "
+                  f"{len(self.deferred_outputs)} outputs to write left for the next run")
 
         print(f"\n{'='*60}")
         print(f"Export completed!")
@@ -447,12 +2161,426 @@ class ClaudeHistoryManager:
 
         return index_path
 
+    def remove_stale_outputs(self, projects, seen_files):
+        """删除来源会话已不存在的会话 Markdown 和分页 HTML，以及它们的输出记录
+
+        输出路径仍属于现有会话时（例如会话改由 .merged/ 中的归并文件导出）保留，由它重写。
+        """
+        live = set()
+        for project in projects:
+            for jsonl_file in project['conversations']:
+                live.add(self.session_markdown_path(project['name'], jsonl_file.stem))
+                live.add(self.session_html_dir(project['name'], jsonl_file.stem))
+        outputs = self.manifest['outputs']
+        for key in [k for k, record in outputs.items() if record['source'] not in seen_files]:
+            if key not in live:
+                path = self.output_dir / key
+                if path.is_dir():
+                    shutil.rmtree(path)
+                else:
+                    path.unlink(missing_ok=True)
+                self.metrics.count('outputs_removed')
+            del outputs[key]
+            self.deferred_outputs.pop(key, None)
+
+    def remove_stale_rollups(self, rollup_keys):
+        """删除本次没有写出的项目汇总页（项目已不存在或其中已没有消息），并记下本次写出的"""
+        current = set(rollup_keys)
+        for key in self.manifest['rollups']:
+            if key not in current:
+                (self.output_dir / key).unlink(missing_ok=True)
+                self.metrics.count('outputs_removed')
+        self.manifest['rollups'] = sorted(current)
+
+    def output_delta(self, key, delta, reset):
+        """输出上次被推迟时，从推迟时的位置续写（其间会话可能又被解析过）"""
+        deferred = self.deferred_outputs.pop(key, None)
+        if deferred and not reset:
+            return deferred
+        return delta, reset
+
+    def store_output_records(self, tasks, records, output_key):
+        """保存写出任务返回的输出记录，未执行的任务记入 deferred_outputs；返回写出的个数"""
+        written = 0
+        for task, record in zip(tasks, records):
+            if record is None:
+                self.deferred_outputs[output_key(task)] = (task[3], task[4])
+            else:
+                self.manifest['outputs'][output_key(task)] = record
+                written += 1
+        return written
+
+    def has_pending_work(self):
+        """上次导出是否因时间预算留下了未完成的解析或写出"""
+        return bool(self.carry_over or self.deferred_outputs)
+
+    def export_filtered(self, since=None, until=None, project=None, out_path=None):
+        """导出时间在 [since, until)（UTC 毫秒）内、项目名称包含 project 的消息，合并为一个 Markdown 文件
+
+        不改动清单和增量导出的文件。消息存储可用的会话按时间索引直接定位到匹配的消息，
+        清单中时间范围与筛选条件不重叠的未变化会话整个跳过。返回写出的文件路径。
+        """
+        if out_path is None:
+            out_path = self.output_dir / "filtered" / self.filtered_file_name(since, until, project)
+        out_path = Path(out_path)
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+
+        projects = [p for p in self.get_all_projects()
+                    if not project or project.lower() in p['name'].lower()]
+        files = self.manifest['files']
+        sessions = messages = 0
+        out = AtomicFile(out_path)
+        with self.metrics.stage('filter'), out as f:
+            f.write(self.generate_filtered_header(since, until, project))
+            for project_info in sorted(projects, key=lambda p: p['name']):
+                safe_name = project_info['name'].replace('/', '_').replace('\\', '_')
+                spill_dir = Path(os.path.relpath(self.output_dir / "sessions" / safe_name / "spill",
+                                                 out_path.parent)).as_posix()
+                spill = self.spill_writer(project_info['name'])
+                for jsonl_file in sorted(project_info['conversations']):
+                    if self.is_outside_time_range(jsonl_file, files.get(str(jsonl_file)), since, until):
+                        self.metrics.count('sessions_skipped')
+                        continue
+                    found = False
+                    hidden = None
+                    for seq, conv in iter_time_range(jsonl_file, self.store_path(jsonl_file), since, until,
+                                                     block_cap=self.block_cap, spill=spill):
+                        # 与完整导出相同，未采用分支中的消息按 branches 跳过或注明
+                        if hidden is None:
+                            hidden = session_view(jsonl_file, self.store_path(jsonl_file),
+                                                  block_cap=self.block_cap).hidden
+                        if not self.show_message(seq, conv, hidden):
+                            continue
+                        if not found:
+                            f.write(f"# {project_info['name']}\n\n会话: {jsonl_file.stem}\n\n---\n\n")
+                            sessions += 1
+                            found = True
+                        self.write_message_markdown(f, seq, conv, spill_dir)
+                        messages += 1
+        self.count_written(out)
+        print(f"Exported {messages} messages from {sessions} sessions to {out_path}")
+        return out_path
+
+    def is_outside_time_range(self, jsonl_file, entry, since, until):
+        """清单记录的会话时间范围是否与 [since, until) 不重叠（仅用于自上次导出后未变化的会话）"""
+        bounds = entry.get('time_range') if entry else None
+        if not bounds or not self.is_session_unchanged(jsonl_file, entry):
+            return False
+        first, last = bounds
+        return (since is not None and last < since) or (until is not None and first >= until)
+
+    def filtered_file_name(self, since, until, project):
+        """筛选导出的默认文件名，由筛选条件组成"""
+        parts = ['history']
+        if since is not None:
+            parts.append(decode_time(since)[:10])
+        if until is not None:
+            parts.append('to-' + decode_time(until - 1)[:10])
+        if project:
+            parts.append(re.sub(r'[^\w.-]+', '_', project))
+        return '-'.join(parts) + '.md'
+
+    def generate_filtered_header(self, since, until, project):
+        """生成筛选导出的 Markdown 表头"""
+        md = "# Claude 对话历史\n\n"
+        if since is not None or until is not None:
+            start = self.format_timestamp(decode_time(since)) if since is not None else "最早"
+            end = self.format_timestamp(decode_time(until)) if until is not None else "现在"
+            md += f"时间范围: {start} 至 {end}（UTC，不含结束时间）\n\n"
+        if project:
+            md += f"项目: 名称包含 \"{project}\"\n\n"
+        md += "---\n\n"
+        return md
+
+    def write_metrics(self, path=None):
+        """--profile 时写出本次运行的性能报告，并在终端显示摘要"""
+        if not self.metrics.enabled:
+            return None
+        if path is None:
+            path = self.output_dir / "metrics" / f"export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        report = self.metrics.write(Path(path), jobs=self.jobs)
+        print("Profile:")
+        for line in format_report(report):
+            print(f"  {line}")
+        print(f"Metrics written to: {path}")
+        return path
+
+    def build_project_info(self, project, jsonl_file, entry):
+        """索引页中一个会话卡片的信息"""
+        # 获取最后更新时间
+        last_time = "Unknown"
+        if entry['last_timestamp']:
+            last_time = self.format_timestamp(entry['last_timestamp'])
+
+        return {
+            'name': project['name'],
+            'display_name': self.clean_project_name(project['name']),
+            'filename': self.session_link(project['name'], jsonl_file.stem),
+            'count': entry['count'],
+            'summary': entry['summary'] or "No content",
+            'last_updated': last_time
+        }
+
+    def write_index_html(self, projects_info):
+        """写出 index.html 并返回其路径"""
+        index_path = self.output_dir / "index.html"
+        if write_if_changed(index_path, self.generate_index_html(projects_info)):
+            self.metrics.count('files_written')
+        return index_path
+
+    def refresh_index(self):
+        """只刷新 index.html，不写会话文件和全文索引
+
+        会话信息优先取自导出清单，其次取自索引缓存；有变化的会话只解析新增部分，
+        结果存入索引缓存，下次完整导出不受影响。
+        """
+        projects = self.get_all_projects()
+        if not projects:
+            print("No projects found!")
+            return
+
+        files = self.manifest['files']
+        entries, reread = self.summarize_sessions(projects, self.load_index_cache())
+        self.refresh_stats(projects, entries)
+        projects_info = self.build_projects_info(projects, entries)
+        index_path = self.write_index_html(projects_info)
+
+        # 只缓存清单中没有的（或比清单更新的）记录
+        self.save_json(self.index_cache_path, {
+            'version': MANIFEST_VERSION,
+            'files': {key: entry for key, entry in entries.items() if entry is not files.get(key)},
+        })
+        print(f"Index refreshed: {len(projects_info)} sessions, {reread} re-read ({index_path})")
+        return index_path
+
+    def refresh_stats(self, projects, entries):
+        """由保存的汇总表按 entries 更新内存中的用量（不保存），索引页的图表与完整导出一致
+
+        每次都从保存的汇总表重新开始，可反复调用（serve 模式每次渲染索引页时）。
+        """
+        files = self.manifest['files']
+        self.stats = None
+        stats = self.get_stats()
+        for project in projects:
+            for jsonl_file in project['conversations']:
+                key = str(jsonl_file)
+                old_usage = files[key].get('usage') if key in files else None
+                if entries[key].get('usage') != old_usage:
+                    stats.apply(project['name'], old_usage or {}, -1)
+                    stats.apply(project['name'], entries[key].get('usage') or {})
+        for key in files.keys() - entries.keys():
+            stats.apply(Path(key).parent.name, files[key].get('usage') or {}, -1)
+        stats.prune()
+
+    def summarize_sessions(self, projects, cache):
+        """取得所有会话的索引页信息
+
+        优先使用导出清单，其次使用 cache 中的记录，都已过期的会话增量解析。
+        返回 ({会话文件路径: 记录}, 重新读取的会话数)。
+        """
+        files = self.manifest['files']
+        entries = {}
+        tasks = []
+        for project in projects:
+            for jsonl_file in sorted(project['conversations']):
+                key = str(jsonl_file)
+                entry = files.get(key)
+                if not self.is_session_unchanged(jsonl_file, entry):
+                    entry = cache.get(key, entry)
+                if self.is_session_unchanged(jsonl_file, entry):
+                    entries[key] = entry
+                else:
+                    tasks.append((jsonl_file, entry))
+        for (jsonl_file, _), entry in zip(tasks, self.run_tasks('summarize_session', tasks)):
+            entries[str(jsonl_file)] = entry
+        return entries, len(tasks)
+
+    def build_projects_info(self, projects, entries):
+        """按项目和会话顺序生成索引页的全部会话卡片，跳过空会话"""
+        return [
+            self.build_project_info(project, jsonl_file, entries[str(jsonl_file)])
+            for project in projects for jsonl_file in sorted(project['conversations'])
+            if entries[str(jsonl_file)]['count']
+        ]
+
+# 进程池中每个工作进程持有的管理器副本
+_worker_manager = None
+
+def _init_worker(payload):
+    global _worker_manager
+    _worker_manager = pickle.loads(payload)
+    _worker_manager.stage_search = True
+
+def _run_worker_task(method_name, args):
+    metrics = _worker_manager.metrics
+    metrics.reset()
+    # 工作进程的 stdout 不经过主进程（例如 auto-backup 的日志），输出随结果传回
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            result = getattr(_worker_manager, method_name)(*args)
+    except BaseException:
+        # 出错时异常传回主进程，已有的输出留在工作进程的 stdout
+        sys.stdout.write(output.getvalue())
+        raise
+    return result, metrics.snapshot() if metrics.enabled else None, output.getvalue()
+
+def _collect_until(futures, deadline):
+    """按顺序取出任务结果；过了 deadline 后取消尚未开始的任务，它们的结果为 None
+
+    已开始或已完成的任务照常取回结果，其输出已经写出，不能丢弃。
+    """
+    expired = False
+    for i, future in enumerate(futures):
+        if not expired and i and time.monotonic() >= deadline:
+            expired = True
+            for pending in futures[i:]:
+                pending.cancel()
+        yield None if future.cancelled() else future.result()
+
+def print_search_results(manager, query, limit, project):
+    """在终端中输出全文检索结果"""
+    index = manager.get_search_index()
+    if not index:
+        return
+
+    started = datetime.now()
+    hits = index.search(query, limit=limit, project=project)
+    elapsed = (datetime.now() - started).total_seconds() * 1000
+
+    print(f"Found {len(hits)} results for \"{query}\" ({elapsed:.1f} ms)\n")
+    for hit in hits:
+        role = "👤 用户" if hit['role'] == 'user' else "🤖 Claude"
+        timestamp = manager.format_timestamp(hit['timestamp']) if hit['timestamp'] else ''
+        print(f"[{manager.clean_project_name(hit['project'])}] {hit['session']} #{hit['seq']}")
+        print(f"  {timestamp}  {role}")
+        print(f"  {hit['snippet']}\n")
+
+def print_stats(manager, by, days):
+    """在终端中输出按天、项目或模型汇总的用量"""
+    stats = manager.get_stats()
+    if not stats.series:
+        print("No usage statistics yet, run an export first")
+        return
+
+    if by == 'day':
+        rows = [(day.isoformat(), row) for day, row in stats.daily()[-days:]]
+        label = "Date"
+    else:
+        totals = stats.totals('p:' if by == 'project' else 'm:')
+        rows = sorted(totals.items(), key=lambda item: (-(item[1][3] + item[1][4]), item[0]))
+        if by == 'project':
+            rows = [(manager.clean_project_name(name), row) for name, row in rows]
+        label = by.capitalize()
+
+    headers = [label, "User", "Assistant", "Requests", "Input", "Output", "Cache read", "Cache write"]
+    width = max([len(headers[0])] + [len(name) for name, _ in rows])
+    print(f"{headers[0]:<{width}}" + "".join(f"{h:>12}" for h in headers[1:]))
+    for name, row in rows:
+        print(f"{name:<{width}}" + "".join(f"{value:>12,}" for value in row))
+    total = [sum(row[i] for _, row in rows) for i in range(len(METRICS))]
+    print(f"{'Total':<{width}}" + "".join(f"{value:>12,}" for value in total))
+
+def since_arg(value):
+    """--since 的参数类型"""
+    try:
+        return parse_time(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+
+def until_arg(value):
+    """--until 的参数类型：只写日期时包含当天"""
+    try:
+        return parse_time(value, end=True)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {value}")
+
+
 def main():
-    manager = ClaudeHistoryManager()
-    index_path = manager.export_all()
+    parser = argparse.ArgumentParser(description="Claude 对话历史管理器")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1,
+                        help="并行导出使用的进程数，1 表示顺序执行；输出与顺序执行时完全相同（默认: CPU 核数）")
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('export', help="导出所有对话历史（默认）")
+    search_parser = subparsers.add_parser('search', help="全文检索已导出的对话")
+    search_parser.add_argument('query', help="检索词，多个词之间为“且”关系")
+    search_parser.add_argument('-n', '--limit', type=int, default=20, help="最多显示的结果数")
+    search_parser.add_argument('-p', '--project', help="只检索名称包含该字符串的项目")
+    stats_parser = subparsers.add_parser('stats', help="显示按天、项目或模型汇总的消息数和 token 用量")
+    stats_parser.add_argument('--by', choices=('day', 'project', 'model'), default='day',
+                              help="汇总方式（默认: day）")
+    stats_parser.add_argument('--days', type=int, default=30, help="按天显示时显示最近多少天（默认: 30）")
+    serve_parser = subparsers.add_parser('serve', help="启动本地服务，按需渲染索引页和会话页面")
+    serve_parser.add_argument('--host', default='127.0.0.1', help="监听地址（默认: 127.0.0.1）")
+    serve_parser.add_argument('--port', type=int, default=8765, help="监听端口（默认: 8765，0 为随机端口）")
+    serve_parser.add_argument('--cache-size', type=int, default=128, help="缓存的渲染页面数（默认: 128）")
+    parser.add_argument('--only', nargs='+', metavar='JSONL',
+                        help="只重新导出这些会话文件，其余沿用上次的结果")
+    parser.add_argument('--no-browser', action='store_true', help="导出后不自动打开浏览器")
+    parser.add_argument('--html', action='store_true',
+                        help="同时为每个会话生成分页 HTML，索引页链接到 HTML 而非 Markdown")
+    parser.add_argument('--index-only', action='store_true',
+                        help="只刷新 index.html（会话数量、摘要、时间），不写会话文件和全文索引")
+    parser.add_argument('--rerender', action='store_true',
+                        help="由消息存储重新生成所有会话文件（修改模板后使用），不重新解析 JSONL")
+    parser.add_argument('--block-cap', type=int, default=DEFAULT_BLOCK_CAP, metavar='BYTES',
+                        help="工具调用、工具结果、思考过程每块最多显示的字节数，"
+                             f"超出部分另存为压缩文件（默认: {DEFAULT_BLOCK_CAP}）")
+    parser.add_argument('--branches', choices=BRANCH_MODES, default='active',
+                        help="重试或编辑消息后留下的未采用分支：active 只显示当前分支（默认），"
+                             "all 全部显示并注明分出处")
+    parser.add_argument('--profile', nargs='?', const='', metavar='FILE',
+                        help="记录各阶段耗时、读写量和峰值内存，写出 JSON 报告"
+                             "（默认: 输出目录/metrics/export-时间.json）")
+    parser.add_argument('--since', type=since_arg, metavar='TIME',
+                        help="只导出该时间之后的消息，合并为一个 Markdown 文件"
+                             "（2026-10-01、2026-10-01T08:00、7d、12h；不带时区时为 UTC）")
+    parser.add_argument('--until', type=until_arg, metavar='TIME',
+                        help="只导出该时间之前的消息（只写日期时包含当天）")
+    parser.add_argument('--project', dest='filter_project', metavar='NAME',
+                        help="只导出名称包含该字符串的项目，合并为一个 Markdown 文件")
+    parser.add_argument('--out', metavar='FILE',
+                        help="筛选导出的文件（默认: 输出目录/filtered/ 下按筛选条件命名）")
+    parser.add_argument('--claude-dir', action='append',
+                        help="Claude 数据目录（默认: ~/.claude）；可多次指定，合并多台电脑同步来的历史")
+    parser.add_argument('--output-dir', help="输出目录（默认: ~/Documents/Claude History）")
+    args = parser.parse_args()
+
+    manager = ClaudeHistoryManager(jobs=args.jobs, claude_dir=args.claude_dir, output_dir=args.output_dir,
+                                   html_pages=args.html or args.command == 'serve',
+                                   profile=args.profile is not None, block_cap=args.block_cap,
+                                   branches=args.branches)
+
+    if args.command == 'search':
+        print_search_results(manager, args.query, args.limit, args.project)
+        return
+
+    if args.command == 'stats':
+        print_stats(manager, args.by, args.days)
+        return
+
+    if args.command == 'serve':
+        from history_server import serve
+        import webbrowser
+        serve(manager, args.host, args.port, args.cache_size,
+              on_ready=None if args.no_browser else webbrowser.open)
+        return
+
+    if args.since is not None or args.until is not None or args.filter_project:
+        manager.export_filtered(args.since, args.until, args.filter_project, args.out)
+        manager.write_metrics(args.profile or None)
+        return
+
+    if args.index_only:
+        with manager.metrics.stage('index'):
+            index_path = manager.refresh_index()
+    else:
+        index_path = manager.export_all(only=args.only, rerender=args.rerender)
+    manager.write_metrics(args.profile or None)
 
     # 自动打开浏览器
-    if index_path:
+    if index_path and not args.no_browser:
         import webbrowser
         webbrowser.open(f'file:///{index_path}')
 
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 原始对话历史归档
+按内容寻址、压缩存储 ~/.claude/projects 下的原始文件，并保存时间点快照
+"""
+
+import hashlib
+import json
+import os
+import time
+import zlib
+from datetime import datetime
+from pathlib import Path
+
+from history_output import temp_file
+
+# 数据块的最大长度；只追加写入的会话文件再次归档时，之前的块全部复用，新增的部分另成新块
+CHUNK_SIZE = 1024 * 1024
+
+COMPRESS_LEVEL = 6
+
+# 快照名称中时间部分（%Y%m%d-%H%M%S）的长度，同一秒内的多次快照在其后加补零的序号
+STAMP_LENGTH = 15
+
+# 清理时不删除最近修改过的数据块：可能属于正在创建、尚未保存清单的快照
+PRUNE_GRACE_SECONDS = 3600
+
+
+def snapshot_key(name):
+    """快照名称的排序键：先按时间，再按同一秒内的序号数值（旧版的序号未补零）"""
+    counters = name[STAMP_LENGTH + 1:].split('-') if len(name) > STAMP_LENGTH else []
+    return name[:STAMP_LENGTH], tuple(int(c) if c.isdigit() else 0 for c in counters)
+
+
+def record_sizes(record, chunk_size):
+    """文件记录中各块的长度；旧版记录没有 sizes，按固定大小切块推算"""
+    if 'sizes' in record:
+        return record['sizes']
+    sizes = [chunk_size] * len(record['chunks'])
+    if sizes:
+        sizes[-1] = record['size'] - chunk_size * (len(sizes) - 1)
+    return sizes
+
+
+class HistoryArchive:
+    """内容寻址的块存储加快照清单
+
+    archive_dir/chunks/ab/<sha256>  zlib 压缩的数据块
+    archive_dir/snapshots/<时间>.json  某一时刻每个文件的大小、修改时间、块列表和各块长度
+    """
+
+    def __init__(self, archive_dir, chunk_size=CHUNK_SIZE):
+        self.archive_dir = Path(archive_dir)
+        self.chunks_dir = self.archive_dir / "chunks"
+        self.snapshots_dir = self.archive_dir / "snapshots"
+        self.chunk_size = chunk_size
+
+    def list_snapshots(self):
+        """按时间顺序返回所有快照名称"""
+        if not self.snapshots_dir.exists():
+            return []
+        return sorted((path.stem for path in self.snapshots_dir.glob("*.json")), key=snapshot_key)
+
+    def load_snapshot(self, name):
+        with open(self.snapshots_dir / f"{name}.json", 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def chunk_path(self, digest):
+        return self.chunks_dir / digest[:2] / digest
+
+    def store_chunk(self, data, stats):
+        """保存一个数据块，已存在则跳过，返回其 sha256"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if path.exists():
+            # 复用的块更新修改时间，同时进行的清理不会删除它
+            os.utime(path)
+            return digest
+        path.parent.mkdir(parents=True, exist_ok=True)
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        f = temp_file(path)
+        try:
+            with f:
+                f.write(compressed)
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+        stats['chunks'] += 1
+        stats['bytes'] += len(compressed)
+        return digest
+
+    def store_file(self, path, st, prev, stats):
+        """归档单个文件并返回其快照记录
+
+        只追加的文件沿用上次的全部块，只读取和存储新增的字节；其余文件从头切块。
+        """
+        chunks, sizes = [], []
+        start = 0
+        with open(path, 'rb') as f:
+            if prev and prev['chunks'] and prev['inode'] == st.st_ino and st.st_size > prev['size'] \
+                    and self.is_append_only(f, prev):
+                chunks, sizes = list(prev['chunks']), list(prev['sizes'])
+                start = prev['size']
+            f.seek(start)
+
+            size = start
+            while True:
+                data = f.read(self.chunk_size)
+                if not data:
+                    break
+                chunks.append(self.store_chunk(data, stats))
+                sizes.append(len(data))
+                size += len(data)
+
+        # 大小按实际读到的字节记录；读取期间文件又有写入时，下次会再归档
+        return {'inode': st.st_ino, 'size': size, 'mtime': st.st_mtime, 'chunks': chunks, 'sizes': sizes}
+
+    def is_append_only(self, f, prev):
+        """上次记录的首块和末块内容都未变时，视为文件只在末尾追加过"""
+        sizes = prev['sizes']
+        f.seek(prev['size'] - sizes[-1])
+        if hashlib.sha256(f.read(sizes[-1])).hexdigest() != prev['chunks'][-1]:
+            return False
+        if len(sizes) > 1:
+            f.seek(0)
+            if hashlib.sha256(f.read(sizes[0])).hexdigest() != prev['chunks'][0]:
+                return False
+        return True
+
+    def snapshot(self, source_dir):
+        """为 source_dir 下的所有文件创建快照
+
+        大小和修改时间未变的文件直接沿用上次的记录，不读取内容。
+        没有任何变化时不创建快照，返回 (None, 统计)。
+        """
+        source_dir = Path(source_dir)
+        snapshots = self.list_snapshots()
+        base = {}
+        if snapshots:
+            last = self.load_snapshot(snapshots[-1])
+            base = last['files']
+            for record in base.values():
+                record['sizes'] = record_sizes(record, last.get('chunk_size', CHUNK_SIZE))
+
+        files = {}
+        stats = {'files': 0, 'changed': 0, 'chunks': 0, 'bytes': 0}
+        for path in sorted(source_dir.rglob("*")):
+            if not path.is_file():
+                continue
+            rel = path.relative_to(source_dir).as_posix()
+            st = path.stat()
+            prev = base.get(rel)
+            stats['files'] += 1
+            if prev and prev['inode'] == st.st_ino and prev['size'] == st.st_size \
+                    and prev['mtime'] == st.st_mtime:
+                files[rel] = prev
+                continue
+            try:
+                files[rel] = self.store_file(path, st, prev, stats)
+            except OSError:
+                # 归档过程中被删除的文件
+                continue
+            stats['changed'] += 1
+
+        if files == base:
+            return None, stats
+
+        name = self.next_snapshot_name(snapshots)
+        self.snapshots_dir.mkdir(parents=True, exist_ok=True)
+        path = self.snapshots_dir / f"{name}.json"
+        f = temp_file(path, 'w', encoding='utf-8')
+        try:
+            with f:
+                json.dump({
+                    'created': datetime.now().isoformat(timespec='seconds'),
+                    'source': str(source_dir),
+                    'chunk_size': self.chunk_size,
+                    'files': files,
+                }, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(f.name, path)
+        except BaseException:
+            os.unlink(f.name)
+            raise
+        return name, stats
+
+    def next_snapshot_name(self, snapshots):
+        """新快照的名称，按 snapshot_key 排在已有快照之后
+
+        同一秒内（或时钟回拨后）接着最后一个快照的时间加补零的序号，字典序与时间顺序一致。
+        """
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        if not snapshots:
+            return stamp
+        last_stamp, counters = snapshot_key(snapshots[-1])
+        if stamp > last_stamp:
+            return stamp
+        return f"{last_stamp}-{(counters[0] if counters else 0) + 1:04d}"
+
+    def prune(self, keep=None):
+        """只保留最近的 keep 个快照（None 时全部保留），并删除不再被任何快照引用的数据块
+
+        返回 (删除的快照数, 删除的数据块数)。最近修改过的块和临时文件留到以后再清理。
+        """
+        snapshots = self.list_snapshots()
+        removed_snapshots = 0
+        if keep is not None and len(snapshots) > keep:
+            for name in snapshots[:len(snapshots) - keep]:
+                (self.snapshots_dir / f"{name}.json").unlink()
+                removed_snapshots += 1
+            snapshots = snapshots[len(snapshots) - keep:]
+
+        referenced = set()
+        for name in snapshots:
+            for record in self.load_snapshot(name)['files'].values():
+                referenced.update(record['chunks'])
+        removed_chunks = 0
+        cutoff = time.time() - PRUNE_GRACE_SECONDS
+        for path in self.chunks_dir.glob('*/*') if self.chunks_dir.exists() else ():
+            if path.name in referenced:
+                continue
+            try:
+                if path.stat().st_mtime < cutoff:
+                    path.unlink()
+                    removed_chunks += 1
+            except FileNotFoundError:
+                pass
+        return removed_snapshots, removed_chunks
+
+    def restore(self, name, target_dir):
+        """将快照中的所有文件还原到 target_dir，返回还原的文件数"""
+        snapshot = self.load_snapshot(name)
+        target_dir = Path(target_dir)
+        if target_dir.exists() and any(target_dir.iterdir()):
+            raise FileExistsError(f"Restore target is not empty: {target_dir}")
+
+        for rel, record in snapshot['files'].items():
+            path = target_dir / rel
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with open(path, 'wb') as f:
+                for digest in record['chunks']:
+                    with open(self.chunk_path(digest), 'rb') as chunk:
+                        data = zlib.decompress(chunk.read())
+                    if hashlib.sha256(data).hexdigest() != digest:
+                        raise ValueError(f"Corrupted archive chunk: {digest}")
+                    f.write(data)
+            os.utime(path, (record['mtime'], record['mtime']))
+        return len(snapshot['files'])
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史的多数据目录合并
+同一会话出现在多个数据目录（例如从几台电脑同步来的 ~/.claude）中时，按时间对各副本的记录
+做流式多路归并，按 uuid 去掉重复的记录，写成一个 JSONL 文件。各副本只顺序读一遍，
+内存占用只与副本数和去重窗口有关，与会话长度无关。
+"""
+
+import hashlib
+import heapq
+import os
+from collections import OrderedDict
+from operator import itemgetter
+
+from history_output import temp_file
+from history_parser import iter_lines, json_loads
+from history_store import timestamp_ms
+
+# 去重时记住的最近记录数：各副本中相同的记录时间相同，归并后彼此相邻，只需比较附近的记录
+DEDUP_WINDOW = 4096
+
+
+def iter_records(path):
+    """逐行产出 (时间, 去重键, 行)
+
+    去重键为记录的 uuid，没有 uuid 的记录（如摘要）为整行的哈希。没有时间的记录沿用
+    前一条的时间，归并后仍跟在它后面。仍在写入的最后一行不产出，留到下次。
+    """
+    last_time = 0
+    with open(path, 'rb') as f:
+        for line, complete in iter_lines(f):
+            if not complete:
+                break
+            if not line.strip():
+                continue
+            try:
+                data = json_loads(line)
+            except ValueError:
+                data = None
+            uuid = timestamp = None
+            if isinstance(data, dict):
+                uuid, timestamp = data.get('uuid'), data.get('timestamp')
+            ms = timestamp_ms(timestamp) if isinstance(timestamp, str) else None
+            if ms is not None:
+                last_time = ms
+            key = uuid if isinstance(uuid, str) and uuid else hashlib.sha1(line).digest()
+            yield last_time, key, line
+
+
+class MergedFile:
+    """写出归并结果：与已有文件相同的前缀不重写
+
+    新内容只是在已有文件末尾增加时原地追加，会话仍可按偏移增量解析；
+    其他变化写入临时文件后原子替换。结束后 status 为 'unchanged'、'appended' 或 'rewritten'。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = None
+        self.status = 'unchanged'
+        self.matched = 0
+        self.old = None
+        self.out = None
+
+    def __enter__(self):
+        try:
+            self.old = open(self.path, 'rb')
+        except FileNotFoundError:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+        return self
+
+    def write(self, data):
+        if self.out is None:
+            old = self.old.read(len(data)) if self.old else b''
+            if old == data:
+                self.matched += len(data)
+                return
+            if self.old and not old:
+                # 已有内容全部相同，之后的都是新增
+                self.old.close()
+                self.old = None
+                self.out = open(self.path, 'ab')
+                self.status = 'appended'
+            else:
+                self.start_rewrite()
+        self.out.write(data)
+
+    def start_rewrite(self):
+        """改为写临时文件（每次唯一命名，同时归并同一会话的进程互不干扰），先复制已比较过的相同前缀"""
+        self.out = temp_file(self.path)
+        self.tmp_path = self.out.name
+        self.status = 'rewritten'
+        if self.old:
+            self.old.seek(0)
+            remaining = self.matched
+            while remaining:
+                chunk = self.old.read(min(remaining, 1024 * 1024))
+                self.out.write(chunk)
+                remaining -= len(chunk)
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None and self.out is None and self.old and self.old.read(1):
+                # 已有文件比新内容长，截掉多余的部分
+                self.start_rewrite()
+        finally:
+            if self.old:
+                self.old.close()
+            if self.out:
+                self.out.close()
+        if self.status == 'rewritten':
+            if exc_type is not None:
+                os.unlink(self.tmp_path)
+                return False
+            try:
+                os.replace(self.tmp_path, self.path)
+            except OSError:
+                os.unlink(self.tmp_path)
+                raise
+        return False
+
+
+def merge_files(sources, target):
+    """将同一会话的多个副本按时间归并写入 target，返回 (写出方式, 去掉的重复记录数)
+
+    同一毫秒内的记录无法区分先后，按 sources 的顺序排列。
+    """
+    seen = OrderedDict()
+    duplicates = 0
+    with MergedFile(target) as out:
+        for _, key, line in heapq.merge(*map(iter_records, sources), key=itemgetter(0)):
+            if key in seen:
+                seen.move_to_end(key)
+                duplicates += 1
+                continue
+            seen[key] = None
+            if len(seen) > DEDUP_WINDOW:
+                seen.popitem(last=False)
+            out.write(line + b'\n')
+    return out.status, duplicates
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史导出的性能统计
+各阶段耗时、计数器和峰值内存，--profile 时写出 JSON 报告
+"""
+
+import json
+import platform
+import sys
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def peak_rss_bytes():
+    """返回当前进程（含已结束子进程）的峰值内存，无法获取时返回 None"""
+    try:
+        import resource
+    except ImportError:
+        resource = None
+
+    if resource:
+        # Linux 单位为 KB，macOS 为字节
+        scale = 1 if sys.platform == 'darwin' else 1024
+        own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        return max(own, children) * scale
+
+    if sys.platform == 'win32':
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD),
+                ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+    return None
+
+
+class Metrics:
+    """阶段计时与计数器；未启用时所有操作都是空操作
+
+    计数器在工作进程中累加后随任务结果传回主进程合并；
+    阶段耗时只在主进程中按墙钟时间记录，并行阶段不会重复计算。
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.counters = defaultdict(int)
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.counters[name] += n
+
+    def record_stream(self, stream, start_offset):
+        """累加一次 history_parser.MessageStream 读取的字节、行和消息数"""
+        if self.enabled:
+            counters = self.counters
+            counters['bytes_read'] += stream.offset - start_offset
+            counters['lines'] += stream.lines
+            counters['records_decoded'] += stream.decoded
+            counters['records_skipped'] += stream.lines - stream.decoded
+            counters['messages'] += stream.messages
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - started
+
+    def reset(self):
+        self.counters.clear()
+
+    def snapshot(self):
+        return dict(self.counters)
+
+    def merge(self, counters):
+        for name, n in counters.items():
+            self.counters[name] += n
+
+    def report(self, **extra):
+        """汇总为可写出 JSON 的报告，包含解析吞吐和峰值内存"""
+        total = time.perf_counter() - self.started
+        counters = dict(self.counters)
+        parse_seconds = self.stages.get('parse', 0.0)
+        throughput = {}
+        if parse_seconds > 0:
+            throughput = {
+                'parse_mb_per_s': counters.get('bytes_read', 0) / 1024 / 1024 / parse_seconds,
+                'parse_messages_per_s': counters.get('messages', 0) / parse_seconds,
+            }
+        return dict({
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'total_seconds': total,
+            'stages': self.stages,
+            'counters': counters,
+            'throughput': throughput,
+            'peak_rss_bytes': peak_rss_bytes(),
+        }, **extra)
+
+    def write(self, path, **extra):
+        """写出 JSON 报告并返回报告内容"""
+        report = self.report(**extra)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=1)
+        return report
+
+
+def format_report(report):
+    """将报告格式化为终端中显示的几行摘要"""
+    lines = [f"Total {report['total_seconds']:.2f}s: " + ', '.join(
+        f"{name} {seconds:.2f}s" for name, seconds in report['stages'].items())]
+    counters = report['counters']
+    if counters:
+        lines.append(', '.join(f"{name} {n:,}" for name, n in sorted(counters.items())))
+    if report['throughput']:
+        lines.append(f"Parse {report['throughput']['parse_mb_per_s']:.1f} MB/s, "
+                     f"{report['throughput']['parse_messages_per_s']:,.0f} messages/s")
+    if report['peak_rss_bytes']:
+        lines.append(f"Peak memory {report['peak_rss_bytes'] / 1024 / 1024:.1f} MB")
+    return lines
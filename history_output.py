@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史导出的文件写出
+先写临时文件再原子替换，读者不会看到写了一半的文件；内容与已有文件相同时不替换，
+文件修改时间保持不变，同步工具和浏览器缓存都不会因此失效
+"""
+
+import filecmp
+import hashlib
+import os
+import tempfile
+
+# 流式读写时使用的缓冲区大小
+STREAM_BUFFER_SIZE = 256 * 1024
+
+
+def _default_mode():
+    """新建文件的默认权限（按当前 umask）"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+FILE_MODE = _default_mode()
+
+
+def temp_file(path, mode='wb', **kwargs):
+    """在 path 所在目录新建唯一命名的临时文件，同时写同一目标的多个进程互不干扰
+
+    NamedTemporaryFile 建出的文件只有属主可读，改回普通文件的默认权限。
+    """
+    f = tempfile.NamedTemporaryFile(mode, dir=path.parent, prefix=f'.{path.name}.', suffix='.tmp',
+                                    delete=False, **kwargs)
+    try:
+        os.chmod(f.name, FILE_MODE)
+    except OSError:
+        pass
+    return f
+
+
+def file_digest(path):
+    """返回文件内容的 sha1，文件不存在时返回 None"""
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(STREAM_BUFFER_SIZE), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def write_if_changed(path, data):
+    """内容哈希与已有文件不同时原子写出 data（str 或 bytes），返回是否写出"""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = None
+    if size == len(data) and file_digest(path) == hashlib.sha1(data).hexdigest():
+        return False
+    f = temp_file(path)
+    try:
+        with f:
+            f.write(data)
+        os.replace(f.name, path)
+    except BaseException:
+        os.unlink(f.name)
+        raise
+    return True
+
+
+class AtomicFile:
+    """流式写出大文件：写入临时文件，关闭时与已有文件比较，不同才替换
+
+    with AtomicFile(path) as f: ... 之后 changed 表示是否替换了目标文件，size 为写出的字节数。
+    写入过程中出错时丢弃临时文件，目标文件保持原样。
+    """
+
+    def __init__(self, path, buffering=STREAM_BUFFER_SIZE):
+        self.path = path
+        self.tmp_path = None
+        self.buffering = buffering
+        self.changed = False
+        self.size = 0
+
+    def __enter__(self):
+        self.file = temp_file(self.path, 'w', encoding='utf-8', buffering=self.buffering)
+        self.tmp_path = self.file.name
+        return self.file
+
+    def __exit__(self, exc_type, exc, tb):
+        self.file.close()
+        if exc_type is not None:
+            os.unlink(self.tmp_path)
+            return False
+        self.size = os.path.getsize(self.tmp_path)
+        try:
+            same = os.path.getsize(self.path) == self.size \
+                and filecmp.cmp(self.tmp_path, self.path, shallow=False)
+        except OSError:
+            same = False
+        if same:
+            os.unlink(self.tmp_path)
+        else:
+            try:
+                os.replace(self.tmp_path, self.path)
+            except OSError:
+                os.unlink(self.tmp_path)
+                raise
+            self.changed = True
+        return False
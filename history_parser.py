@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史解析
+view-history.py 与 claude-history-manager.py 共用的流式 JSONL 消息读取
+"""
+
+import hashlib
+import json
+
+# 安装了 orjson 时用它解码 JSON，速度更快
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
+
+# 读取 JSONL 时每次读入的字节数
+READ_CHUNK_SIZE = 1024 * 1024
+
+# 可能产出消息的记录必然包含的字节串：角色取值，以及 text 内容块或纯文本的用户输入
+ROLE_MARKERS = (b'"user"', b'"assistant"')
+TEXT_MARKER = b'"text"'
+USER_STRING_MARKERS = (b'"role":"user","content":"', b'"role": "user", "content": "')
+# 带 token 用量的助手记录必然包含的字节串
+USAGE_MARKER = b'"usage"'
+# 完整内容模式下还需解析的内容块类型
+BLOCK_MARKERS = (b'"tool_use"', b'"tool_result"', b'"thinking"', b'"image"')
+
+DEFAULT_ROLES = ('user', 'assistant')
+
+# 正文达到该字符数的消息参与去重，重复出现时只输出对首次出现的引用
+INTERN_MIN_SIZE = 1024
+
+# 完整内容模式下工具调用、工具结果和思考过程每块保留的字节数，超出部分交给 spill 另存
+DEFAULT_BLOCK_CAP = 16 * 1024
+
+
+class Message:
+    """一条用户/助手消息；offset 为该消息所在行之后的字节偏移，可用于断点续读
+
+    content 为所有文本块连接后的正文；完整内容模式下 blocks 为按原顺序排列的 Block 列表。
+    repeat_of 为正文与之相同的首条消息序号（经 BlockInterner 去重时设置）。
+    """
+
+    __slots__ = ('role', 'content', 'timestamp', 'offset', 'repeat_of', 'blocks', 'branch_of')
+
+    def __init__(self, role, content, timestamp, offset=0, blocks=None):
+        self.role = role
+        self.content = content
+        self.timestamp = timestamp
+        self.offset = offset
+        self.repeat_of = None
+        self.blocks = blocks
+        # 属于未采用的分支时为分出处的消息序号（见 history_thread）
+        self.branch_of = None
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {self.content[:30]!r}, {self.timestamp!r}, offset={self.offset})"
+
+
+class BlockInterner:
+    """会话内大段正文的内容哈希表 {摘要: 首次出现的消息序号}
+
+    重复贴入的文件、系统提醒等在同一会话中反复出现，按内容哈希识别后只保留首次出现的那一份。
+    blocks 可以是完整会话的哈希表，从任意消息序号（start 之后）开始判断都能得到相同结果。
+    keep_strings 时相同正文共享同一个字符串对象，内存占用只取决于不重复的内容。
+    """
+
+    def __init__(self, blocks=None, start=0, min_size=INTERN_MIN_SIZE, keep_strings=False):
+        self.blocks = dict(blocks or {})
+        self.seq = start
+        self.min_size = min_size
+        self.strings = {} if keep_strings else None
+
+    def add(self, message):
+        """为下一条消息编号；正文与之前的消息重复时设置并返回 repeat_of"""
+        self.seq += 1
+        content = message.content
+        if len(content) < self.min_size:
+            return None
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+        first = self.blocks.get(digest)
+        if first is None or first > self.seq:
+            self.blocks[digest] = first = self.seq
+        if self.strings is not None:
+            message.content = self.strings.setdefault(digest, content)
+        if first < self.seq:
+            message.repeat_of = first
+        return message.repeat_of
+
+
+class Block:
+    """一个内容块：type 为 text、thinking、tool_use、tool_result 或 image
+
+    title 为工具名称、图片类型等附加信息，error 表示工具执行出错；
+    text 超过字节上限时只保留开头，size 为原始字节数，spill 为另存的完整内容（由 spill 回调返回）。
+    """
+
+    __slots__ = ('type', 'text', 'title', 'error', 'size', 'spill')
+
+    def __init__(self, type, text, title='', error=False, size=0, spill=None):
+        self.type = type
+        self.text = text
+        self.title = title
+        self.error = error
+        self.size = size
+        self.spill = spill
+
+
+def tool_result_text(content):
+    """工具结果的内容可能是字符串，也可能是 text/image 块列表"""
+    if isinstance(content, str):
+        return content
+    parts = []
+    for item in content or []:
+        if isinstance(item, dict):
+            if item.get('type') == 'text':
+                parts.append(item.get('text', ''))
+            elif item.get('type') == 'image':
+                parts.append('[image]')
+    return '\n'.join(parts)
+
+
+def make_block(item, cap, spill):
+    """将 message.content 中的一项转换为 Block，无法识别时返回 None"""
+    kind = item.get('type')
+    if kind == 'text':
+        return Block('text', item.get('text', ''))
+    if kind == 'thinking':
+        text, title, error = item.get('thinking', ''), '', False
+    elif kind == 'tool_use':
+        text = json.dumps(item.get('input'), ensure_ascii=False, indent=1)
+        title, error = item.get('name', ''), False
+    elif kind == 'tool_result':
+        text, title, error = tool_result_text(item.get('content')), '', bool(item.get('is_error'))
+    elif kind == 'image':
+        source = item.get('source') or {}
+        return Block('image', '', source.get('media_type', ''))
+    else:
+        return None
+
+    data = text.encode('utf-8')
+    block = Block(kind, text, title, error, len(data))
+    if cap is not None and len(data) > cap:
+        # 超长内容只在内存中保留开头，完整内容交给 spill 另存
+        block.text = data[:cap].decode('utf-8', 'ignore')
+        if spill:
+            block.spill = spill(data)
+    return block
+
+
+def extract_message(data, blocks=False, block_cap=DEFAULT_BLOCK_CAP, spill=None):
+    """从一条 JSONL 记录中提取用户/助手消息，没有可显示的内容时返回 None
+
+    默认只提取文本；blocks 为真时同时提取工具调用、工具结果、思考过程等所有内容块，
+    只含这些块的记录也会产出消息。
+    """
+    role = data.get('type')
+    if role not in DEFAULT_ROLES:
+        return None
+
+    message = data.get('message') or {}
+    content = message.get('content', [])
+    items = None
+    if isinstance(content, str):
+        # 直接输入的用户消息是纯字符串
+        text = content
+        if blocks and text:
+            items = [Block('text', text)]
+    else:
+        texts = []
+        items = [] if blocks else None
+        for item in content:
+            if not isinstance(item, dict):
+                continue
+            if item.get('type') == 'text':
+                texts.append(item.get('text', ''))
+            if blocks:
+                block = make_block(item, block_cap, spill)
+                if block and (block.text or block.type == 'image' or block.type == 'tool_result'):
+                    items.append(block)
+        text = '\n\n'.join(t for t in texts if t)
+
+    if not text and not items:
+        return None
+    timestamp = data.get('timestamp')
+    return Message(role, text, timestamp if isinstance(timestamp, str) else '', blocks=items)
+
+
+def extract_usage(data):
+    """从助手记录中提取 (消息 id, 模型, 时间, usage 字典)，没有用量信息时返回 None
+
+    同一次 API 响应的多个内容块会各写一条记录，消息 id 相同，由调用方去重。
+    """
+    if data.get('type') != 'assistant':
+        return None
+    message = data.get('message') or {}
+    usage = message.get('usage')
+    if not isinstance(usage, dict):
+        return None
+    return message.get('id') or '', message.get('model') or '', data.get('timestamp', ''), usage
+
+
+def may_contain_message(line):
+    """用字节查找快速排除工具结果、附件、摘要等不会产出消息的记录"""
+    if TEXT_MARKER in line:
+        return ROLE_MARKERS[0] in line or ROLE_MARKERS[1] in line
+    return USER_STRING_MARKERS[0] in line or USER_STRING_MARKERS[1] in line
+
+
+def may_contain_blocks(line):
+    """完整内容模式下的预过滤：工具调用、工具结果、思考过程的记录也需要解析"""
+    if may_contain_message(line):
+        return True
+    if ROLE_MARKERS[0] in line or ROLE_MARKERS[1] in line:
+        for marker in BLOCK_MARKERS:
+            if marker in line:
+                return True
+    return False
+
+
+def iter_lines(f):
+    """按大块读取二进制文件并切分成行，产出 (不含换行符的行, 是否以换行结尾)"""
+    pending = []
+    while True:
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        lines = chunk.split(b'\n')
+        if len(lines) == 1:
+            # 超长行跨越多个块
+            pending.append(chunk)
+            continue
+        if pending:
+            pending.append(lines[0])
+            lines[0] = b''.join(pending)
+            pending = []
+        tail = lines.pop()
+        for line in lines:
+            yield line, True
+        if tail:
+            pending.append(tail)
+    if pending:
+        yield b''.join(pending), False
+
+
+class MessageStream:
+    """逐条产出会话消息的流式读取器
+
+    不在内存中保留整段对话；offset 记录已消费到的字节位置，
+    end_offset 可限制只读到某个位置为止。遍历结束后 lines、decoded、messages
+    分别为读取的行数、解码的 JSON 记录数和产出的消息数。
+    指定 on_usage 时，每条带用量的助手记录都以 (extract_usage 的结果, 该行之后的偏移) 调用它；
+    指定 interner（BlockInterner）时，产出的每条消息都经它去重。
+    blocks 为真时产出包含所有内容块的消息（见 extract_message），每块最多保留 block_cap 字节，
+    超出的块以完整内容的 UTF-8 字节调用 spill，返回值记入 Block.spill。
+    指定 on_record 时，每个完整的行都以 (解码后的记录或未解码时的 None, 原始行, 该行之后的偏移) 调用它，
+    在该行的消息产出之前。
+    """
+
+    def __init__(self, jsonl_path, start_offset=0, end_offset=None, roles=DEFAULT_ROLES, since=None,
+                 on_usage=None, interner=None, blocks=False, block_cap=DEFAULT_BLOCK_CAP, spill=None,
+                 on_record=None):
+        self.jsonl_path = jsonl_path
+        self.offset = start_offset
+        self.end_offset = end_offset
+        self.roles = frozenset(roles)
+        self.since = since
+        self.on_usage = on_usage
+        self.interner = interner
+        self.blocks = blocks
+        self.block_cap = block_cap
+        self.spill = spill
+        self.on_record = on_record
+        self.lines = self.decoded = self.messages = 0
+
+    def __iter__(self):
+        roles, since, end_offset, on_usage = self.roles, self.since, self.end_offset, self.on_usage
+        on_record = self.on_record
+        interner = self.interner
+        blocks, block_cap, spill = self.blocks, self.block_cap, self.spill
+        prefilter = may_contain_blocks if blocks else may_contain_message
+        # 计数先用局部变量累加，结束时（包括提前停止遍历）再写回
+        lines = decoded = messages = 0
+        # 只跳过无法解码或结构不符的行；读取文件和回调中的错误照常抛出，调用方不会记下读到一半的偏移
+        try:
+            with open(self.jsonl_path, 'rb', buffering=0) as f:
+                f.seek(self.offset)
+                for line, complete in iter_lines(f):
+                    if end_offset is not None and self.offset >= end_offset:
+                        break
+                    lines += 1
+                    message = usage = data = None
+                    if prefilter(line) or (on_usage and USAGE_MARKER in line):
+                        decoded += 1
+                        try:
+                            data = json_loads(line)
+                            if not isinstance(data, dict):
+                                raise ValueError("record is not an object")
+                            message = extract_message(data, blocks, block_cap, spill)
+                            if on_usage:
+                                usage = extract_usage(data)
+                        except (ValueError, TypeError, AttributeError) as e:
+                            if not complete:
+                                # 会话仍在写入，留到下次再解析
+                                break
+                            print(f"Warning: skipping malformed record in {self.jsonl_path} "
+                                  f"at byte {self.offset}: {e}")
+                            message = usage = data = None
+                    elif not complete:
+                        break
+                    self.offset += len(line) + (1 if complete else 0)
+                    if usage:
+                        on_usage(usage, self.offset)
+                    if on_record and complete:
+                        on_record(data, line, self.offset)
+                    # 时间戳为 ISO 8601 UTC 格式，可直接按字符串比较
+                    if message and message.role in roles \
+                            and (since is None or message.timestamp >= since):
+                        message.offset = self.offset
+                        messages += 1
+                        if interner:
+                            interner.add(message)
+                        yield message
+        finally:
+            self.lines += lines
+            self.decoded += decoded
+            self.messages += messages
+
+
+def iter_messages(jsonl_path, start_offset=0, end_offset=None, roles=DEFAULT_ROLES, since=None,
+                  on_usage=None, interner=None, blocks=False, block_cap=DEFAULT_BLOCK_CAP, spill=None,
+                  on_record=None):
+    """流式读取会话中的消息
+
+    从 start_offset 字节处开始，只产出 roles 中角色、时间不早于 since 的消息。
+    返回的迭代器在遍历后 offset 属性为已读取到的位置。
+    """
+    return MessageStream(jsonl_path, start_offset, end_offset, roles, since, on_usage, interner,
+                         blocks, block_cap, spill, on_record)
@@ -0,0 +1,486 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史全文检索
+基于 SQLite FTS5 的持久化倒排索引，随导出增量更新
+"""
+
+import json
+import re
+import sqlite3
+from itertools import groupby
+
+from history_output import write_if_changed
+
+# 中日韩文字（汉字、假名、谚文）按二元组切分，其他文字按单词切分
+CJK_CHARS = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\uac00-\ud7af'
+CJK_RE = re.compile(f'[{CJK_CHARS}]')
+TOKEN_RE = re.compile(f'[{CJK_CHARS}]+|[^\\W{CJK_CHARS}]+')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    project TEXT NOT NULL,
+    session TEXT NOT NULL,
+    offset INTEGER NOT NULL DEFAULT 0,
+    count INTEGER NOT NULL DEFAULT 0,
+    hidden_digest TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    content TEXT NOT NULL,
+    hidden INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS messages_session ON messages(session_id);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(tokens, content='');
+CREATE TABLE IF NOT EXISTS dirty_shards (key TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS dirty_docs (chunk INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS staged_sessions (
+    path TEXT PRIMARY KEY,
+    project TEXT NOT NULL,
+    session TEXT NOT NULL,
+    reset INTEGER NOT NULL,
+    offset INTEGER NOT NULL,
+    count INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS staged_messages (
+    path TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    content TEXT NOT NULL,
+    tokens TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS staged_messages_path ON staged_messages(path);
+"""
+
+# 旧版索引库缺少的列，打开时补上
+ADDED_COLUMNS = (
+    ('sessions', 'hidden_digest', 'TEXT'),
+    ('messages', 'hidden', 'INTEGER NOT NULL DEFAULT 0'),
+)
+
+# 每批写入的消息数；每批连同会话偏移一起提交，中断后可从批次边界继续
+BATCH_SIZE = 500
+
+# 浏览器端索引：每个文档分片包含的消息数，以及结果预览长度
+DOC_CHUNK_SIZE = 1000
+PREVIEW_LENGTH = 120
+
+
+def tokenize(text):
+    """将文本切分为索引词
+
+    中日韩文字连续段切为相邻二元组，并额外保留段尾单字，
+    保证任意单字都能以前缀方式命中；其他文字按单词小写切分。
+    """
+    for run in TOKEN_RE.findall(text.lower()):
+        if CJK_RE.match(run):
+            for i in range(len(run) - 1):
+                yield run[i:i + 2]
+            yield run[-1]
+        else:
+            yield run
+
+
+def shard_key(token):
+    """索引词所在的分片：中日韩文字取首字，其他取前两个字符"""
+    return token[0] if CJK_RE.match(token) else token[:2]
+
+
+def shard_filename(key):
+    """分片文件名使用字符码点，避免文件系统对大小写和特殊字符的限制"""
+    return 's-' + '-'.join(f'{ord(c):x}' for c in key) + '.js'
+
+
+def write_script(path, callback, *args):
+    """以 JSONP 形式写出数据，便于 file:/// 页面通过 <script> 加载"""
+    payload = ', '.join(json.dumps(arg, ensure_ascii=False, separators=(',', ':')) for arg in args)
+    write_if_changed(path, f'{callback}({payload});\n')
+
+
+def build_match_query(query):
+    """将用户输入转换为 FTS5 查询：各词之间为 AND，中文连续段为短语"""
+    parts = []
+    for run in TOKEN_RE.findall(query.lower()):
+        if CJK_RE.match(run) and len(run) > 1:
+            bigrams = ' '.join(run[i:i + 2] for i in range(len(run) - 1))
+            parts.append(f'"{bigrams}"')
+        else:
+            parts.append(f'"{run}"*')
+    return ' '.join(parts)
+
+
+def make_snippet(content, query, width=80):
+    """截取内容中第一个命中词附近的片段"""
+    lowered = content.lower()
+    pos = -1
+    for run in TOKEN_RE.findall(query.lower()):
+        pos = lowered.find(run)
+        if pos >= 0:
+            break
+    start = max(0, pos - width // 3) if pos >= 0 else 0
+    snippet = ' '.join(content[start:start + width].split())
+    if start > 0:
+        snippet = '...' + snippet
+    if start + width < len(content):
+        snippet += '...'
+    return snippet
+
+
+class SearchIndex:
+    """会话消息的全文索引，每个会话记录已索引到的字节偏移
+
+    消息 id 即浏览器端分片中的文档 id，按写入顺序分配。staged 为真时（并行导出的工作进程中）
+    写入器只把消息暂存到 staged_* 表，由主进程按任务顺序调用 apply_staged 写入，
+    id 因而与各工作进程完成的先后无关，与依次导出时相同。
+    未采用分支中的消息（set_hidden）保留 id，但不在全文索引和文档分片中。
+    """
+
+    def __init__(self, db_path, staged=False):
+        self.db_path = db_path
+        self.staged = staged
+        self.conn = sqlite3.connect(str(db_path), timeout=60)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript(SCHEMA)
+        for table, column, definition in ADDED_COLUMNS:
+            if column not in {row[1] for row in self.conn.execute(f'PRAGMA table_info({table})')}:
+                self.conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+    def close(self):
+        self.conn.close()
+
+    def session_offsets(self):
+        """返回 {会话文件路径: 已索引到的字节偏移}"""
+        return dict(self.conn.execute('SELECT path, offset FROM sessions'))
+
+    def session_state(self, path):
+        """返回会话的 (id, 已索引偏移, 已索引消息数)，未索引时返回 None"""
+        return self.conn.execute(
+            'SELECT id, offset, count FROM sessions WHERE path = ?', (str(path),)).fetchone()
+
+    def reset_session(self, path, project, session):
+        """清空会话已有的索引内容，返回会话 id"""
+        with self.conn:
+            state = self.session_state(path)
+            if state is None:
+                cur = self.conn.execute(
+                    'INSERT INTO sessions (path, project, session) VALUES (?, ?, ?)',
+                    (str(path), project, session))
+                return cur.lastrowid
+
+            session_id = state[0]
+            self.delete_messages(session_id)
+            self.conn.execute(
+                'UPDATE sessions SET offset = 0, count = 0, hidden_digest = NULL WHERE id = ?', (session_id,))
+            return session_id
+
+    def remove_session(self, path):
+        """删除已不存在的会话的全部索引内容，受影响的分片和 meta.js 在下次导出分片时重写；返回是否有记录"""
+        with self.conn:
+            state = self.session_state(path)
+            if state is None:
+                return False
+            self.delete_messages(state[0])
+            self.conn.execute('DELETE FROM sessions WHERE id = ?', (state[0],))
+            self.conn.execute('DELETE FROM staged_messages WHERE path = ?', (str(path),))
+            self.conn.execute('DELETE FROM staged_sessions WHERE path = ?', (str(path),))
+            return True
+
+    def delete_messages(self, session_id):
+        """在当前事务中删除会话的消息和全文索引，并标记受影响的分片"""
+        # 未采用分支中的消息已不在全文索引中
+        rows = self.conn.execute(
+            'SELECT id, content FROM messages WHERE session_id = ? AND NOT hidden', (session_id,))
+        # 无内容表删除时需要提供原始索引词
+        deleted = [(row_id, ' '.join(tokenize(content))) for row_id, content in rows]
+        self.conn.executemany(
+            "INSERT INTO messages_fts (messages_fts, rowid, tokens) VALUES ('delete', ?, ?)",
+            deleted)
+        self.mark_dirty(deleted)
+        self.conn.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+
+    def mark_dirty(self, rows):
+        """记录 (消息 id, 索引词) 涉及的浏览器端分片，下次导出时重新生成"""
+        # 分片只取决于前两个字符，先按前缀去重再计算
+        prefixes = set()
+        for _, tokens in rows:
+            prefixes.update(t[:2] for t in tokens.split())
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO dirty_shards (key) VALUES (?)',
+            [(key,) for key in {shard_key(p) for p in prefixes}])
+        self.conn.executemany(
+            'INSERT OR IGNORE INTO dirty_docs (chunk) VALUES (?)',
+            [(chunk,) for chunk in {row_id // DOC_CHUNK_SIZE for row_id, _ in rows}])
+
+    def writer(self, path, project, session, reset=False):
+        """返回会话的增量写入器；reset 为 True 时先清空已有索引"""
+        state = self.session_state(path)
+        if self.staged:
+            reset = reset or state is None
+            offset, count = (0, 0) if reset else state[1:]
+            return StagedIndexWriter(self, path, project, session, reset, offset, count)
+        if reset or state is None:
+            return SessionIndexWriter(self, self.reset_session(path, project, session), 0, 0)
+        return SessionIndexWriter(self, *state)
+
+    def insert_messages(self, session_id, rows):
+        """在当前事务中写入 (序号, 角色, 时间, 内容, 索引词) 并标记受影响的分片"""
+        conn = self.conn
+        inserted = []
+        for seq, role, timestamp, content, tokens in rows:
+            cur = conn.execute(
+                'INSERT INTO messages (session_id, seq, role, timestamp, content) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (session_id, seq, role, timestamp, content))
+            inserted.append((cur.lastrowid, tokens))
+        conn.executemany('INSERT INTO messages_fts (rowid, tokens) VALUES (?, ?)', inserted)
+        self.mark_dirty(inserted)
+        if inserted:
+            # 新消息尚未按对话树排除，需要重新 set_hidden
+            conn.execute('UPDATE sessions SET hidden_digest = NULL WHERE id = ?', (session_id,))
+
+    def hidden_digests(self):
+        """返回 {会话文件路径: 上次 set_hidden 时对话树的摘要}，之后又写入过消息的为 None"""
+        return dict(self.conn.execute('SELECT path, hidden_digest FROM sessions'))
+
+    def set_hidden(self, path, seqs, digest):
+        """会话中序号在 seqs 内的消息属于未采用的分支：移出全文索引，不再出现在检索结果和文档分片中
+
+        之前排除、现在又回到当前分支的消息重新加入。digest 为对话树的摘要，记下供 hidden_digests 比较。
+        """
+        conn = self.conn
+        with conn:
+            state = self.session_state(path)
+            if state is None:
+                return
+            session_id = state[0]
+            seqs = json.dumps(sorted(seqs))
+            hide = [(row_id, ' '.join(tokenize(content))) for row_id, content in conn.execute(
+                'SELECT id, content FROM messages WHERE session_id = ? AND NOT hidden '
+                'AND seq IN (SELECT value FROM json_each(?))', (session_id, seqs))]
+            show = [(row_id, ' '.join(tokenize(content))) for row_id, content in conn.execute(
+                'SELECT id, content FROM messages WHERE session_id = ? AND hidden '
+                'AND seq NOT IN (SELECT value FROM json_each(?))', (session_id, seqs))]
+            conn.executemany(
+                "INSERT INTO messages_fts (messages_fts, rowid, tokens) VALUES ('delete', ?, ?)", hide)
+            conn.executemany('INSERT INTO messages_fts (rowid, tokens) VALUES (?, ?)', show)
+            conn.executemany('UPDATE messages SET hidden = 1 WHERE id = ?', [(row_id,) for row_id, _ in hide])
+            conn.executemany('UPDATE messages SET hidden = 0 WHERE id = ?', [(row_id,) for row_id, _ in show])
+            self.mark_dirty(hide + show)
+            conn.execute('UPDATE sessions SET hidden_digest = ? WHERE id = ?', (digest, session_id))
+
+    def apply_staged(self, paths):
+        """按 paths 的顺序把暂存的会话索引写入正式的表，返回写入的会话数"""
+        conn = self.conn
+        applied = 0
+        for path in map(str, paths):
+            staged = conn.execute(
+                'SELECT project, session, reset, offset, count FROM staged_sessions WHERE path = ?',
+                (path,)).fetchone()
+            if staged is None:
+                continue
+            project, session, reset, offset, count = staged
+            state = self.session_state(path)
+            session_id = self.reset_session(path, project, session) if reset or state is None else state[0]
+            with conn:
+                rows = conn.execute(
+                    'SELECT seq, role, timestamp, content, tokens FROM staged_messages '
+                    'WHERE path = ? ORDER BY rowid', (path,))
+                while True:
+                    batch = rows.fetchmany(BATCH_SIZE)
+                    if not batch:
+                        break
+                    self.insert_messages(session_id, batch)
+                conn.execute('UPDATE sessions SET offset = ?, count = ? WHERE id = ?',
+                             (offset, count, session_id))
+                conn.execute('DELETE FROM staged_messages WHERE path = ?', (path,))
+                conn.execute('DELETE FROM staged_sessions WHERE path = ?', (path,))
+            applied += 1
+        return applied
+
+    def search(self, query, limit=20, project=None):
+        """按相关度返回命中的消息"""
+        match = build_match_query(query)
+        if not match:
+            return []
+
+        sql = """
+            SELECT s.project, s.session, m.seq, m.role, m.timestamp, m.content
+            FROM messages_fts
+            JOIN messages m ON m.id = messages_fts.rowid
+            JOIN sessions s ON s.id = m.session_id
+            WHERE messages_fts MATCH ?
+        """
+        params = [match]
+        if project:
+            sql += " AND s.project LIKE ?"
+            params.append(f'%{project}%')
+        sql += " ORDER BY bm25(messages_fts) LIMIT ?"
+        params.append(limit)
+
+        return [{
+            'project': project_name,
+            'session': session,
+            'seq': seq,
+            'role': role,
+            'timestamp': timestamp,
+            'snippet': make_snippet(content, query),
+        } for project_name, session, seq, role, timestamp, content
+            in self.conn.execute(sql, params)]
+
+    def export_shards(self, out_dir, describe_session):
+        """导出浏览器端使用的分片索引，只重写有变化的分片
+
+        describe_session(project, session) 返回 (显示名称, 链接)。
+        out_dir 中尚无 meta.js 时全量生成。
+        """
+        out_dir.mkdir(parents=True, exist_ok=True)
+        conn = self.conn
+        conn.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS temp.vocab_instance "
+            "USING fts5vocab(main, messages_fts, 'instance')")
+
+        if (out_dir / 'meta.js').exists():
+            keys = [key for key, in conn.execute('SELECT key FROM dirty_shards')]
+            chunks = [chunk for chunk, in conn.execute('SELECT chunk FROM dirty_docs')]
+            for key in keys:
+                upper = key[:-1] + chr(ord(key[-1]) + 1)
+                postings = self.iter_postings(key, upper)
+                self.write_shard(out_dir, key, [(t, d) for t, d in postings if shard_key(t) == key])
+        else:
+            # 全量生成：按索引词顺序扫描一遍，同一分片的词必然相邻
+            keys = []
+            for key, group in groupby(self.iter_postings(), lambda item: shard_key(item[0])):
+                keys.append(key)
+                self.write_shard(out_dir, key, group)
+            chunks = [chunk for chunk, in conn.execute(
+                'SELECT DISTINCT id / ? FROM messages', (DOC_CHUNK_SIZE,))]
+
+        for chunk in chunks:
+            self.write_doc_chunk(out_dir, chunk)
+
+        sessions = {}
+        for session_id, project, session in conn.execute('SELECT id, project, session FROM sessions'):
+            display_name, link = describe_session(project, session)
+            sessions[session_id] = [display_name, session, link]
+        write_script(out_dir / 'meta.js', '__searchMeta', {
+            'docChunkSize': DOC_CHUNK_SIZE,
+            'sessions': sessions,
+        })
+
+        if keys or chunks:
+            # 空删除也会写入 WAL 并在关闭时改动 search.db，没有变化时不执行
+            with conn:
+                conn.execute('DELETE FROM dirty_shards')
+                conn.execute('DELETE FROM dirty_docs')
+        return len(keys), len(chunks)
+
+    def iter_postings(self, lower=None, upper=None):
+        """按索引词顺序产出 (索引词, 升序消息 id 列表)，可限定 [lower, upper) 范围"""
+        sql = 'SELECT term, group_concat(DISTINCT doc) FROM temp.vocab_instance'
+        params = ()
+        if lower is not None:
+            sql += ' WHERE term >= ? AND term < ?'
+            params = (lower, upper)
+        # instance 表按索引词顺序输出，分组和去重在 SQLite 内完成，无需额外排序
+        sql += ' GROUP BY term'
+        for term, docs in self.conn.execute(sql, params):
+            yield term, sorted(map(int, docs.split(',')))
+
+    def write_shard(self, out_dir, key, postings):
+        """写出单个分片：{索引词: 差分编码的消息 id 列表}"""
+        encoded = {term: [docs[0]] + [b - a for a, b in zip(docs, docs[1:])]
+                   for term, docs in postings}
+
+        path = out_dir / shard_filename(key)
+        if not encoded:
+            if path.exists():
+                path.unlink()
+            return
+        write_script(path, '__searchShard', key, encoded)
+
+    def write_doc_chunk(self, out_dir, chunk):
+        """写出单个文档分片：{消息 id: [会话 id, 序号, 角色, 时间, 预览]}"""
+        docs = {}
+        for row_id, session_id, seq, role, timestamp, content in self.conn.execute(
+                'SELECT id, session_id, seq, role, timestamp, substr(content, 1, ?) '
+                'FROM messages WHERE id >= ? AND id < ? AND NOT hidden',
+                (PREVIEW_LENGTH, chunk * DOC_CHUNK_SIZE, (chunk + 1) * DOC_CHUNK_SIZE)):
+            docs[row_id] = [session_id, seq, role, timestamp, ' '.join(content.split())]
+
+        path = out_dir / f'd-{chunk}.js'
+        if not docs:
+            if path.exists():
+                path.unlink()
+            return
+        write_script(path, '__searchDocs', chunk, docs)
+
+
+class SessionIndexWriter:
+    """单个会话的批量写入器，消息按批连同偏移一起提交"""
+
+    def __init__(self, index, session_id, offset, count):
+        self.index = index
+        self.session_id = session_id
+        self.offset = offset
+        self.count = count
+        self.pending = []
+
+    def add(self, conv):
+        """加入一条消息（history_parser.Message），索引偏移推进到该消息之后"""
+        self.count += 1
+        if conv.content:
+            # 只含工具调用等内容块的消息不进入全文索引，但占用序号
+            self.pending.append((self.count, conv.role, conv.timestamp, conv.content))
+        self.offset = conv.offset
+        if len(self.pending) >= BATCH_SIZE:
+            self.flush()
+
+    def flush(self, end_offset=None):
+        """提交已缓存的消息和会话偏移"""
+        if end_offset is not None:
+            self.offset = end_offset
+        conn = self.index.conn
+        with conn:
+            self.index.insert_messages(self.session_id, [
+                (seq, role, timestamp, content, ' '.join(tokenize(content)))
+                for seq, role, timestamp, content in self.pending])
+            conn.execute(
+                'UPDATE sessions SET offset = ?, count = ? WHERE id = ?',
+                (self.offset, self.count, self.session_id))
+        self.pending = []
+
+
+class StagedIndexWriter(SessionIndexWriter):
+    """工作进程中的写入器：消息连同切好的索引词暂存，由主进程的 apply_staged 写入
+
+    同一会话上次未写入的暂存内容（例如导出中断留下的）先清除，它们会重新产生。
+    """
+
+    def __init__(self, index, path, project, session, reset, offset, count):
+        super().__init__(index, None, offset, count)
+        self.path = str(path)
+        with index.conn:
+            index.conn.execute('DELETE FROM staged_messages WHERE path = ?', (self.path,))
+            index.conn.execute(
+                'INSERT OR REPLACE INTO staged_sessions (path, project, session, reset, offset, count) '
+                'VALUES (?, ?, ?, ?, ?, ?)', (self.path, project, session, int(reset), offset, count))
+
+    def flush(self, end_offset=None):
+        if end_offset is not None:
+            self.offset = end_offset
+        conn = self.index.conn
+        with conn:
+            conn.executemany(
+                'INSERT INTO staged_messages (path, seq, role, timestamp, content, tokens) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                [(self.path, seq, role, timestamp, content, ' '.join(tokenize(content)))
+                 for seq, role, timestamp, content in self.pending])
+            conn.execute('UPDATE staged_sessions SET offset = ?, count = ? WHERE path = ?',
+                         (self.offset, self.count, self.path))
+        self.pending = []
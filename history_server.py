@@ -0,0 +1,246 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史本地服务
+按需从 JSONL 渲染索引页和会话分页，渲染结果缓存在有界 LRU 中，支持 ETag 和 gzip
+"""
+
+import gzip
+import hashlib
+import io
+import mimetypes
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote, urlsplit
+
+# 会话页面路径：/sessions/<项目>/<会话>/index.html、page-N.html，或导出模式下的 <会话>.md
+SESSION_ROUTE = re.compile(r'^/sessions/([^/]+)/([^/]+?)(?:/(index|page-(\d+))\.html|\.md)$')
+# 超长内容块另存的压缩文件：/sessions/<项目>/spill/<哈希>.txt.gz
+SPILL_ROUTE = re.compile(r'^/sessions/([^/]+)/spill/([0-9a-f]+\.txt\.gz)$')
+
+# 小于该字节数的响应不压缩
+GZIP_MIN_SIZE = 1024
+
+
+class LRUCache:
+    """线程安全的有界 LRU 缓存"""
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+
+class RenderedPage:
+    """渲染好的页面：原文、gzip 压缩后的内容和 ETag"""
+
+    __slots__ = ('body', 'gzipped', 'etag', 'content_type')
+
+    def __init__(self, body, etag, content_type):
+        self.body = body
+        self.gzipped = gzip.compress(body, 6) if len(body) >= GZIP_MIN_SIZE else None
+        self.etag = etag
+        self.content_type = content_type
+
+
+class HistoryServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, manager, cache_size=128):
+        super().__init__(address, HistoryRequestHandler)
+        self.manager = manager
+        self.cache = LRUCache(cache_size)
+        # 索引页使用的会话记录，随请求增量更新
+        self.entries = manager.load_index_cache()
+        self.entries_lock = threading.Lock()
+
+    def session_file(self, safe_name, session):
+        """将 URL 中的项目和会话映射到 JSONL 文件，拒绝越出项目目录的路径"""
+        if safe_name in ('.', '..') or session in ('.', '..') or '\\' in safe_name + session:
+            return None
+        return self.manager.find_session_file(safe_name, session)
+
+    def render_index(self):
+        """按需渲染 index.html；所有会话文件的大小和修改时间不变时直接使用缓存"""
+        manager = self.manager
+        projects = manager.get_all_projects()
+        signature = hashlib.sha1()
+        for project in projects:
+            for jsonl_file in sorted(project['conversations']):
+                st = jsonl_file.stat()
+                signature.update(f"{jsonl_file}\0{st.st_ino}\0{st.st_size}\0{st.st_mtime}\n".encode('utf-8'))
+        key = ('index', signature.hexdigest())
+
+        def render():
+            # 用量汇总表也按会话记录更新，渲染完成前不能被其他请求改动
+            with self.entries_lock:
+                entries, _ = manager.summarize_sessions(projects, self.entries)
+                self.entries = entries
+                manager.refresh_stats(projects, entries)
+                return manager.generate_index_html(manager.build_projects_info(projects, entries))
+
+        return self.cached(key, render)
+
+    def render_session(self, jsonl_file, project, page):
+        """按需渲染会话目录页（page 为 None）或某一页"""
+        manager = self.manager
+        st = jsonl_file.stat()
+        version = (str(jsonl_file), st.st_ino, st.st_size, st.st_mtime)
+        pages, count, end_offset, blocks = self.cached_value(('pages',) + version,
+                                                     lambda: manager.scan_session_pages(jsonl_file))
+        session = jsonl_file.stem
+
+        def render():
+            f = io.StringIO()
+            if page is None:
+                manager.write_session_toc_html(f, project, session, pages, count)
+            else:
+                manager.write_indexed_session_page(f, project, jsonl_file, pages, page, end_offset, blocks)
+            return f.getvalue()
+
+        if page is not None and not 1 <= page <= len(pages):
+            return None
+        return self.cached(('page', page) + version, render)
+
+    def cached_value(self, key, compute):
+        value = self.cache.get(key)
+        if value is None:
+            value = compute()
+            self.cache.put(key, value)
+        return value
+
+    def cached(self, key, render, content_type='text/html; charset=utf-8'):
+        """取得缓存的渲染结果；ETag 由缓存键（含文件偏移和修改时间）决定"""
+        def compute():
+            etag = '"' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16] + '"'
+            return RenderedPage(render().encode('utf-8'), etag, content_type)
+        return self.cached_value(key, compute)
+
+
+class HistoryRequestHandler(BaseHTTPRequestHandler):
+    server_version = "ClaudeHistory/1.0"
+
+    def do_GET(self):
+        path = unquote(urlsplit(self.path).path)
+        if path in ('/', '/index.html'):
+            return self.send_page(self.server.render_index())
+
+        match = SPILL_ROUTE.match(path)
+        if match:
+            return self.send_spill(*match.groups())
+
+        match = SESSION_ROUTE.match(path)
+        if match:
+            safe_name, session, name, page = match.groups()
+            jsonl_file = self.server.session_file(safe_name, session)
+            if jsonl_file is None:
+                return self.send_error(404)
+            if name is None:
+                # 导出模式下的 .md 链接跳转到分页页面
+                return self.redirect(f"/sessions/{quote(safe_name)}/{quote(session)}/index.html")
+            project = {'name': safe_name, 'path': jsonl_file.parent}
+            rendered = self.server.render_session(jsonl_file, project, int(page) if page else None)
+            if rendered is None:
+                return self.send_error(404)
+            return self.send_page(rendered)
+
+        if path.startswith('/search/'):
+            return self.send_static(path)
+        self.send_error(404)
+
+    def send_static(self, path):
+        """提供导出时生成的全文检索分片"""
+        search_dir = (self.server.manager.output_dir / "search").resolve()
+        file_path = (search_dir / path[len('/search/'):]).resolve()
+        if file_path.parent != search_dir or not file_path.is_file():
+            return self.send_error(404)
+        st = file_path.stat()
+        content_type = mimetypes.guess_type(file_path.name)[0] or 'application/octet-stream'
+        rendered = self.server.cached(('static', str(file_path), st.st_size, st.st_mtime),
+                                      lambda: file_path.read_text(encoding='utf-8'), content_type)
+        self.send_page(rendered)
+
+    def send_spill(self, safe_name, name):
+        """提供渲染页面时另存的完整内容块，浏览器直接以纯文本显示"""
+        if safe_name in ('.', '..'):
+            return self.send_error(404)
+        file_path = self.server.manager.output_dir / "sessions" / safe_name / "spill" / name
+        try:
+            data = file_path.read_bytes()
+        except OSError:
+            return self.send_error(404)
+        use_gzip = 'gzip' in self.headers.get('Accept-Encoding', '')
+        if not use_gzip:
+            data = gzip.decompress(data)
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        # 文件名即内容哈希，内容不会变化
+        self.send_header('Cache-Control', 'max-age=31536000, immutable')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_page(self, rendered):
+        """发送页面；ETag 匹配时返回 304，客户端支持时返回 gzip"""
+        if rendered.etag in self.headers.get('If-None-Match', ''):
+            self.send_response(304)
+            self.send_header('ETag', rendered.etag)
+            self.end_headers()
+            return
+
+        body = rendered.body
+        use_gzip = rendered.gzipped is not None and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if use_gzip:
+            body = rendered.gzipped
+        self.send_response(200)
+        self.send_header('Content-Type', rendered.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', rendered.etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Vary', 'Accept-Encoding')
+        if use_gzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        print(f"[{self.log_date_time_string()}] {format % args}")
+
+
+def serve(manager, host='127.0.0.1', port=8765, cache_size=128, on_ready=None):
+    """启动本地服务直到按 Ctrl+C；on_ready(url) 在开始监听后调用"""
+    server = HistoryServer((host, port), manager, cache_size)
+    url = f"http://{host}:{server.server_port}/"
+    print(f"Serving Claude history at {url}")
+    print("Press Ctrl+C to stop\n")
+    if on_ready:
+        on_ready(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史用量统计
+按天、项目、模型汇总消息数和 token 用量；汇总表由整数数组组成，持久化后每次导出只叠加有变化的会话
+"""
+
+import json
+import sys
+from array import array
+from datetime import date
+
+from history_output import write_if_changed
+
+STATS_VERSION = 1
+
+# 每天一行，依次为以下指标
+METRICS = ('user_messages', 'assistant_messages', 'requests',
+           'input_tokens', 'output_tokens', 'cache_read_tokens', 'cache_creation_tokens')
+WIDTH = len(METRICS)
+
+# message.usage 中对应 input_tokens 之后各指标的字段
+USAGE_FIELDS = ('input_tokens', 'output_tokens', 'cache_read_input_tokens', 'cache_creation_input_tokens')
+
+
+class UsageCollector:
+    """累加单个会话的用量，结果存入清单的会话记录
+
+    entry['usage'] 为 {"日期\\t模型": [各指标]}，消息数记在模型为空的键下；
+    会话被重写或删除时据此从汇总表中减去。entry['last_usage'] 为最后一次响应的
+    [消息 id, 各 token 数]，用于对同一响应的多条记录去重，也跨越增量解析的边界。
+    """
+
+    def __init__(self, entry):
+        self.usage = {key: list(values) for key, values in (entry.get('usage') or {}).items()}
+        last = entry.get('last_usage') or ['', [0] * len(USAGE_FIELDS)]
+        self.last_id, self.last_tokens = last[0], list(last[1])
+
+    def row(self, timestamp, model=''):
+        key = f"{timestamp[:10]}\t{model}"
+        row = self.usage.get(key)
+        if row is None:
+            row = self.usage[key] = [0] * WIDTH
+        return row
+
+    def add_message(self, conv):
+        self.row(conv.timestamp)[0 if conv.role == 'user' else 1] += 1
+
+    def add_usage(self, record):
+        """加入 history_parser.extract_usage 的结果"""
+        message_id, model, timestamp, usage = record
+        tokens = []
+        for field in USAGE_FIELDS:
+            value = usage.get(field)
+            tokens.append(value if isinstance(value, int) else 0)
+
+        row = self.row(timestamp, model)
+        if message_id and message_id == self.last_id:
+            # 同一响应的后续记录：只补上增加的部分（流式写入时 output_tokens 会逐步变大）
+            for i, (old, new) in enumerate(zip(self.last_tokens, tokens)):
+                if new > old:
+                    row[3 + i] += new - old
+                    self.last_tokens[i] = new
+            return
+        row[2] += 1
+        for i, value in enumerate(tokens):
+            row[3 + i] += value
+        self.last_id, self.last_tokens = message_id, tokens
+
+    def update(self, entry):
+        entry['usage'] = self.usage
+        entry['last_usage'] = [self.last_id, self.last_tokens]
+
+
+class UsageStats:
+    """按项目和模型分列的每日汇总表
+
+    series 中 "p:项目" 和 "m:模型" 各对应一个 array('q')，依次存放 first_day 起每天的 WIDTH 个指标。
+    按天的总量由所有项目列相加得到；模型列只记录请求数和 token。
+    """
+
+    def __init__(self):
+        self.first_day = None
+        self.days = 0
+        self.series = {}
+        self.generation = 0
+
+    def day_index(self, day):
+        """返回某天（公历序数）所在的行，必要时向前或向后扩展所有数组"""
+        if self.first_day is None:
+            self.first_day, self.days = day, 1
+            return 0
+        if day < self.first_day:
+            pad = array('q', [0]) * ((self.first_day - day) * WIDTH)
+            for values in self.series.values():
+                values[0:0] = pad
+            self.days += self.first_day - day
+            self.first_day = day
+        elif day >= self.first_day + self.days:
+            pad = array('q', [0]) * ((day - self.first_day - self.days + 1) * WIDTH)
+            for values in self.series.values():
+                values.extend(pad)
+            self.days = day - self.first_day + 1
+        return day - self.first_day
+
+    def column(self, name):
+        values = self.series.get(name)
+        if values is None:
+            values = self.series[name] = array('q', [0]) * (self.days * WIDTH)
+        return values
+
+    def apply(self, project, usage, sign=1):
+        """加上（sign=-1 时减去）一个会话的用量记录"""
+        for key, row in usage.items():
+            day, model = key.split('\t')
+            try:
+                start = self.day_index(date.fromisoformat(day).toordinal()) * WIDTH
+            except ValueError:
+                # 没有时间戳的记录
+                continue
+            names = ['p:' + project]
+            if model:
+                names.append('m:' + model)
+            for name in names:
+                values = self.column(name)
+                for i, value in enumerate(row):
+                    values[start + i] += sign * value
+
+    def prune(self):
+        """删除已全部为零的列"""
+        for name in [name for name, values in self.series.items() if not any(values)]:
+            del self.series[name]
+
+    def daily(self, skip_empty=True):
+        """返回 [(日期, [各指标])]，skip_empty 时只包含有活动的日子"""
+        rows = []
+        projects = [values for name, values in self.series.items() if name.startswith('p:')]
+        for index in range(self.days):
+            start = index * WIDTH
+            row = [sum(values[start + i] for values in projects) for i in range(WIDTH)]
+            if any(row) or not skip_empty:
+                rows.append((date.fromordinal(self.first_day + index), row))
+        return rows
+
+    def totals(self, prefix):
+        """返回 {项目或模型: [各指标的总和]}，prefix 为 'p:' 或 'm:'"""
+        return {name[len(prefix):]: [sum(values[i::WIDTH]) for i in range(WIDTH)]
+                for name, values in self.series.items() if name.startswith(prefix)}
+
+    def save(self, path):
+        """保存为一行 JSON 表头加各列的原始字节，内容未变化时不写"""
+        names = sorted(self.series)
+        header = json.dumps({
+            'version': STATS_VERSION,
+            'metrics': METRICS,
+            'first_day': self.first_day,
+            'days': self.days,
+            'series': names,
+            'generation': self.generation,
+            'byteorder': sys.byteorder,
+        }, ensure_ascii=False, separators=(',', ':'))
+        write_if_changed(path, b''.join([header.encode('utf-8'), b'\n']
+                                        + [self.series[name].tobytes() for name in names]))
+
+    @classmethod
+    def load(cls, path):
+        """读取汇总表；文件不存在或格式不符时返回空表"""
+        stats = cls()
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header['version'] != STATS_VERSION or tuple(header['metrics']) != METRICS:
+                    return stats
+                size = header['days'] * WIDTH
+                series = {}
+                for name in header['series']:
+                    values = array('q')
+                    values.fromfile(f, size)
+                    if header['byteorder'] != sys.byteorder:
+                        values.byteswap()
+                    series[name] = values
+        except (OSError, ValueError, KeyError, EOFError):
+            return stats
+        stats.first_day, stats.days = header['first_day'], header['days']
+        stats.series, stats.generation = series, header['generation']
+        return stats
+
+
+def format_tokens(n):
+    """将 token 数格式化为 1.2K、3.4M 的形式"""
+    for unit, scale in (('B', 10 ** 9), ('M', 10 ** 6), ('K', 10 ** 3)):
+        if n >= scale:
+            return f"{n / scale:.1f}{unit}"
+    return str(n)
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史的二进制消息存储
+解析 JSONL 时顺带保存提取出的消息，之后重新渲染、重建索引都直接读取，无需再次解码 JSON
+
+每个会话两个文件：
+  <会话>.cols  一行 JSON 表头 + 各列的原始字节（array），每条消息一行
+  <会话>.blob  各消息的正文和内容块依次连接，读取时内存映射
+列文件很小，每次整体原子替换；正文只在末尾追加。表头记录的 blob 长度之后的字节
+（写出中断留下的）在下次追加前截掉。
+时间列同时是会话的时间索引：时间递增的会话（表头 sorted）按时间范围二分查找，直接定位到匹配的消息。
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime, timedelta, timezone
+from functools import lru_cache
+
+from history_output import write_if_changed
+from history_parser import Block, Message, iter_messages
+from history_thread import ThreadIndex
+
+STORE_VERSION = 2
+
+ROLES = ('user', 'assistant')
+BLOCK_TYPES = ('text', 'thinking', 'tool_use', 'tool_result', 'image')
+
+# 每条消息一行：JSONL 中该消息之后的字节偏移、角色、时间（UTC 毫秒）、正文在 blob 中的结束位置
+COLUMNS = (('offsets', 'q'), ('roles', 'B'), ('times', 'q'), ('ends', 'q'))
+
+# times 列的特殊值：没有时间戳；时间戳不是标准格式，原文存在正文之前
+NO_TIME = -2 ** 63
+RAW_TIME = NO_TIME + 1
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# 各字段前的长度（非标准时间戳、正文）或个数（内容块）
+LENGTH = struct.Struct('<I')
+# 内容块：类型、是否出错、原始字节数、标题/正文/另存文件名的长度
+BLOCK_HEADER = struct.Struct('<BBqIII')
+
+
+# 标准格式的时间戳；日期部分按天缓存，解析整个会话时每条消息只需几次切片
+CANONICAL_TIME = re.compile(r'(\d{4}-\d{2}-\d{2})T([01]\d|2[0-3]):([0-5]\d):([0-5]\d)\.(\d{3})Z')
+
+
+@lru_cache(maxsize=1024)
+def day_ms(day):
+    """YYYY-MM-DD 零点的 UTC 毫秒，日期无效时返回 None"""
+    try:
+        return (date.fromisoformat(day) - EPOCH.date()).days * 86400000
+    except ValueError:
+        return None
+
+
+def encode_time(timestamp):
+    """将 2026-01-01T00:00:00.000Z 形式的时间戳转换为毫秒，其他形式返回 None"""
+    match = CANONICAL_TIME.fullmatch(timestamp)
+    if not match:
+        return None
+    day, hour, minute, second, ms = match.groups()
+    base = day_ms(day)
+    if base is None:
+        return None
+    return base + ((int(hour) * 60 + int(minute)) * 60 + int(second)) * 1000 + int(ms)
+
+
+def timestamp_ms(timestamp):
+    """将任意 ISO 8601 形式的时间戳转换为毫秒（不带时区时按 UTC），无法识别时返回 None"""
+    ms = encode_time(timestamp) if timestamp else None
+    if ms is None and timestamp:
+        try:
+            dt = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=timezone.utc)
+        ms = (dt - EPOCH) // timedelta(milliseconds=1)
+    return ms
+
+
+def decode_time(ms):
+    dt = EPOCH + timedelta(milliseconds=ms)
+    return f"{dt:%Y-%m-%dT%H:%M:%S}.{ms % 1000:03d}Z"
+
+
+def parse_time(value, end=False):
+    """将命令行中的时间转换为 UTC 毫秒
+
+    支持 2026-10-01（end 时为次日零点，即包含当天）、2026-10-01T08:30（可带 Z 或 +08:00，
+    不带时区时按 UTC），以及 7d、12h 这样相对现在的时间。格式不符时抛出 ValueError。
+    """
+    value = value.strip()
+    relative = re.fullmatch(r'(\d+)([dh])', value)
+    if relative:
+        amount = int(relative.group(1))
+        delta = timedelta(days=amount) if relative.group(2) == 'd' else timedelta(hours=amount)
+        return (datetime.now(timezone.utc) - delta - EPOCH) // timedelta(milliseconds=1)
+    dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if end and re.fullmatch(r'\d{4}-\d{2}-\d{2}', value):
+        dt += timedelta(days=1)
+    return (dt - EPOCH) // timedelta(milliseconds=1)
+
+
+def read_head_fingerprint(path, limit):
+    """读取文件开头（最多 4KB）作为指纹，用于识别被替换的文件"""
+    with open(path, 'rb') as f:
+        head = f.read(min(limit, 4096))
+    return hashlib.sha1(head).hexdigest()
+
+
+def load_columns(path):
+    """读取列文件，返回 (表头, {列名: array})；不存在或格式不符时返回 None"""
+    try:
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline())
+            if header.get('version') != STORE_VERSION:
+                return None
+            columns = {}
+            for name, typecode in COLUMNS:
+                values = array(typecode)
+                values.fromfile(f, header['count'])
+                if header['byteorder'] != sys.byteorder:
+                    values.byteswap()
+                columns[name] = values
+    except (OSError, ValueError, KeyError, EOFError):
+        return None
+    return header, columns
+
+
+class MessageStoreWriter:
+    """增量写入一个会话的消息存储
+
+    resume 成功时在已有内容之后追加，否则从头写；commit 先写正文再替换列文件。
+    """
+
+    def __init__(self, base_path, block_cap):
+        self.base_path = base_path
+        self.cols_path = base_path.with_name(base_path.name + '.cols')
+        self.blob_path = base_path.with_name(base_path.name + '.blob')
+        self.block_cap = block_cap
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.offset = 0
+        self.size = 0
+        self.pending = []
+        self.sorted = True
+        self.last_time = NO_TIME
+
+    def resume(self, offset, count):
+        """已有存储恰好覆盖到 JSONL 的 offset（共 count 条消息）时接着写入，返回是否成功"""
+        loaded = load_columns(self.cols_path)
+        if not loaded:
+            return False
+        header, columns = loaded
+        if header['offset'] != offset or header['count'] != count or header['block_cap'] != self.block_cap:
+            return False
+        try:
+            if os.path.getsize(self.blob_path) < header['size']:
+                return False
+        except OSError:
+            return False
+        self.columns = columns
+        self.offset, self.size = offset, header['size']
+        self.sorted = header['sorted']
+        if columns['times']:
+            self.last_time = columns['times'][-1]
+        return True
+
+    def add(self, message):
+        """加入下一条消息（history_parser.Message，完整内容模式）"""
+        parts = []
+        ms = encode_time(message.timestamp) if message.timestamp else NO_TIME
+        if ms is None:
+            ms = RAW_TIME
+            raw = message.timestamp.encode('utf-8')
+            parts += [LENGTH.pack(len(raw)), raw]
+        content = message.content.encode('utf-8')
+        blocks = message.blocks or []
+        parts += [LENGTH.pack(len(content)), content, LENGTH.pack(len(blocks))]
+        for block in blocks:
+            title = block.title.encode('utf-8')
+            text = block.text.encode('utf-8')
+            spill = (block.spill or '').encode('utf-8')
+            parts += [BLOCK_HEADER.pack(BLOCK_TYPES.index(block.type), block.error, block.size,
+                                        len(title), len(text), len(spill)), title, text, spill]
+        payload = b''.join(parts)
+        self.pending.append(payload)
+        self.size += len(payload)
+
+        columns = self.columns
+        columns['offsets'].append(message.offset)
+        columns['roles'].append(ROLES.index(message.role))
+        columns['times'].append(ms)
+        columns['ends'].append(self.size)
+        self.offset = message.offset
+        # 没有时间或时间倒退的会话只能逐条比较
+        if ms <= RAW_TIME or ms < self.last_time:
+            self.sorted = False
+        self.last_time = ms
+
+    def commit(self, offset, head):
+        """写出新增内容，存储覆盖到 JSONL 的 offset 处；head 为 JSONL 开头的指纹"""
+        self.cols_path.parent.mkdir(parents=True, exist_ok=True)
+        start = self.size - sum(map(len, self.pending))
+        with open(self.blob_path, 'r+b' if start and self.blob_path.exists() else 'wb') as f:
+            f.truncate(start)
+            f.seek(start)
+            f.write(b''.join(self.pending))
+        self.pending = []
+        self.offset = offset
+        header = json.dumps({
+            'version': STORE_VERSION,
+            'count': len(self.columns['offsets']),
+            'offset': offset,
+            'size': self.size,
+            'block_cap': self.block_cap,
+            'sorted': self.sorted,
+            'head': head,
+            'byteorder': sys.byteorder,
+        }, separators=(',', ':'))
+        write_if_changed(self.cols_path, b''.join(
+            [header.encode('utf-8'), b'\n'] + [self.columns[name].tobytes() for name, _ in COLUMNS]))
+
+
+class MessageStore:
+    """只读打开一个会话的消息存储；正文内存映射，按需解码
+
+    用作上下文管理器，结束时释放映射（Windows 上映射中的文件不能被替换）。
+    """
+
+    def __init__(self, header, columns, blob_path):
+        self.header = header
+        self.offset = header['offset']
+        self.block_cap = header['block_cap']
+        self.offsets = columns['offsets']
+        self.roles = columns['roles']
+        self.times = columns['times']
+        self.ends = columns['ends']
+        self.file = open(blob_path, 'rb')
+        self.blob = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if header['size'] else b''
+
+    @classmethod
+    def open(cls, base_path):
+        """打开存储；不存在或不完整时返回 None"""
+        loaded = load_columns(base_path.with_name(base_path.name + '.cols'))
+        if not loaded:
+            return None
+        header, columns = loaded
+        blob_path = base_path.with_name(base_path.name + '.blob')
+        try:
+            if header['size'] and os.path.getsize(blob_path) < header['size']:
+                return None
+            return cls(header, columns, blob_path)
+        except OSError:
+            return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self.file.close()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def index_after(self, offset):
+        """JSONL 中位于 offset 之后的第一条消息的下标"""
+        return bisect_right(self.offsets, offset)
+
+    def matches(self, jsonl_path):
+        """存储是否仍是该 JSONL 文件的前缀（文件只在末尾追加过）"""
+        try:
+            return os.path.getsize(jsonl_path) >= self.offset \
+                and read_head_fingerprint(jsonl_path, self.offset) == self.header['head']
+        except OSError:
+            return False
+
+    def time_range(self, since=None, until=None):
+        """时间在 [since, until)（UTC 毫秒，None 表示不限）内的消息下标
+
+        时间递增的会话二分查找，返回 range；否则逐条比较时间列。指定了范围时没有时间的消息不算在内。
+        """
+        times = self.times
+        if since is None and until is None:
+            return range(len(self))
+        lo = -2 ** 63 if since is None else since
+        hi = 2 ** 63 - 1 if until is None else until
+        if self.header['sorted']:
+            return range(bisect_left(times, lo), bisect_left(times, hi))
+        indices = []
+        for i, ms in enumerate(times):
+            if ms == RAW_TIME:
+                ms = timestamp_ms(self.message(i).timestamp)
+                if ms is None:
+                    continue
+            if ms != NO_TIME and lo <= ms < hi:
+                indices.append(i)
+        return indices
+
+    def message(self, i):
+        """解码第 i 条消息"""
+        blob = self.blob
+        pos = self.ends[i - 1] if i else 0
+        ms = self.times[i]
+        if ms == NO_TIME:
+            timestamp = ''
+        elif ms == RAW_TIME:
+            n, = LENGTH.unpack_from(blob, pos)
+            timestamp = str(blob[pos + 4:pos + 4 + n], 'utf-8')
+            pos += 4 + n
+        else:
+            timestamp = decode_time(ms)
+        n, = LENGTH.unpack_from(blob, pos)
+        pos += 4
+        content = str(blob[pos:pos + n], 'utf-8')
+        pos += n
+        count, = LENGTH.unpack_from(blob, pos)
+        pos += 4
+        blocks = []
+        for _ in range(count):
+            kind, error, size, title_len, text_len, spill_len = BLOCK_HEADER.unpack_from(blob, pos)
+            pos += BLOCK_HEADER.size
+            title = str(blob[pos:pos + title_len], 'utf-8')
+            pos += title_len
+            text = str(blob[pos:pos + text_len], 'utf-8')
+            pos += text_len
+            spill = str(blob[pos:pos + spill_len], 'utf-8') if spill_len else None
+            pos += spill_len
+            blocks.append(Block(BLOCK_TYPES[kind], text, title, bool(error), size, spill))
+        return Message(ROLES[self.roles[i]], content, timestamp, self.offsets[i], blocks)
+
+    def messages(self, start=0, stop=None, interner=None):
+        """依次产出 [start, stop) 范围的消息；指定 interner 时经它去重（序号从 start 起算）"""
+        for i in range(start, len(self) if stop is None else min(stop, len(self))):
+            message = self.message(i)
+            if interner:
+                interner.add(message)
+            yield message
+
+
+def iter_time_range(jsonl_path, base_path=None, since=None, until=None, **kwargs):
+    """产出会话中时间在 [since, until)（UTC 毫秒）内的 (消息序号, 消息)
+
+    base_path 处有与该文件一致的消息存储时，存储覆盖的部分按时间索引直接定位，
+    之后追加的部分再解析 JSONL；否则解析整个文件。kwargs 传给 iter_messages（完整内容模式）。
+    """
+    start_offset = 0
+    seq = 0
+    store = MessageStore.open(base_path) if base_path else None
+    if store:
+        with store:
+            if store.block_cap == kwargs.get('block_cap') and store.matches(jsonl_path):
+                for i in store.time_range(since, until):
+                    yield i + 1, store.message(i)
+                start_offset, seq = store.offset, len(store)
+
+    bounded = since is not None or until is not None
+    for message in iter_messages(jsonl_path, start_offset, blocks=True, **kwargs):
+        seq += 1
+        if bounded:
+            ms = timestamp_ms(message.timestamp)
+            if ms is None or (since is not None and ms < since) or (until is not None and ms >= until):
+                continue
+        yield seq, message
+
+
+def session_view(jsonl_path, base_path=None, **kwargs):
+    """会话当前分支的视图（见 history_thread），消息序号与 iter_time_range 一致
+
+    base_path 处的消息存储和对话树与该文件一致时，只需接着读取之后追加的部分（不保存），
+    否则从头建立。kwargs 传给 iter_messages（完整内容模式）。
+    """
+    thread, seq = None, 0
+    store = MessageStore.open(base_path) if base_path else None
+    if store:
+        with store:
+            loaded, head = ThreadIndex.load(base_path.with_name(base_path.name + '.thread'))
+            if loaded and loaded.offset == store.offset and head == store.header['head'] \
+                    and store.matches(jsonl_path):
+                thread, seq = loaded, len(store)
+    if thread is None:
+        thread = ThreadIndex()
+    for message in iter_messages(jsonl_path, thread.offset, blocks=True, on_record=thread.add_line, **kwargs):
+        seq += 1
+        thread.mark_message(message.offset, seq)
+    return thread.view()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Claude 对话历史的对话树
+每条记录以 uuid / parentUuid 指向上一条记录。重试、编辑消息后重新生成时，会从较早的记录分出
+新的分支，新旧分支按写入顺序交错保存在同一个 JSONL 中；接续的会话（--continue / --resume）
+第一条记录的 parentUuid 指向另一个会话中的记录。
+
+解析 JSONL 时顺带单遍建立对话树：每条带 uuid 的记录只占几个整数（uuid 的 64 位哈希、父记录下标、
+消息序号、标志），uuid 到下标的哈希表用于查找父记录，与正文大小无关。
+当前分支为最后一条主线记录沿父记录回溯的路径，不在其上的其他主线记录即未采用的分支。
+
+每个会话保存为 <会话>.thread：一行 JSON 表头 + 各列的原始字节（array），会话追加内容时接着建立。
+"""
+
+import hashlib
+import json
+import re
+import sys
+from array import array
+
+from history_output import write_if_changed
+
+THREAD_VERSION = 1
+
+# 每条带 uuid 的记录一行：uuid 的哈希、父记录下标、消息序号（不是消息时为 0）、标志
+COLUMNS = (('hashes', 'q'), ('parents', 'q'), ('seqs', 'q'), ('flags', 'B'))
+
+# parents 列的特殊值：根记录；父记录不在本会话中（接续的会话，或尚未读到）
+NO_PARENT = -1
+EXTERNAL_PARENT = -2
+
+# flags 列：子代理（Task 工具）的记录，不属于主线对话
+SIDECHAIN = 1
+
+# 视图中记录的状态
+ACTIVE = 1
+ABANDONED = 2
+VISITING = 3
+
+# 未解码的记录（例如系统记录、文件快照）直接在原始字节中查找链接字段
+UUID_PATTERN = re.compile(rb'"uuid"\s*:\s*"([^"]+)"')
+PARENT_PATTERN = re.compile(rb'"parentUuid"\s*:\s*"([^"]+)"')
+LOGICAL_PARENT_PATTERN = re.compile(rb'"logicalParentUuid"\s*:\s*"([^"]+)"')
+SIDECHAIN_PATTERN = re.compile(rb'"isSidechain"\s*:\s*true')
+
+
+def uuid_hash(uuid):
+    """uuid 的 64 位哈希（有符号，存入 array('q')），跨进程稳定"""
+    return int.from_bytes(hashlib.blake2b(uuid.encode('utf-8'), digest_size=8).digest(), 'little', signed=True)
+
+
+def record_links(data, line):
+    """返回记录的 (uuid, 父记录 uuid, 是否为子代理记录)；没有 uuid 时返回 None
+
+    data 为解码后的记录，未解码时为 None，从原始行中查找。压缩上下文后的第一条记录
+    parentUuid 为空，logicalParentUuid 指向压缩前的最后一条记录，视为它的父记录。
+    """
+    if data is not None:
+        if not isinstance(data, dict):
+            return None
+        uuid = data.get('uuid')
+        if not isinstance(uuid, str) or not uuid:
+            return None
+        parent = data.get('parentUuid') or data.get('logicalParentUuid')
+        return uuid, parent if isinstance(parent, str) else None, data.get('isSidechain') is True
+    match = UUID_PATTERN.search(line)
+    if not match:
+        return None
+    parent = PARENT_PATTERN.search(line) or LOGICAL_PARENT_PATTERN.search(line)
+    return (match.group(1).decode('utf-8', 'replace'),
+            parent.group(1).decode('utf-8', 'replace') if parent else None,
+            SIDECHAIN_PATTERN.search(line) is not None)
+
+
+class ThreadView:
+    """对话树的一个视图
+
+    hidden 为未采用分支中的消息 {消息序号: 分出处的消息序号（0 表示会话开头）}；
+    leaf 为当前分支最后一条记录 uuid 的哈希，continues 为当前分支的根指向的其他会话中的 uuid。
+    """
+
+    __slots__ = ('hidden', 'leaf', 'continues')
+
+    def __init__(self, hidden, leaf, continues):
+        self.hidden = hidden
+        self.leaf = leaf
+        self.continues = continues
+
+    def digest(self, last_seq=None):
+        """序号不超过 last_seq 的未采用消息的摘要，用于判断已写出的内容是否需要重写"""
+        items = sorted((seq, fork) for seq, fork in self.hidden.items() if last_seq is None or seq <= last_seq)
+        return hashlib.sha1(json.dumps(items, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+
+
+class ThreadIndex:
+    """一个会话的对话树，按 JSONL 中的顺序逐条加入记录"""
+
+    def __init__(self):
+        self.columns = {name: array(typecode) for name, typecode in COLUMNS}
+        self.index = {}
+        # 父记录尚未出现的记录 {下标: 父记录 uuid}，及按父记录哈希的反查表
+        self.external = {}
+        self.pending = {}
+        self.offset = 0
+        self.last_offset = None
+
+    def __len__(self):
+        return len(self.columns['hashes'])
+
+    def add_line(self, data, line, offset):
+        """MessageStream 的 on_record 回调：加入 JSONL 中 offset 处结束的一行"""
+        if offset <= self.offset:
+            return
+        self.offset = offset
+        links = record_links(data, line)
+        if links:
+            self.add(*links)
+            self.last_offset = offset
+
+    def add(self, uuid, parent, sidechain=False):
+        """加入一条记录；uuid 重复时（例如归并后残留的副本）以第一条为准"""
+        columns = self.columns
+        i = len(columns['hashes'])
+        h = uuid_hash(uuid)
+        p = NO_PARENT
+        if parent:
+            p = self.index.get(uuid_hash(parent), EXTERNAL_PARENT)
+            if p == EXTERNAL_PARENT:
+                self.external[i] = parent
+                self.pending.setdefault(uuid_hash(parent), []).append(i)
+        columns['hashes'].append(h)
+        columns['parents'].append(p)
+        columns['seqs'].append(0)
+        columns['flags'].append(SIDECHAIN if sidechain else 0)
+        if h in self.index:
+            return
+        self.index[h] = i
+        # 先写出子记录、后写出父记录时补上链接
+        for child in self.pending.pop(h, ()):
+            columns['parents'][child] = i
+            del self.external[child]
+
+    def mark_message(self, offset, seq):
+        """最后加入的记录（JSONL 中 offset 处结束）是第 seq 条消息"""
+        if self.last_offset == offset:
+            self.columns['seqs'][-1] = seq
+
+    def view(self):
+        """选出当前分支：最后一条主线记录沿父记录回溯；线性时间
+
+        不在当前分支上的主线记录（包括编辑第一条消息后留下的旧根）都属于未采用的分支，
+        各记下它们沿父记录回溯到的第一条当前分支记录之前最近的消息序号。
+        """
+        hashes, parents, seqs, flags = (self.columns[name] for name, _ in COLUMNS)
+        n = len(hashes)
+        leaf = n - 1
+        while leaf >= 0 and flags[leaf] & SIDECHAIN:
+            leaf -= 1
+        if leaf < 0:
+            return ThreadView({}, None, None)
+        # 子代理记录不属于任何分支，视为已确定（anchor 为 0）
+        state = bytearray(ACTIVE if flag & SIDECHAIN else 0 for flag in flags)
+        anchor = array('q', bytes(8 * n))
+        path = []
+        i = leaf
+        while i >= 0 and not state[i]:
+            state[i] = ACTIVE
+            path.append(i)
+            i = parents[i]
+        root = path[-1]
+        # 从根往下：anchor 为当前分支上不晚于该记录的最近一条消息的序号
+        last = 0
+        for i in reversed(path):
+            last = anchor[i] = seqs[i] or last
+
+        # 其余记录沿父记录回溯到已确定的记录为止，整条链取它的 anchor；每条记录只处理一次
+        hidden = {}
+        for i in range(n):
+            if state[i]:
+                continue
+            chain = []
+            j = i
+            while j >= 0 and not state[j]:
+                state[j] = VISITING
+                chain.append(j)
+                j = parents[j]
+            base = anchor[j] if j >= 0 and state[j] != VISITING else 0
+            for k in chain:
+                state[k] = ABANDONED
+                anchor[k] = base
+                if seqs[k]:
+                    hidden[seqs[k]] = base
+        return ThreadView(hidden, hashes[leaf], self.external.get(root))
+
+    def contains(self, h):
+        """会话中是否有 uuid 哈希为 h 的记录"""
+        return h in self.index if self.index else h in self.columns['hashes']
+
+    def save(self, path, head):
+        """保存到 path；head 为 JSONL 开头的指纹"""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        header = json.dumps({
+            'version': THREAD_VERSION,
+            'count': len(self),
+            'offset': self.offset,
+            'last_offset': self.last_offset,
+            'head': head,
+            'external': {str(i): uuid for i, uuid in self.external.items()},
+            'byteorder': sys.byteorder,
+        }, separators=(',', ':'))
+        write_if_changed(path, b''.join(
+            [header.encode('utf-8'), b'\n'] + [self.columns[name].tobytes() for name, _ in COLUMNS]))
+
+    @classmethod
+    def load(cls, path, resumable=True):
+        """读取保存的对话树；不存在或格式不符时返回 (None, None)，否则返回 (对话树, head)
+
+        resumable 为假时不建立 uuid 的哈希表，只能用于 view 和 contains。
+        """
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if header.get('version') != THREAD_VERSION:
+                    return None, None
+                thread = cls()
+                for name, typecode in COLUMNS:
+                    values = thread.columns[name]
+                    values.fromfile(f, header['count'])
+                    if header['byteorder'] != sys.byteorder:
+                        values.byteswap()
+        except (OSError, ValueError, KeyError, EOFError):
+            return None, None
+        thread.offset, thread.last_offset = header['offset'], header['last_offset']
+        thread.external = {int(i): uuid for i, uuid in header['external'].items()}
+        if resumable:
+            index = thread.index
+            for i, h in enumerate(thread.columns['hashes']):
+                index.setdefault(h, i)
+            for i, uuid in thread.external.items():
+                thread.pending.setdefault(uuid_hash(uuid), []).append(i)
+        return thread, header['head']
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+"""测试直接导入仓库根目录下的 history_* 模块；带连字符的脚本用 load_script 加载"""
+
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+
+def load_script(file_name, module_name):
+    """加载仓库根目录下文件名含连字符的脚本，注册到 sys.modules（进程池按模块名序列化对象）"""
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+    spec = importlib.util.spec_from_file_location(module_name, ROOT / file_name)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def message(uuid, parent, role, text, second=0):
+    """一条消息记录"""
+    return {
+        'type': role, 'uuid': uuid, 'parentUuid': parent,
+        'timestamp': f'2026-10-01T00:00:{second:02d}.000Z',
+        'message': {'role': role, 'content': [{'type': 'text', 'text': text}]},
+    }
+
+
+def write_session(path, records, mode='w'):
+    """写出 JSONL 会话；records 中的 dict 编码为 JSON，str 原样写出（例如损坏的行）"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, mode, encoding='utf-8') as f:
+        for record in records:
+            f.write((record if isinstance(record, str) else json.dumps(record, ensure_ascii=False)) + '\n')
+    return path
+
+
+@pytest.fixture
+def manager_module():
+    return load_script('claude-history-manager.py', 'claude_history_manager')
+
+
+@pytest.fixture
+def claude_dir(tmp_path):
+    return tmp_path / '.claude'
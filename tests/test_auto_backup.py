@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""自动备份：导出过程的输出写入日志，包括并行导出时工作进程中的输出"""
+
+import multiprocessing
+
+import pytest
+
+from conftest import load_script, message, write_session
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_worker_warnings_reach_log(tmp_path, monkeypatch, manager_module, jobs):
+    if jobs > 1 and multiprocessing.get_start_method() != 'fork':
+        pytest.skip("process pool needs the fork start method")
+    monkeypatch.setenv('HOME', str(tmp_path))
+    projects = tmp_path / '.claude' / 'projects' / 'p'
+    for name in ('a', 'b', 'c', 'd'):
+        write_session(projects / f'{name}.jsonl', [
+            message(f'{name}1', None, 'user', 'hello'),
+            '{"type": "user", "message": {"content": [{"type": "text", "text": "cut',
+            message(f'{name}2', f'{name}1', 'assistant', 'world', 1),
+        ])
+
+    auto_backup = load_script('auto-backup.py', 'auto_backup')
+    backup = auto_backup.AutoBackup()
+    backup.manager = manager_module.ClaudeHistoryManager(jobs=jobs)
+    backup.backup()
+
+    log = backup.log_file.read_text(encoding='utf-8')
+    assert log.count('skipping malformed record') == 4
+    assert 'Backup completed successfully' in log
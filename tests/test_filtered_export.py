@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""筛选导出与完整导出显示同一条当前分支"""
+
+from conftest import load_script, message, write_session
+
+RECORDS = [
+    message('u1', None, 'user', 'first prompt', 0),
+    message('a1', 'u1', 'assistant', 'OLD BRANCH answer', 1),
+    # 重试：同一条提问的新回答
+    message('a1b', 'u1', 'assistant', 'new answer', 2),
+    message('u2', 'a1b', 'user', 'edited-away prompt', 3),
+    message('a2', 'u2', 'assistant', 'reply to edited-away prompt', 4),
+    # 编辑提问后重新生成
+    message('u2b', 'a1b', 'user', 'edited prompt', 5),
+    message('a2b', 'u2b', 'assistant', 'final reply', 6),
+]
+
+HIDDEN = ('OLD BRANCH answer', 'edited-away prompt', 'reply to edited-away prompt')
+SHOWN = ('first prompt', 'new answer', 'edited prompt', 'final reply')
+
+
+def check_active_branch(text):
+    for hidden in HIDDEN:
+        assert hidden not in text
+    for shown in SHOWN:
+        assert shown in text
+
+
+def test_filtered_export_hides_abandoned_branches(tmp_path, manager_module):
+    session = write_session(tmp_path / '.claude' / 'projects' / 'proj' / 's.jsonl', RECORDS)
+    manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / 'out')
+
+    # 没有导出过：从头建立对话树
+    check_active_branch(manager.export_filtered(project='proj', out_path=tmp_path / 'f0.md').read_text('utf-8'))
+
+    manager.export_all()
+    check_active_branch((tmp_path / 'out' / 'sessions' / 'proj' / 's.md').read_text('utf-8'))
+    check_active_branch(manager.export_filtered(project='proj', out_path=tmp_path / 'f1.md').read_text('utf-8'))
+
+    # 导出之后追加的重试：存储之后的部分接着建立对话树
+    write_session(session, [
+        message('a2c', 'u2b', 'assistant', 'retried final reply', 7),
+    ], mode='a')
+    text = manager.export_filtered(project='proj', out_path=tmp_path / 'f2.md').read_text('utf-8')
+    assert 'final reply' not in text.replace('retried final reply', '')
+    assert '## 8.' in text and '## 7.' not in text
+
+
+def test_view_history_filter_hides_abandoned_branches(tmp_path, monkeypatch, manager_module):
+    session = write_session(tmp_path / '.claude' / 'projects' / 'proj' / 's.jsonl', RECORDS)
+    manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / 'out')
+    manager.export_all()
+
+    view_history = load_script('view-history.py', 'view_history')
+    for store_dir in (tmp_path / 'out' / '.store', tmp_path / 'missing'):
+        monkeypatch.setattr(view_history, 'STORE_DIR', store_dir)
+        with open(tmp_path / 'v.md', 'w', encoding='utf-8') as f:
+            count = view_history.write_filtered_markdown(f, [session], since=0)
+        assert count == len(SHOWN)
+        check_active_branch((tmp_path / 'v.md').read_text('utf-8'))
@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""原始历史归档：追加只存新增的字节、快照顺序、还原和清理"""
+
+import json
+from datetime import datetime
+
+import pytest
+
+import history_archive
+from history_archive import HistoryArchive, snapshot_key
+
+
+class FrozenDatetime(datetime):
+    """所有快照都在同一秒内创建"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return cls(2026, 10, 18, 12, 0, 0)
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / 'projects' / 'p' / 's.jsonl'
+    path.parent.mkdir(parents=True)
+    return path
+
+
+def restored(archive, name, tmp_path):
+    target = tmp_path / f'restore-{name}'
+    archive.restore(name, target)
+    return (target / 'p' / 's.jsonl').read_bytes()
+
+
+def test_append_stores_only_new_bytes(tmp_path, source):
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    source.write_bytes(bytes(range(40)))
+    first, stats = archive.snapshot(source.parent.parent)
+    assert stats['chunks'] == 3
+
+    with open(source, 'ab') as f:
+        f.write(b'bcdef')
+    second, stats = archive.snapshot(source.parent.parent)
+    assert stats['chunks'] == 1 and stats['changed'] == 1
+    record = archive.load_snapshot(second)['files']['p/s.jsonl']
+    assert record['sizes'] == [16, 16, 8, 5]
+    assert record['chunks'][:3] == archive.load_snapshot(first)['files']['p/s.jsonl']['chunks']
+
+    assert restored(archive, first, tmp_path) == bytes(range(40))
+    assert restored(archive, second, tmp_path) == bytes(range(40)) + b'bcdef'
+
+
+def test_rewritten_file_is_chunked_again(tmp_path, source):
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    source.write_bytes(b'x' * 20)
+    first, _ = archive.snapshot(source.parent.parent)
+    # 截断后重写，且比原来更长：首块已变，不能当作追加
+    source.write_bytes(b'y' * 30)
+    second, stats = archive.snapshot(source.parent.parent)
+    assert archive.load_snapshot(second)['files']['p/s.jsonl']['sizes'] == [16, 14]
+    assert restored(archive, first, tmp_path) == b'x' * 20
+    assert restored(archive, second, tmp_path) == b'y' * 30
+    assert archive.snapshot(source.parent.parent)[0] is None
+
+
+def test_legacy_record_without_sizes(tmp_path, source):
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    source.write_bytes(b'z' * 40)
+    name, _ = archive.snapshot(source.parent.parent)
+    path = archive.snapshots_dir / f'{name}.json'
+    snapshot = json.loads(path.read_text('utf-8'))
+    del snapshot['files']['p/s.jsonl']['sizes']
+    path.write_text(json.dumps(snapshot), 'utf-8')
+
+    with open(source, 'ab') as f:
+        f.write(b'!')
+    name, stats = archive.snapshot(source.parent.parent)
+    assert stats['chunks'] == 1
+    assert archive.load_snapshot(name)['files']['p/s.jsonl']['sizes'] == [16, 16, 8, 1]
+    assert restored(archive, name, tmp_path) == b'z' * 40 + b'!'
+
+
+def test_snapshots_in_the_same_second_stay_in_order(tmp_path, source, monkeypatch):
+    monkeypatch.setattr(history_archive, 'datetime', FrozenDatetime)
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    names = []
+    for i in range(12):
+        with open(source, 'ab') as f:
+            f.write(b'%d\n' % i)
+        name, stats = archive.snapshot(source.parent.parent)
+        # 每次都以上一个快照为基准，只存新增的字节
+        assert stats['chunks'] == 1
+        names.append(name)
+    assert names[0] == '20261018-120000'
+    assert names[1] == '20261018-120000-0001'
+    assert names[11] == '20261018-120000-0011'
+    assert archive.list_snapshots() == names == sorted(names)
+    assert restored(archive, names[-1], tmp_path) == b''.join(b'%d\n' % i for i in range(12))
+
+
+def test_legacy_snapshot_names_sort_numerically(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_archive, 'datetime', FrozenDatetime)
+    archive = HistoryArchive(tmp_path / 'archive')
+    archive.snapshots_dir.mkdir(parents=True)
+    for name in ('20261018-120000', '20261018-120000-9', '20261018-120000-10', '20261018-115959'):
+        (archive.snapshots_dir / f'{name}.json').write_text('{"files": {}}', 'utf-8')
+    snapshots = archive.list_snapshots()
+    assert snapshots == ['20261018-115959', '20261018-120000', '20261018-120000-9', '20261018-120000-10']
+    name = archive.next_snapshot_name(snapshots)
+    assert name == '20261018-120000-0011'
+    assert snapshot_key(name) > snapshot_key(snapshots[-1])
+
+
+def test_prune_removes_unreferenced_chunks(tmp_path, source, monkeypatch):
+    monkeypatch.setattr(history_archive, 'PRUNE_GRACE_SECONDS', -1)
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    source.write_bytes(b'old contents....' * 2)
+    archive.snapshot(source.parent.parent)
+    source.write_bytes(b'new contents....' * 2)
+    name, _ = archive.snapshot(source.parent.parent)
+
+    assert archive.prune() == (0, 0)
+    assert archive.prune(keep=1) == (1, 1)
+    assert archive.list_snapshots() == [name]
+    assert restored(archive, name, tmp_path) == b'new contents....' * 2
+
+
+def test_prune_keeps_recent_chunks(tmp_path, source):
+    archive = HistoryArchive(tmp_path / 'archive', chunk_size=16)
+    source.write_bytes(b'data')
+    archive.snapshot(source.parent.parent)
+    # 尚未写入快照清单的块（例如另一个进程正在创建快照）
+    archive.store_chunk(b'in progress', {'chunks': 0, 'bytes': 0})
+    assert archive.prune() == (0, 0)
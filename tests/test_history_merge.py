@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""多数据目录合并：按时间归并、去重，以及归并结果的追加和重写"""
+
+import json
+
+import pytest
+
+from conftest import message, write_session
+from history_merge import MergedFile, merge_files
+
+
+def uuids(path):
+    return [json.loads(line)['uuid'] for line in path.read_text('utf-8').splitlines()]
+
+
+def leftovers(path):
+    return sorted(p.name for p in path.parent.iterdir() if p != path)
+
+
+@pytest.fixture
+def copies(tmp_path):
+    """两台电脑上的同一会话：开头相同，之后各自有记录"""
+    a = write_session(tmp_path / 'a' / 's.jsonl', [
+        message('u1', None, 'user', 'q1', 0), message('a1', 'u1', 'assistant', 'r1', 1),
+        message('u3', 'a1', 'user', 'q3', 3)])
+    b = write_session(tmp_path / 'b' / 's.jsonl', [
+        message('u1', None, 'user', 'q1', 0), message('a1', 'u1', 'assistant', 'r1', 1),
+        message('u2', 'a1', 'user', 'q2', 2)])
+    return a, b, tmp_path / 'merged' / 's.jsonl'
+
+
+def test_merge_orders_by_time_and_drops_duplicates(copies):
+    a, b, target = copies
+    assert merge_files([a, b], target) == ('rewritten', 2)
+    assert uuids(target) == ['u1', 'a1', 'u2', 'u3']
+    assert merge_files([a, b], target) == ('unchanged', 2)
+    assert leftovers(target) == []
+
+
+def test_new_records_at_the_end_are_appended(copies):
+    a, b, target = copies
+    merge_files([a, b], target)
+    before = target.read_bytes()
+    write_session(a, [message('a3', 'u3', 'assistant', 'r3', 4)], mode='a')
+    assert merge_files([a, b], target)[0] == 'appended'
+    assert target.read_bytes().startswith(before)
+    assert uuids(target) == ['u1', 'a1', 'u2', 'u3', 'a3']
+
+
+def test_shorter_result_is_rewritten(copies):
+    a, b, target = copies
+    merge_files([a, b], target)
+    # 一个副本被截断：归并结果变短，截掉多余的部分
+    write_session(b, [message('u1', None, 'user', 'q1', 0)])
+    assert merge_files([a, b], target) == ('rewritten', 1)
+    assert uuids(target) == ['u1', 'a1', 'u3']
+    # 中间插入较早的记录：前缀之后的内容不同
+    write_session(b, [message('u0', None, 'user', 'q0', 2)])
+    assert merge_files([a, b], target)[0] == 'rewritten'
+    assert uuids(target) == ['u1', 'a1', 'u0', 'u3']
+    assert leftovers(target) == []
+
+
+def test_failed_rewrite_keeps_target(copies):
+    a, b, target = copies
+    merge_files([a, b], target)
+    before = target.read_bytes()
+    with pytest.raises(RuntimeError):
+        with MergedFile(target) as out:
+            out.write(b'different\n')
+            raise RuntimeError
+    assert target.read_bytes() == before
+    assert leftovers(target) == []
+
+
+def test_concurrent_rewrites_use_separate_temp_files(copies):
+    a, b, target = copies
+    merge_files([a, b], target)
+    first, second = MergedFile(target), MergedFile(target)
+    with first:
+        first.write(b'first\n')
+        with second:
+            second.write(b'second\n')
+    assert target.read_bytes() == b'first\n'
+    assert leftovers(target) == []
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""全文索引：切词、增量写入和截断重建、浏览器端分片，以及与导出的当前分支一致"""
+
+import multiprocessing
+import sqlite3
+
+import pytest
+
+from conftest import load_script, message, write_session
+from history_parser import Message
+from history_search import SearchIndex, build_match_query, tokenize
+
+RECORDS = [
+    message('u1', None, 'user', 'first prompt', 0),
+    message('a1', 'u1', 'assistant', 'abandoned answer', 1),
+    message('a1b', 'u1', 'assistant', 'accepted answer', 2),
+]
+
+
+def export(tmp_path, out='out', jobs=1, branches='active'):
+    module = load_script('claude-history-manager.py', 'claude_history_manager')
+    manager = module.ClaudeHistoryManager(jobs=jobs, claude_dir=tmp_path / '.claude',
+                                          output_dir=tmp_path / out, branches=branches)
+    manager.export_all()
+    return manager
+
+
+def hits(manager, query):
+    return sorted(hit['snippet'] for hit in manager.get_search_index().search(query))
+
+
+def shard_text(search_dir):
+    return ''.join(path.read_text('utf-8') for path in sorted(search_dir.glob('*.js')))
+
+
+def test_abandoned_branches_are_not_searchable(tmp_path):
+    session = write_session(tmp_path / '.claude' / 'projects' / 'p' / 's.jsonl', RECORDS)
+    manager = export(tmp_path)
+    assert hits(manager, 'answer') == ['accepted answer']
+    assert hits(manager, 'abandoned') == []
+    text = shard_text(tmp_path / 'out' / 'search')
+    assert 'accepted answer' in text and 'abandoned' not in text
+
+    # 之后追加的重试让原来的回答也成为未采用的分支
+    write_session(session, [message('a1c', 'u1', 'assistant', 'retried answer', 3)], mode='a')
+    manager = export(tmp_path)
+    assert hits(manager, 'answer') == ['retried answer']
+    text = shard_text(tmp_path / 'out' / 'search')
+    assert 'retried answer' in text and 'accepted' not in text and 'abandoned' not in text
+
+
+def test_all_branches_mode_keeps_them_searchable(tmp_path):
+    write_session(tmp_path / '.claude' / 'projects' / 'p' / 's.jsonl', RECORDS)
+    export(tmp_path)
+    manager = export(tmp_path, branches='all')
+    assert hits(manager, 'answer') == ['abandoned answer', 'accepted answer']
+    manager = export(tmp_path)
+    assert hits(manager, 'answer') == ['accepted answer']
+
+
+@pytest.mark.skipif(multiprocessing.get_start_method() != 'fork', reason="process pool needs fork")
+def test_parallel_export_writes_identical_shards(tmp_path):
+    for name in 'abcd':
+        write_session(tmp_path / '.claude' / 'projects' / 'p' / f'{name}.jsonl', [
+            message(f'{name}1', None, 'user', f'question {name} 中文检索', 0),
+            message(f'{name}2', f'{name}1', 'assistant', f'old reply {name}', 1),
+            message(f'{name}3', f'{name}1', 'assistant', f'new reply {name}', 2),
+        ])
+    export(tmp_path, 'j1', jobs=1)
+    export(tmp_path, 'j4', jobs=4)
+    files = sorted(p.name for p in (tmp_path / 'j1' / 'search').iterdir())
+    assert files == sorted(p.name for p in (tmp_path / 'j4' / 'search').iterdir())
+    for name in files:
+        assert (tmp_path / 'j1' / 'search' / name).read_bytes() == (tmp_path / 'j4' / 'search' / name).read_bytes()
+
+
+def test_old_database_gains_hidden_columns(tmp_path):
+    db = tmp_path / 'search.db'
+    conn = sqlite3.connect(str(db))
+    conn.execute('CREATE TABLE sessions (id INTEGER PRIMARY KEY, path TEXT UNIQUE NOT NULL, '
+                 'project TEXT NOT NULL, session TEXT NOT NULL, offset INTEGER NOT NULL DEFAULT 0, '
+                 'count INTEGER NOT NULL DEFAULT 0)')
+    conn.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY, session_id INTEGER NOT NULL, '
+                 'seq INTEGER NOT NULL, role TEXT NOT NULL, timestamp TEXT NOT NULL, content TEXT NOT NULL)')
+    conn.commit()
+    conn.close()
+    index = SearchIndex(db)
+    assert index.hidden_digests() == {}
+    assert 'hidden' in {row[1] for row in index.conn.execute('PRAGMA table_info(messages)')}
+    index.close()
+
+
+def test_tokenize_cjk_bigrams():
+    assert list(tokenize('全文检索 Search-Index 2026')) == ['全文', '文检', '检索', '索', 'search', 'index', '2026']
+    assert list(tokenize('中')) == ['中']
+    assert build_match_query('全文检索 idx') == '"全文 文检 检索" "idx"*'
+    assert build_match_query('...') == ''
+
+
+def add_messages(index, path, texts, start=0, reset=False):
+    """像导出时那样增量写入会话的消息，偏移即消息序号"""
+    writer = index.writer(path, 'proj', 's', reset=reset)
+    for i, text in enumerate(texts, start + 1):
+        writer.add(Message('user' if i % 2 else 'assistant', text, f'2026-10-01T00:00:{i:02d}.000Z', i))
+    writer.flush()
+
+
+def found(index, query):
+    return sorted(hit['seq'] for hit in index.search(query))
+
+
+def test_index_round_trip_append_and_truncate(tmp_path):
+    index = SearchIndex(tmp_path / 'search.db')
+    add_messages(index, 'a.jsonl', ['建立全文检索索引', 'sqlite fts5 tokenizer', ''])
+    assert found(index, '检索') == [1] and found(index, '索') == [1]
+    assert found(index, '全文索引') == []
+    assert found(index, 'token') == [2]
+    # 空消息占用序号，但不进入索引
+    assert index.session_state('a.jsonl')[1:] == (3, 3)
+
+    # 追加：接着已索引的偏移和序号写入
+    add_messages(index, 'a.jsonl', ['再次检索 tokenizer'], start=3)
+    assert found(index, '检索') == [1, 4] and found(index, 'tokenizer') == [2, 4]
+
+    # 截断后重新解析：原有内容全部移出索引
+    add_messages(index, 'a.jsonl', ['截断后的内容'], reset=True)
+    assert found(index, '检索') == [] and found(index, 'tokenizer') == []
+    assert found(index, '截断') == [1]
+    assert index.session_state('a.jsonl')[1:] == (1, 1)
+
+    assert index.remove_session('a.jsonl')
+    assert found(index, '截断') == [] and index.session_offsets() == {}
+    index.close()
+
+
+def test_staged_writes_match_direct_writes(tmp_path):
+    direct = SearchIndex(tmp_path / 'direct.db')
+    staged = SearchIndex(tmp_path / 'staged.db', staged=True)
+    for index in (direct, staged):
+        add_messages(index, 'b.jsonl', ['second session'])
+        add_messages(index, 'a.jsonl', ['first session', '检索'])
+    # 暂存的内容按给定顺序写入，与依次写入时的 id 相同
+    assert staged.search('session') == []
+    assert staged.apply_staged(['b.jsonl', 'a.jsonl', 'missing.jsonl']) == 2
+    query = 'SELECT m.id, s.path, m.seq, m.content FROM messages m JOIN sessions s ON s.id = m.session_id ORDER BY m.id'
+    assert list(staged.conn.execute(query)) == list(direct.conn.execute(query))
+    assert staged.search('检索') == direct.search('检索')
+    assert staged.session_offsets() == direct.session_offsets() == {'a.jsonl': 2, 'b.jsonl': 1}
+
+
+def test_incremental_shards_match_full_export(tmp_path):
+    index = SearchIndex(tmp_path / 'search.db')
+
+    def describe(project, session):
+        return project, f'{session}.html'
+
+    add_messages(index, 'a.jsonl', ['全文检索 alpha', 'beta'])
+    add_messages(index, 'b.jsonl', ['gamma 检索'])
+    assert index.export_shards(tmp_path / 'inc', describe)[0] > 0
+    add_messages(index, 'a.jsonl', ['delta 全文'], start=2)
+    add_messages(index, 'b.jsonl', ['epsilon'], reset=True)
+    keys, chunks = index.export_shards(tmp_path / 'inc', describe)
+    assert 0 < keys and chunks == 1
+    assert index.export_shards(tmp_path / 'inc', describe) == (0, 0)
+
+    index.export_shards(tmp_path / 'full', describe)
+    files = sorted(p.name for p in (tmp_path / 'full').iterdir())
+    assert files == sorted(p.name for p in (tmp_path / 'inc').iterdir())
+    for name in files:
+        assert (tmp_path / 'inc' / name).read_bytes() == (tmp_path / 'full' / name).read_bytes(), name
+    assert 'gamma' not in shard_text(tmp_path / 'inc')
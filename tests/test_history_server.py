@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""serve 模式：按需渲染的页面与导出的文件一致，会话变化后缓存和 ETag 随之更新"""
+
+import gzip
+import http.client
+import shutil
+import threading
+
+import pytest
+
+from conftest import message, write_session
+from history_server import HistoryServer, LRUCache
+
+
+def reply(uuid, parent, text, second, output_tokens):
+    record = message(uuid, parent, 'assistant', text, second)
+    record['message'].update(id=f'msg-{uuid}', model='claude-test',
+                             usage={'input_tokens': 10, 'output_tokens': output_tokens})
+    return record
+
+
+@pytest.fixture
+def site(tmp_path, manager_module):
+    session = write_session(tmp_path / '.claude' / 'projects' / 'proj' / 's.jsonl', [
+        message('u1', None, 'user', 'question ' * 200), reply('a1', 'u1', 'answer', 1, 20)])
+
+    def manager(out):
+        return manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / out,
+                                                   html_pages=True)
+
+    manager('out').export_all()
+    server = HistoryServer(('127.0.0.1', 0), manager('out'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def get(path, **headers):
+        conn = http.client.HTTPConnection('127.0.0.1', server.server_port, timeout=10)
+        conn.request('GET', path, headers=headers)
+        response = conn.getresponse()
+        body = response.read()
+        conn.close()
+        return response, body
+
+    def exported(path):
+        """在输出目录的副本上完整导出，返回其中的文件"""
+        shutil.rmtree(tmp_path / 'copy', ignore_errors=True)
+        shutil.copytree(tmp_path / 'out', tmp_path / 'copy')
+        manager('copy').export_all()
+        return (tmp_path / 'copy' / path).read_bytes()
+
+    yield session, get, exported
+    server.shutdown()
+    server.server_close()
+
+
+def test_pages_match_exported_files(site):
+    _, get, exported = site
+    for path in ('index.html', 'sessions/proj/s/index.html', 'sessions/proj/s/page-1.html'):
+        response, body = get('/' + path)
+        assert response.status == 200
+        assert body == exported(path), path
+
+    response, _ = get('/sessions/proj/s.md')
+    assert response.status == 302 and response.getheader('Location') == '/sessions/proj/s/index.html'
+    for path in ('/sessions/proj/s/page-2.html', '/sessions/proj/missing/index.html',
+                 '/sessions/../proj/s/index.html', '/search/../.manifest.json', '/other'):
+        assert get(path)[0].status == 404, path
+
+
+def test_etag_gzip_and_updates_after_append(site):
+    session, get, exported = site
+    response, body = get('/sessions/proj/s/page-1.html', **{'Accept-Encoding': 'gzip'})
+    assert response.getheader('Content-Encoding') == 'gzip'
+    etag = response.getheader('ETag')
+    assert gzip.decompress(body) == get('/sessions/proj/s/page-1.html')[1]
+    assert get('/sessions/proj/s/page-1.html', **{'If-None-Match': etag})[0].status == 304
+
+    # 会话追加后缓存键（文件大小）变化：重新渲染，与重新导出的页面一致
+    write_session(session, [message('u2', 'a1', 'user', 'follow-up', 5), reply('a2', 'u2', 'more', 6, 30)],
+                  mode='a')
+    response, body = get('/sessions/proj/s/page-1.html', **{'If-None-Match': etag})
+    assert response.status == 200 and response.getheader('ETag') != etag
+    assert body == exported('sessions/proj/s/page-1.html')
+    # 索引页的会话信息和用量图表同样更新，多次渲染不会重复计算
+    for second in (7, 8):
+        write_session(session, [reply(f'a{second}', 'a2', 'again', second, 5)], mode='a')
+        assert get('/')[1] == exported('index.html')
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""用量汇总表：保存后读回、增量导出时的叠加和扣除，与从头导出的结果一致"""
+
+from array import array
+from datetime import date
+
+import pytest
+
+from conftest import message, write_session
+from history_stats import METRICS, WIDTH, UsageCollector, UsageStats
+
+
+def reply(uuid, parent, text, day, output_tokens, model='claude-test', message_id=None):
+    """带用量的助手消息"""
+    record = message(uuid, parent, 'assistant', text)
+    record['timestamp'] = f'2026-10-{day:02d}T12:00:00.000Z'
+    record['message'].update(id=message_id or f'msg-{uuid}', model=model, usage={
+        'input_tokens': 10, 'output_tokens': output_tokens,
+        'cache_read_input_tokens': 100, 'cache_creation_input_tokens': 0})
+    return record
+
+
+def prompt(uuid, parent, text, day):
+    record = message(uuid, parent, 'user', text)
+    record['timestamp'] = f'2026-10-{day:02d}T11:59:00.000Z'
+    return record
+
+
+def summary(stats):
+    return stats.daily(), stats.totals('p:'), stats.totals('m:')
+
+
+def test_save_and_load_round_trip(tmp_path):
+    stats = UsageStats()
+    stats.apply('proj', {'2026-10-05\tclaude-test': [0, 0, 1, 10, 20, 0, 0], '2026-10-05\t': [1, 1, 0, 0, 0, 0, 0]})
+    # 更早和更晚的日子：数组向前、向后扩展
+    stats.apply('other', {'2026-10-01\t': [2, 0, 0, 0, 0, 0, 0], '2026-10-09\tx': [0, 0, 1, 5, 5, 0, 0],
+                          'unknown\t': [1, 0, 0, 0, 0, 0, 0]})
+    stats.generation = 3
+    stats.save(tmp_path / 'stats.bin')
+
+    loaded = UsageStats.load(tmp_path / 'stats.bin')
+    assert (loaded.first_day, loaded.days, loaded.generation) == (date(2026, 10, 1).toordinal(), 9, 3)
+    assert loaded.series == stats.series
+    assert loaded.totals('p:') == {'proj': [1, 1, 1, 10, 20, 0, 0], 'other': [2, 0, 1, 5, 5, 0, 0]}
+    assert loaded.totals('m:') == {'claude-test': [0, 0, 1, 10, 20, 0, 0], 'x': [0, 0, 1, 5, 5, 0, 0]}
+    assert [day for day, _ in loaded.daily()] == [date(2026, 10, 1), date(2026, 10, 5), date(2026, 10, 9)]
+
+    loaded.apply('other', {'2026-10-01\t': [2, 0, 0, 0, 0, 0, 0], '2026-10-09\tx': [0, 0, 1, 5, 5, 0, 0]}, -1)
+    loaded.prune()
+    assert sorted(loaded.series) == ['m:claude-test', 'p:proj']
+
+
+def test_unreadable_file_loads_empty(tmp_path):
+    path = tmp_path / 'stats.bin'
+    assert UsageStats.load(path).series == {}
+    path.write_bytes(b'{"version": 1, "metrics": ["other"]}\n')
+    assert UsageStats.load(path).series == {}
+    stats = UsageStats()
+    stats.apply('p', {'2026-10-01\t': [1] * WIDTH})
+    stats.save(path)
+    path.write_bytes(path.read_bytes()[:-8])
+    assert UsageStats.load(path).series == {}
+    assert len(METRICS) == WIDTH and isinstance(stats.series['p:p'], array)
+
+
+def test_repeated_records_of_one_response_count_once():
+    collector = UsageCollector({})
+    for output_tokens in (1, 5, 5, 8):
+        collector.add_usage(('msg-1', 'm', '2026-10-01T00:00:00Z', {'input_tokens': 3, 'output_tokens': output_tokens}))
+    entry = {}
+    collector.update(entry)
+    assert entry['usage'] == {'2026-10-01\tm': [0, 0, 1, 3, 8, 0, 0]}
+
+    # 增量解析从上次的最后一条响应之后继续：同一响应的后续记录仍只补上增加的部分
+    collector = UsageCollector(entry)
+    collector.add_usage(('msg-1', 'm', '2026-10-01T00:00:00Z', {'input_tokens': 3, 'output_tokens': 12}))
+    collector.add_usage(('msg-2', 'm', '2026-10-01T00:00:00Z', {'input_tokens': 1}))
+    collector.update(entry)
+    assert entry['usage'] == {'2026-10-01\tm': [0, 0, 2, 4, 12, 0, 0]}
+
+
+@pytest.fixture
+def export(tmp_path, manager_module):
+    def run(out='out'):
+        manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / out)
+        manager.export_all()
+        # 重新加载：检查保存的文件而不是内存中的汇总表
+        return summary(manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude',
+                                                           output_dir=tmp_path / out).get_stats())
+    return run
+
+
+def test_incremental_export_matches_fresh_export(tmp_path, export):
+    projects = tmp_path / '.claude' / 'projects'
+    a = write_session(projects / 'proj-a' / 'a.jsonl', [
+        prompt('u1', None, 'first', 1), reply('r1', 'u1', 'answer', 1, 50)])
+    b = write_session(projects / 'proj-b' / 'b.jsonl', [
+        prompt('v1', None, 'other', 3), reply('s1', 'v1', 'answer', 3, 7, model='claude-other')])
+    _, projects_total, models = export()
+    assert projects_total == {'proj-a': [1, 1, 1, 10, 50, 100, 0], 'proj-b': [1, 1, 1, 10, 7, 100, 0]}
+    assert set(models) == {'claude-test', 'claude-other'}
+
+    # 追加：同一响应的下一条记录（另一个内容块）跨越增量边界，之后是新的一天
+    write_session(a, [reply('r1b', 'u1', 'answer', 1, 80, message_id='msg-r1'),
+                      prompt('u2', 'r1b', 'next', 2), reply('r2', 'u2', 'more', 2, 5)], mode='a')
+    incremental = export()
+    assert incremental[1]['proj-a'] == [2, 3, 2, 20, 85, 200, 0]
+    assert [day.day for day, _ in incremental[0]] == [1, 2, 3]
+    assert export('fresh') == incremental
+
+    # 截断后重写：减去原有的用量，按新内容重新统计
+    write_session(a, [prompt('u1', None, 'first', 4), reply('r9', 'u1', 'rewritten', 4, 1)])
+    incremental = export()
+    assert incremental[1]['proj-a'] == [1, 1, 1, 10, 1, 100, 0]
+    assert [day.day for day, _ in incremental[0]] == [3, 4]
+    (tmp_path / 'fresh' / '.manifest.json').unlink()
+    assert export('fresh') == incremental
+
+    # 删除会话：它的项目和模型列一并消失
+    b.unlink()
+    incremental = export()
+    assert set(incremental[1]) == {'proj-a'} and set(incremental[2]) == {'claude-test'}
+    (tmp_path / 'fresh' / '.manifest.json').unlink()
+    assert export('fresh') == incremental
+
+
+def test_stale_stats_file_is_rebuilt_from_manifest(tmp_path, export, manager_module):
+    write_session(tmp_path / '.claude' / 'projects' / 'p' / 's.jsonl', [
+        prompt('u1', None, 'first', 1), reply('r1', 'u1', 'answer', 1, 50)])
+    expected = export()
+    # 汇总表停留在上次导出之前（例如保存清单前中断）
+    stale = UsageStats()
+    stale.apply('p', {'2026-10-01\t': [9] * WIDTH})
+    stale.save(tmp_path / 'out' / '.stats.bin')
+    manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / 'out')
+    assert summary(manager.get_stats()) == expected
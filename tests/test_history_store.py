@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""消息存储：写入后读回、追加续写、截断或重写后重新解析，以及按时间定位"""
+
+import pytest
+
+from conftest import message, write_session
+from history_parser import iter_messages
+from history_store import (MessageStore, MessageStoreWriter, iter_time_range, read_head_fingerprint,
+                           timestamp_ms)
+
+BLOCK_CAP = 64
+
+
+def tool_call(uuid, parent, second):
+    record = message(uuid, parent, 'assistant', '', second)
+    record['message']['content'] = [
+        {'type': 'text', 'text': '调用工具'},
+        {'type': 'tool_use', 'id': f'tool-{uuid}', 'name': 'Bash', 'input': {'command': 'x' * 200}}]
+    return record
+
+
+def records(start, count):
+    """count 条消息，时间递增"""
+    result = []
+    for i in range(start, start + count):
+        parent = f'm{i - 1}' if i else None
+        result.append(tool_call(f'm{i}', parent, i) if i % 3 == 2 else
+                      message(f'm{i}', parent, 'user' if i % 2 == 0 else 'assistant', f'消息 {i}', i))
+    return result
+
+
+def parse(jsonl, start=0):
+    return list(iter_messages(jsonl, start, blocks=True, block_cap=BLOCK_CAP))
+
+
+def store_session(jsonl, base, resume=None):
+    """像导出时那样把 JSONL 中尚未存储的消息写入存储，返回写入器"""
+    writer = MessageStoreWriter(base, BLOCK_CAP)
+    start = 0
+    if resume and writer.resume(*resume):
+        start = writer.offset
+    stream = iter_messages(jsonl, start, blocks=True, block_cap=BLOCK_CAP)
+    for conv in stream:
+        writer.add(conv)
+    writer.commit(stream.offset, read_head_fingerprint(jsonl, stream.offset))
+    return writer
+
+
+def fields(conv):
+    return (conv.role, conv.content, conv.timestamp, conv.offset,
+            [(b.type, b.text, b.title, b.error, b.size, b.spill) for b in conv.blocks or []])
+
+
+def stored(base):
+    with MessageStore.open(base) as store:
+        return [fields(conv) for conv in store.messages()]
+
+
+@pytest.fixture
+def session(tmp_path):
+    return write_session(tmp_path / 'p' / 's.jsonl', records(0, 6)), tmp_path / 'store' / 'p' / 's'
+
+
+def test_round_trip(session):
+    jsonl, base = session
+    odd = message('odd', 'm5', 'user', 'raw time', 0)
+    odd['timestamp'] = '2026-10-01 00:00:07+08:00'
+    untimed = message('untimed', 'odd', 'assistant', 'no time', 0)
+    del untimed['timestamp']
+    write_session(jsonl, [odd, untimed], mode='a')
+
+    store_session(jsonl, base)
+    assert stored(base) == [fields(conv) for conv in parse(jsonl)]
+    with MessageStore.open(base) as store:
+        assert len(store) == 8 and store.offset == jsonl.stat().st_size
+        assert store.matches(jsonl)
+        # 超出上限的内容块只保留开头，记录原始大小
+        block = store.message(2).blocks[1]
+        assert len(block.text.encode('utf-8')) <= BLOCK_CAP < block.size
+        assert store.message(6).timestamp == '2026-10-01 00:00:07+08:00'
+        assert store.message(7).timestamp == ''
+        assert not store.header['sorted']
+
+
+def test_append_resumes_after_stored_messages(session):
+    jsonl, base = session
+    writer = store_session(jsonl, base)
+    blob = base.with_name('s.blob').read_bytes()
+    write_session(jsonl, records(6, 4), mode='a')
+
+    writer = store_session(jsonl, base, resume=(writer.offset, 6))
+    assert writer.offset == jsonl.stat().st_size
+    assert base.with_name('s.blob').read_bytes().startswith(blob)
+    assert stored(base) == [fields(conv) for conv in parse(jsonl)]
+    with MessageStore.open(base) as store:
+        assert len(store) == 10 and store.header['sorted']
+        assert store.index_after(store.offsets[5]) == 6
+
+
+def test_resume_refuses_a_different_prefix(session):
+    jsonl, base = session
+    writer = store_session(jsonl, base)
+    for offset, count in ((writer.offset - 1, 6), (writer.offset, 5)):
+        assert not MessageStoreWriter(base, BLOCK_CAP).resume(offset, count)
+    assert not MessageStoreWriter(base, BLOCK_CAP * 2).resume(writer.offset, 6)
+    assert MessageStoreWriter(base, BLOCK_CAP).resume(writer.offset, 6)
+
+
+def test_truncated_or_rewritten_session_is_reparsed(session):
+    jsonl, base = session
+    store_session(jsonl, base)
+
+    # 截断：存储比文件长，不再是它的前缀
+    write_session(jsonl, records(0, 3))
+    with MessageStore.open(base) as store:
+        assert not store.matches(jsonl)
+    store_session(jsonl, base)
+    assert stored(base) == [fields(conv) for conv in parse(jsonl)]
+
+    # 开头被改写：文件不比存储短，但指纹不同
+    rewritten = records(0, 6)
+    rewritten[0]['message']['content'][0]['text'] = '改写的消息'
+    write_session(jsonl, rewritten)
+    with MessageStore.open(base) as store:
+        assert not store.matches(jsonl)
+    store_session(jsonl, base)
+    assert stored(base)[0][1] == '改写的消息'
+    assert stored(base) == [fields(conv) for conv in parse(jsonl)]
+
+
+def test_incomplete_blob_is_ignored_and_leftovers_are_cut(session):
+    jsonl, base = session
+    writer = store_session(jsonl, base)
+    blob = base.with_name('s.blob')
+    size = blob.stat().st_size
+
+    # 写出中断：正文末尾多出未记录的字节，下次追加前截掉
+    with open(blob, 'ab') as f:
+        f.write(b'partial')
+    write_session(jsonl, records(6, 1), mode='a')
+    store_session(jsonl, base, resume=(writer.offset, 6))
+    assert stored(base) == [fields(conv) for conv in parse(jsonl)]
+
+    # 正文比表头记录的短：存储不可用
+    with open(blob, 'r+b') as f:
+        f.truncate(size - 1)
+    assert MessageStore.open(base) is None
+    assert not MessageStoreWriter(base, BLOCK_CAP).resume(jsonl.stat().st_size, 7)
+
+
+def test_time_range_matches_parsing(session):
+    jsonl, base = session
+    store_session(jsonl, base)
+    write_session(jsonl, records(6, 4), mode='a')
+    since = timestamp_ms('2026-10-01T00:00:02.000Z')
+    until = timestamp_ms('2026-10-01T00:00:08.000Z')
+
+    with MessageStore.open(base) as store:
+        assert store.time_range(since, until) == range(2, 6)
+        assert store.time_range() == range(6)
+    # 存储覆盖的部分按时间索引定位，之后追加的部分解析 JSONL
+    for base_path in (base, None):
+        found = [(seq, conv.content) for seq, conv in iter_time_range(jsonl, base_path, since, until,
+                                                                      block_cap=BLOCK_CAP)]
+        assert found == [(i + 1, conv.content) for i, conv in enumerate(parse(jsonl)) if 2 <= i < 8]
+    assert [seq for seq, _ in iter_time_range(jsonl, base, block_cap=BLOCK_CAP)] == list(range(1, 11))
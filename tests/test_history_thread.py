@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""对话树：当前分支的选择和未采用分支的识别"""
+
+from history_thread import ThreadIndex, record_links
+
+
+def build(records):
+    """records 为 (uuid, 父记录 uuid, 消息序号或 0[, 是否为子代理记录])，按文件中的顺序"""
+    thread = ThreadIndex()
+    for offset, (uuid, parent, seq, *side) in enumerate(records, 1):
+        thread.add(uuid, parent, bool(side and side[0]))
+        thread.last_offset = offset
+        if seq:
+            thread.mark_message(offset, seq)
+    return thread
+
+
+def test_linear_session_hides_nothing():
+    view = build([('u1', None, 1), ('a1', 'u1', 2), ('u2', 'a1', 3)]).view()
+    assert view.hidden == {}
+    assert view.continues is None
+
+
+def test_retry_hides_old_branch():
+    view = build([
+        ('u1', None, 1), ('a1', 'u1', 2),
+        ('u2', 'a1', 3), ('a2', 'u2', 4),
+        ('u2b', 'a1', 5), ('a2b', 'u2b', 6),
+    ]).view()
+    assert view.hidden == {3: 2, 4: 2}
+
+
+def test_edited_first_message_hides_old_root():
+    view = build([
+        ('u1', None, 1), ('a1', 'u1', 2),
+        ('u1b', None, 3), ('a1b', 'u1b', 4),
+    ]).view()
+    assert view.hidden == {1: 0, 2: 0}
+
+
+def test_parent_written_after_child():
+    # a2 先于它的父记录 u2 写出；u2 所在的分支未被采用
+    view = build([
+        ('u1', None, 1), ('a2', 'u2', 2), ('u2', 'u1', 3),
+        ('u2b', 'u1', 4), ('a2b', 'u2b', 5),
+    ]).view()
+    assert view.hidden == {2: 1, 3: 1}
+
+
+def test_fork_after_non_message_record():
+    # 分出处是系统记录时，取当前分支上它之前最近的消息
+    view = build([
+        ('u1', None, 1), ('s1', 'u1', 0),
+        ('u2', 's1', 2), ('u2b', 's1', 3),
+    ]).view()
+    assert view.hidden == {2: 1}
+
+
+def test_sidechain_records_are_never_hidden():
+    view = build([
+        ('u1', None, 1), ('a1', 'u1', 2),
+        ('k1', None, 3, True), ('k2', 'k1', 4, True),
+    ]).view()
+    assert view.hidden == {}
+
+
+def test_continued_session():
+    view = build([('b1', 'other-session', 1), ('b2', 'b1', 2)]).view()
+    assert view.continues == 'other-session'
+    assert view.hidden == {}
+
+
+def test_compaction_links_through_logical_parent():
+    line = b'{"parentUuid":null,"logicalParentUuid":"a1","type":"system","uuid":"s1"}'
+    assert record_links(None, line) == ('s1', 'a1', False)
+    assert record_links({'parentUuid': None, 'logicalParentUuid': 'a1', 'uuid': 's1'}, line) == ('s1', 'a1', False)
+    view = build([('u1', None, 1), ('a1', 'u1', 2), ('s1', 'a1', 0), ('u2', 's1', 3)]).view()
+    assert view.hidden == {}
+
+
+def test_cycle_terminates():
+    thread = build([('x', 'y', 1), ('y', 'x', 2), ('u1', None, 3)])
+    assert thread.view().hidden == {1: 0, 2: 0}
+
+
+def test_save_and_resume(tmp_path):
+    thread = build([('u1', None, 1), ('a1', 'u1', 2), ('u2', 'a1', 3)])
+    thread.offset = 3
+    thread.save(tmp_path / 's.thread', 'head')
+    loaded, head = ThreadIndex.load(tmp_path / 's.thread')
+    assert head == 'head'
+    loaded.add('u2b', 'a1')
+    loaded.last_offset = 4
+    loaded.mark_message(4, 4)
+    assert loaded.view().hidden == {3: 2}
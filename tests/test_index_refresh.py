@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+"""仅刷新索引页：沿用清单和索引缓存，只解析新增部分，结果与完整导出的 index.html 一致"""
+
+import json
+import shutil
+
+import pytest
+
+from conftest import message, write_session
+
+
+def reply(uuid, parent, text, second, output_tokens):
+    record = message(uuid, parent, 'assistant', text, second)
+    record['message'].update(id=f'msg-{uuid}', model='claude-test',
+                             usage={'input_tokens': 10, 'output_tokens': output_tokens})
+    return record
+
+
+@pytest.fixture
+def setup(tmp_path, manager_module):
+    projects = tmp_path / '.claude' / 'projects'
+    a = write_session(projects / 'proj-a' / 'a.jsonl', [
+        message('u1', None, 'user', 'first question'), reply('r1', 'u1', 'answer', 1, 20)])
+    b = write_session(projects / 'proj-b' / 'b.jsonl', [message('v1', None, 'user', 'other question')])
+    starts = []
+
+    def manager(out='out'):
+        instance = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / out)
+        iter_session = instance.iter_session
+
+        def recording(jsonl_file, start_offset=0, *args, **kwargs):
+            starts.append((jsonl_file.name, start_offset))
+            return iter_session(jsonl_file, start_offset, *args, **kwargs)
+        instance.iter_session = recording
+        return instance
+
+    manager().export_all()
+    starts.clear()
+    return a, b, manager, starts
+
+
+def full_export_index(tmp_path, manager):
+    """在输出目录的副本上完整导出，返回其 index.html"""
+    shutil.rmtree(tmp_path / 'copy', ignore_errors=True)
+    shutil.copytree(tmp_path / 'out', tmp_path / 'copy')
+    manager('copy').export_all()
+    return (tmp_path / 'copy' / 'index.html').read_text('utf-8')
+
+
+def test_refresh_matches_full_export(tmp_path, setup):
+    a, b, manager, starts = setup
+    out = tmp_path / 'out'
+    manifest = (out / '.manifest.json').read_bytes()
+    markdown = (out / 'sessions' / 'proj-a' / 'a.md').read_bytes()
+    size = a.stat().st_size
+
+    write_session(a, [message('u2', 'r1', 'user', 'follow-up', 5), reply('r2', 'u2', 'more', 6, 30)], mode='a')
+    b.unlink()
+    b.parent.rmdir()
+    manager().refresh_index()
+    # 只解析追加的部分，不写会话文件和清单
+    assert starts == [('a.jsonl', size)]
+    assert (out / '.manifest.json').read_bytes() == manifest
+    assert (out / 'sessions' / 'proj-a' / 'a.md').read_bytes() == markdown
+
+    index = (out / 'index.html').read_text('utf-8')
+    assert 'other question' not in index
+    assert index == full_export_index(tmp_path, manager)
+
+
+def test_cache_is_reused_until_the_session_changes(tmp_path, setup, capsys):
+    a, _, manager, starts = setup
+    cache_path = tmp_path / 'out' / '.index-cache.json'
+
+    write_session(a, [message('u2', 'r1', 'user', 'follow-up', 5)], mode='a')
+    manager().refresh_index()
+    cached = json.loads(cache_path.read_text('utf-8'))['files']
+    # 清单中的记录仍然有效的会话不进入缓存
+    assert list(cached) == [str(a)]
+    assert cached[str(a)]['count'] == 3 and cached[str(a)]['offset'] == a.stat().st_size
+
+    starts.clear()
+    capsys.readouterr()
+    manager().refresh_index()
+    assert starts == [] and '0 re-read' in capsys.readouterr().out
+
+    # 缓存之后再次追加：从缓存记录的位置继续
+    size = a.stat().st_size
+    write_session(a, [reply('r2', 'u2', 'more', 6, 30)], mode='a')
+    manager().refresh_index()
+    assert starts == [('a.jsonl', size)]
+    assert (tmp_path / 'out' / 'index.html').read_text('utf-8') == full_export_index(tmp_path, manager)
+
+    # 截断后重写：从头解析，摘要也随之更新
+    starts.clear()
+    write_session(a, [message('w1', None, 'user', 'rewritten question')])
+    manager().refresh_index()
+    assert starts == [('a.jsonl', 0)]
+    index = (tmp_path / 'out' / 'index.html').read_text('utf-8')
+    assert 'rewritten question' in index and 'first question' not in index
+    assert index == full_export_index(tmp_path, manager)
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+"""来源会话消失后，它的会话输出、项目汇总页和存储都被清理"""
+
+import json
+
+from conftest import message, write_session
+
+
+def session_records(name):
+    return [message(f'{name}1', None, 'user', f'question in {name}'),
+            message(f'{name}2', f'{name}1', 'assistant', f'answer in {name}', 1)]
+
+
+def test_removed_sessions_and_projects_are_cleaned_up(tmp_path, manager_module):
+    projects = tmp_path / '.claude' / 'projects'
+    out = tmp_path / 'out'
+    a = write_session(projects / 'proj-a' / 'a.jsonl', session_records('a'))
+    b = write_session(projects / 'proj-b' / 'b.jsonl', session_records('b'))
+
+    def export():
+        manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=out,
+                                                      html_pages=True)
+        manager.export_all()
+        return json.loads((out / '.manifest.json').read_text('utf-8'))
+
+    manifest = export()
+    assert manifest['rollups'] == ['proj-a.md', 'proj-b.md']
+    for path in ('proj-a.md', 'proj-b.md', 'sessions/proj-b/b.md', 'sessions/proj-b/b/index.html',
+                 '.store/proj-b/b.cols', '.store/proj-b/b.thread'):
+        assert (out / path).exists(), path
+
+    # 删除一个项目
+    b.unlink()
+    b.parent.rmdir()
+    manifest = export()
+    assert manifest['rollups'] == ['proj-a.md']
+    assert not (out / 'proj-b.md').exists()
+    assert not (out / 'sessions' / 'proj-b' / 'b.md').exists()
+    assert not (out / 'sessions' / 'proj-b' / 'b').exists()
+    assert not (out / '.store' / 'proj-b' / 'b.cols').exists()
+    assert 'answer in b' not in (out / 'index.html').read_text('utf-8')
+    assert 'answer in a' in (out / 'sessions' / 'proj-a' / 'a.md').read_text('utf-8')
+
+    # 所有会话都已不存在：不提前返回，照常清理
+    a.unlink()
+    manifest = export()
+    assert manifest['files'] == {} and manifest['outputs'] == {} and manifest['rollups'] == []
+    assert not (out / 'proj-a.md').exists()
+    assert not (out / 'sessions' / 'proj-a' / 'a.md').exists()
+    assert not (out / '.store' / 'proj-a' / 'a.cols').exists()
+    assert 'question in a' not in (out / 'index.html').read_text('utf-8')
+    manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=out)
+    assert manager.get_stats().totals('p:') == {}
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""view-history.py 的消息序号与 claude-history-manager.py 的导出一致"""
+
+import re
+
+import pytest
+
+from conftest import load_script, message, write_session
+
+PASTED = 'pasted file contents\n' * 60
+
+
+def tool_call(uuid, parent, second):
+    """只含工具调用的助手记录：也占用一个消息序号"""
+    record = message(uuid, parent, 'assistant', '', second)
+    record['message']['content'] = [{'type': 'tool_use', 'id': f'tool-{uuid}', 'name': 'Bash',
+                                     'input': {'command': 'ls'}}]
+    return record
+
+
+RECORDS = [
+    message('u1', None, 'user', PASTED, 0),
+    tool_call('t1', 'u1', 1),
+    message('a1', 't1', 'assistant', 'first answer', 2),
+    message('a1b', 't1', 'assistant', 'retried answer', 3),
+    message('u2', 'a1b', 'user', PASTED, 4),
+    tool_call('t2', 'u2', 5),
+    message('a2', 't2', 'assistant', 'second answer', 6),
+]
+
+
+def numbered(path):
+    """{消息序号: 该消息的内容}"""
+    parts = re.split(r'^## (\d+)\. .*$', path.read_text('utf-8'), flags=re.M)
+    return {int(number): body.split('\n---\n')[0] for number, body in zip(parts[1::2], parts[2::2])}
+
+
+@pytest.mark.parametrize('store_dir', ['out/.store', 'missing'])
+def test_numbers_match_manager_export(tmp_path, monkeypatch, manager_module, store_dir):
+    session = write_session(tmp_path / '.claude' / 'projects' / 'proj' / 's.jsonl', RECORDS)
+    manager = manager_module.ClaudeHistoryManager(claude_dir=tmp_path / '.claude', output_dir=tmp_path / 'out')
+    manager.export_all()
+    exported = numbered(tmp_path / 'out' / 'sessions' / 'proj' / 's.md')
+    # 未采用分支中的第 3 条不输出，工具调用只在完整导出中显示
+    assert sorted(exported) == [1, 2, 4, 5, 6, 7]
+    assert '与第 1 条消息内容相同' in exported[5]
+
+    view_history = load_script('view-history.py', 'view_history')
+    monkeypatch.setattr(view_history, 'STORE_DIR', tmp_path / store_dir)
+    for since in (None, 0):
+        with open(tmp_path / 'v.md', 'w', encoding='utf-8') as f:
+            assert view_history.write_filtered_markdown(f, [session], since=since) == 4
+        messages = numbered(tmp_path / 'v.md')
+        assert sorted(messages) == [1, 4, 5, 7]
+        assert 'retried answer' in messages[4] and 'second answer' in messages[7]
+        if since is None:
+            # 不限时间时重复的正文与完整导出一样折叠为引用
+            assert '与第 1 条消息内容相同' in messages[5] and '#m1' in messages[5]
+        else:
+            assert PASTED in messages[5]
@@ -5,54 +5,16 @@ Claude 对话历史查看器
 将 JSONL 格式的对话历史转换为易读的 Markdown 格式
 """
 
-import json
-import sys
+import argparse
 from pathlib import Path
 from datetime import datetime
 
-def parse_chat_history(jsonl_path):
-    """解析 JSONL 对话历史"""
-    conversations = []
-
-    with open(jsonl_path, 'r', encoding='utf-8') as f:
-        for line in f:
-            try:
-                data = json.loads(line)
-                if data.get('type') == 'user':
-                    # 用户消息
-                    message = data.get('message', {})
-                    content_list = message.get('content', [])
-                    text = ''
-                    for item in content_list:
-                        if item.get('type') == 'text':
-                            text = item.get('text', '')
-
-                    timestamp = data.get('timestamp', '')
-                    conversations.append({
-                        'role': 'user',
-                        'content': text,
-                        'timestamp': timestamp
-                    })
-
-                elif data.get('type') == 'assistant':
-                    # AI 回复
-                    message = data.get('message', {})
-                    content_list = message.get('content', [])
-                    text = ''
-                    for item in content_list:
-                        if item.get('type') == 'text':
-                            text = item.get('text', '')
-
-                    timestamp = data.get('timestamp', '')
-                    conversations.append({
-                        'role': 'assistant',
-                        'content': text,
-                        'timestamp': timestamp
-                    })
-            except json.JSONDecodeError:
-                continue
+from history_output import AtomicFile
+from history_parser import DEFAULT_BLOCK_CAP, INTERN_MIN_SIZE, BlockInterner
+from history_store import iter_time_range, parse_time, session_view
 
-    return conversations
+# claude-history-manager.py 默认输出目录中的消息存储，筛选时用其时间索引直接定位
+STORE_DIR = Path.home() / "Documents" / "Claude History" / ".store"
 
 def format_timestamp(iso_timestamp):
     """格式化时间戳"""
@@ -62,51 +24,99 @@ def format_timestamp(iso_timestamp):
     except:
         return iso_timestamp
 
-def generate_markdown(conversations):
-    """生成 Markdown 格式的对话历史"""
-    md = "# Claude 对话历史\n\n"
-    md += f"生成时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n\n"
-    md += "---\n\n"
-
-    for i, conv in enumerate(conversations, 1):
-        if not conv['content']:
-            continue
-
-        role = "👤 用户" if conv['role'] == 'user' else "🤖 Claude"
-        timestamp = format_timestamp(conv['timestamp']) if conv['timestamp'] else ''
-
-        md += f"## {i}. {role}\n\n"
-        if timestamp:
-            md += f"*时间: {timestamp}*\n\n"
-        md += f"{conv['content']}\n\n"
-        md += "---\n\n"
+def write_message(f, i, conv):
+    """写入第 i 条消息"""
+    role = "👤 用户" if conv.role == 'user' else "🤖 Claude"
+    timestamp = format_timestamp(conv.timestamp) if conv.timestamp else ''
+
+    if conv.repeat_of is None and len(conv.content) >= INTERN_MIN_SIZE:
+        f.write(f'<a id="m{i}"></a>\n\n')
+    f.write(f"## {i}. {role}\n\n")
+    if timestamp:
+        f.write(f"*时间: {timestamp}*\n\n")
+    if conv.repeat_of is None:
+        f.write(conv.content)
+    else:
+        # 重复的大段正文只写对首次出现的引用
+        f.write(f"<details>\n<summary>🔁 与第 {conv.repeat_of} 条消息内容相同，已折叠</summary>\n\n"
+                f"[跳转到第 {conv.repeat_of} 条消息](#m{conv.repeat_of})\n\n</details>")
+    f.write("\n\n---\n\n")
+
+def write_filtered_markdown(f, jsonl_paths, since=None, until=None):
+    """写入多个会话中时间在 [since, until)（UTC 毫秒）内的消息，返回消息数量
+
+    消息序号与 claude-history-manager.py 的导出一致；只含工具调用或工具结果的记录和未采用分支中的消息不输出。
+    不限时间时整个会话按顺序读取，重复的大段正文折叠为对首次出现的引用。
+    """
+    f.write("# Claude 对话历史\n\n")
+    f.write("---\n\n")
+
+    count = 0
+    for jsonl_path in jsonl_paths:
+        store_path = STORE_DIR / jsonl_path.parent.name.replace('/', '_').replace('\\', '_') / jsonl_path.stem
+        found = False
+        hidden = None
+        interner = BlockInterner() if since is None and until is None else None
+        for i, conv in iter_time_range(jsonl_path, store_path, since, until, block_cap=DEFAULT_BLOCK_CAP):
+            if hidden is None:
+                hidden = session_view(jsonl_path, store_path, block_cap=DEFAULT_BLOCK_CAP).hidden
+            if interner:
+                interner.add(conv)
+                # 首次出现处不输出时，重复的正文完整写出
+                if conv.repeat_of in hidden:
+                    conv.repeat_of = None
+            if not conv.content or i in hidden:
+                continue
+            if not found:
+                f.write(f"# {jsonl_path.parent.name}\n\n会话: {jsonl_path.stem}\n\n---\n\n")
+                found = True
+            write_message(f, i, conv)
+            count += 1
 
-    return md
+    return count
 
 def main():
     # 默认路径
     default_path = Path.home() / ".claude" / "projects" / "e-----vibe-coding-Claude-Code-gtm-assistant-ai-version" / "24a291d5-5997-4fbf-855b-da4a8cac7cea.jsonl"
 
-    # 使用命令行参数或默认路径
-    jsonl_path = Path(sys.argv[1]) if len(sys.argv) > 1 else default_path
-
-    if not jsonl_path.exists():
-        print(f"File not found: {jsonl_path}")
-        return
-
-    print(f"Reading chat history: {jsonl_path.name}")
-
-    # 解析对话
-    conversations = parse_chat_history(jsonl_path)
-    print(f"Found {len(conversations)} messages")
-
-    # 生成 Markdown
-    markdown = generate_markdown(conversations)
-
-    # 保存到文件
-    output_path = jsonl_path.parent / "chat_history.md"
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(markdown)
+    parser = argparse.ArgumentParser(description="将 JSONL 对话历史转换为 Markdown")
+    parser.add_argument('jsonl', nargs='?', type=Path, default=default_path, help="对话历史文件")
+    parser.add_argument('--since', metavar='TIME',
+                        help="只输出该时间之后的消息（2026-10-01、2026-10-01T08:00、7d、12h；不带时区时为 UTC）")
+    parser.add_argument('--until', metavar='TIME', help="只输出该时间之前的消息（只写日期时包含当天）")
+    parser.add_argument('--project', metavar='NAME',
+                        help="输出 ~/.claude/projects 中名称包含该字符串的项目的所有会话")
+    parser.add_argument('-o', '--output', type=Path,
+                        help="输出文件（默认: 对话历史所在目录的 chat_history.md，指定 --project 时为当前目录）")
+    args = parser.parse_args()
+    try:
+        since = parse_time(args.since) if args.since else None
+        until = parse_time(args.until, end=True) if args.until else None
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.project:
+        projects_dir = Path.home() / ".claude" / "projects"
+        jsonl_paths = sorted(path for path in projects_dir.glob("*/*.jsonl")
+                             if args.project.lower() in path.parent.name.lower())
+        if not jsonl_paths:
+            print(f"No sessions found for project: {args.project}")
+            return
+        output_path = args.output or Path.cwd() / "chat_history.md"
+        print(f"Reading {len(jsonl_paths)} sessions")
+    else:
+        jsonl_path = args.jsonl
+        if not jsonl_path.exists():
+            print(f"File not found: {jsonl_path}")
+            return
+        jsonl_paths = [jsonl_path]
+        output_path = args.output or jsonl_path.parent / "chat_history.md"
+        print(f"Reading chat history: {jsonl_path.name}")
+
+    # 边解析边写入 Markdown
+    with AtomicFile(output_path) as f:
+        count = write_filtered_markdown(f, jsonl_paths, since, until)
+    print(f"Found {count} messages")
 
     print(f"Chat history saved to: {output_path}")
     print(f"\nView with:")